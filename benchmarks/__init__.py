@@ -0,0 +1,3 @@
+"""
+Benchmarks of the h5p package pipeline, run with python -m benchmarks.run
+"""
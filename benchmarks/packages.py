@@ -0,0 +1,67 @@
+"""
+Synthetic H5P packages of different shapes for benchmarks
+"""
+import json
+import random
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def build_library(h5p_zip, name, files, file_size, depth, rng):
+    """
+    Writes a library with given number of JS files, nested depth directories deep, into the zip
+    """
+    folder = "{}-1.0".format(name)
+    h5p_zip.writestr("{}/library.json".format(folder), json.dumps({
+        "machineName": name,
+        "majorVersion": 1,
+        "minorVersion": 0,
+        "patchVersion": 0,
+        "preloadedJs": [{"path": "js/{}.js".format(index)} for index in range(min(files, 5))],
+    }))
+    for index in range(files):
+        directory = "/".join("d{}".format(level) for level in range(index % (depth + 1)))
+        path = "{}/js/{}{}.js".format(folder, directory + "/" if directory else "", index)
+        h5p_zip.writestr(path, "var v{} = '{}';\n".format(index, rng.choice("abcdef") * file_size))
+
+
+def build_package(path, libraries=1, files=10, file_size=1024, media=0, media_size=0, depth=0, seed=0):
+    """
+    Writes an h5p package to path and returns it opened for reading
+
+    Packages hold given number of libraries of files JS files each, nested depth directories deep,
+    and media content files of media_size random bytes, which don't compress. The package is written
+    to disk by chunks, so that building it doesn't grow the memory of the process measured by a case.
+    """
+    rng = random.Random(seed)
+    names = ["H5P.Bench{}".format(index) for index in range(libraries)]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as h5p_zip:
+        h5p_zip.writestr("h5p.json", json.dumps({
+            "title": "Benchmark",
+            "mainLibrary": names[0],
+            "preloadedDependencies": [
+                # Versions are strings in h5p.json of real packages, unlike in library.json
+                {"machineName": name, "majorVersion": "1", "minorVersion": "0"} for name in names
+            ],
+        }))
+        h5p_zip.writestr("content/content.json", json.dumps({"media": [
+            "videos/{}.mp4".format(index) for index in range(media)
+        ]}))
+        for name in names:
+            build_library(h5p_zip, name, files, file_size, depth, rng)
+        for index in range(media):
+            zip_info = zipfile.ZipInfo("content/videos/{}.mp4".format(index))
+            zip_info.file_size = media_size
+            with h5p_zip.open(zip_info, "w") as member:
+                for offset in range(0, media_size, CHUNK_SIZE):
+                    size = min(CHUNK_SIZE, media_size - offset)
+                    member.write(rng.getrandbits(size * 8).to_bytes(size, "little"))
+    return open(path, "rb")
+
+
+PACKAGE_SHAPES = {
+    "many_small": {"libraries": 20, "files": 100, "file_size": 2048},
+    "few_huge": {"media": 3, "media_size": 20 * 1024 * 1024},
+    "deep_tree": {"libraries": 5, "files": 100, "file_size": 512, "depth": 12},
+}
@@ -0,0 +1,429 @@
+"""
+Benchmarks of the h5p package pipeline and block handlers
+
+Each case runs in its own process, so that settings can differ between cases, and the best of a few runs
+is kept. Wall time, storage calls and peak RSS growth of the measured call of each case are compared against
+benchmarks/baseline.json.
+
+Usage:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --case cloud_unpack_many_small --latency 0.02
+    python -m benchmarks.run --save-baseline
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_LATENCY = 0.005
+# Differences in wall time below this many seconds are considered noise
+TIME_NOISE_FLOOR = 0.05
+# Differences in peak RSS growth below this many kilobytes are considered noise: memory taken by the stacks and
+# allocator arenas of worker threads varies between runs and with the number of CPUs of the host
+RSS_NOISE_FLOOR_KB = 8 * 1024
+
+
+def read_memory_kb(field):
+    """
+    Returns a memory field of /proc/self/status in kilobytes, e.g. VmRSS or VmHWM, or None without procfs
+    """
+    try:
+        with open("/proc/self/status", encoding="utf8") as status_file:
+            for line in status_file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Measurement:
+    """
+    Measures wall time and peak RSS growth of the code run within it
+
+    The peak RSS of the process is reset on entry, so that memory used by setting up the case, e.g. building
+    its package, is left out. Peak RSS growth is only measured on Linux, and is None elsewhere.
+    """
+
+    def __enter__(self):
+        try:
+            # Writing 5 resets the peak RSS (VmHWM) of the process to its current RSS
+            with open("/proc/self/clear_refs", "w", encoding="utf8") as clear_refs:
+                clear_refs.write("5")
+            self.rss_before = read_memory_kb("VmRSS")
+        except OSError:
+            self.rss_before = None
+        self.peak_rss_kb = None
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.perf_counter() - self.started
+        peak_rss = read_memory_kb("VmHWM")
+        if self.rss_before is not None and peak_rss is not None:
+            self.peak_rss_kb = max(peak_rss - self.rss_before, 0)
+
+
+def configure_django(media_root, overrides):
+    """
+    Configures minimal Django settings, which h5pxblock reads when imported
+    """
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        MEDIA_ROOT=media_root,
+        MEDIA_URL="/media/",
+        INSTALLED_APPS=[],
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        TEMPLATES=[{"BACKEND": "django.template.backends.django.DjangoTemplates"}],
+        **overrides,
+    )
+    django.setup()
+
+
+def cloud_unpack(shape, fail_rate=0.0, shared_libraries_path=None):
+    """
+    Returns a case uploading a package of given shape to the fake cloud storage
+    """
+    def run(options):
+        from benchmarks.packages import PACKAGE_SHAPES, build_package
+        from benchmarks.storage import InMemoryStorage
+        from h5pxblock.utils import unpack_and_upload_on_cloud
+
+        storage = InMemoryStorage(latency=options.latency, fail_rate=fail_rate)
+        with build_package(options.package_path, **PACKAGE_SHAPES[shape]) as package, Measurement() as measurement:
+            unpack_and_upload_on_cloud(package, storage, "h5pxblockmedia/org/course/block", shared_libraries_path)
+        return measurement, storage.calls
+    return run
+
+
+def cloud_reupload(shape):
+    """
+    Returns a case uploading a package of given shape again over its previous upload
+    """
+    def run(options):
+        from benchmarks.packages import PACKAGE_SHAPES, build_package
+        from benchmarks.storage import InMemoryStorage
+        from h5pxblock.utils import unpack_and_upload_on_cloud
+
+        storage = InMemoryStorage(latency=options.latency)
+        with build_package(options.package_path, **PACKAGE_SHAPES[shape]) as package:
+            unpack_and_upload_on_cloud(package, storage, "h5pxblockmedia/org/course/block")
+        storage.calls.clear()
+        with build_package(options.package_path, **PACKAGE_SHAPES[shape]) as package, Measurement() as measurement:
+            unpack_and_upload_on_cloud(package, storage, "h5pxblockmedia/org/course/block")
+        return measurement, storage.calls
+    return run
+
+
+def cloud_delete(files, batch_api):
+    """
+    Returns a case deleting a content tree of given number of files from the fake cloud storage
+    """
+    def run(options):
+        from benchmarks.storage import InMemoryStorage
+        from h5pxblock.utils import delete_existing_files_cloud
+
+        storage = InMemoryStorage(latency=options.latency, batch_api=batch_api)
+        for index in range(files):
+            storage.files["h5pxblockmedia/org/course/block/d{}/{}.js".format(index % 50, index)] = b"x" * 100
+        with Measurement() as measurement:
+            delete_existing_files_cloud(storage, "h5pxblockmedia/org/course/block")
+        return measurement, storage.calls
+    return run
+
+
+def local_unpack(shape):
+    """
+    Returns a case extracting a package of given shape on the local filesystem
+    """
+    def run(options):
+        from django.conf import settings
+
+        from benchmarks.packages import PACKAGE_SHAPES, build_package
+        from h5pxblock.utils import unpack_package_local_path
+
+        path = os.path.join(settings.MEDIA_ROOT, "h5pxblockmedia/org/course/block")
+        with build_package(options.package_path, **PACKAGE_SHAPES[shape]) as package, Measurement() as measurement:
+            unpack_package_local_path(package, path)
+        return measurement, {}
+    return run
+
+
+def make_block():
+    """
+    Returns a block on a toy runtime, with the services of the LMS the handlers use
+    """
+    from types import SimpleNamespace
+    from unittest import mock
+
+    from xblock.field_data import DictFieldData
+    from xblock.fields import ScopeIds
+    from xblock.test.toy_runtime import ToyRuntime
+
+    from h5pxblock.h5pxblock import H5PPlayerXBlock
+
+    runtime = ToyRuntime()
+    runtime.publish = mock.Mock()
+    block = H5PPlayerXBlock(
+        runtime, DictFieldData({"has_score": True}), ScopeIds("student", "h5pxblock", "definition", "usage")
+    )
+    block.location = SimpleNamespace(org="org", course="course", block_id="block")
+    block.due = None
+    block.emit_completion = mock.Mock()
+    user_service = mock.Mock(
+        get_current_user=mock.Mock(return_value=SimpleNamespace(full_name="Learner", emails=["learner@example.com"]))
+    )
+    toy_service = runtime.service
+    runtime.service = lambda block, name: user_service if name == "user" else toy_service(block, name)
+    return block
+
+
+def handler_user_state(requests):
+    """
+    Returns a case saving and fetching learner state through the user_interaction_data handler
+    """
+    def run(options):
+        from webob import Request
+
+        block = make_block()
+        states = [json.dumps({"progress": index % 10, "answers": ["answer"] * 200}) for index in range(requests)]
+        with Measurement() as measurement:
+            for state in states:
+                block.user_interaction_data(Request.blank("/", POST={"data": state}))
+                block.user_interaction_data(Request.blank("/"))
+        return measurement, {}
+    return run
+
+
+def handler_result(requests):
+    """
+    Returns a case posting scored xAPI statements to the result_handler
+    """
+    def run(options):
+        from webob import Request
+
+        block = make_block()
+        bodies = [
+            json.dumps({"result": {"score": {"raw": index % 10, "max": 10}}}).encode() for index in range(requests)
+        ]
+        with Measurement() as measurement:
+            for body in bodies:
+                block.result_handler(Request.blank("/", method="POST", body=body))
+        return measurement, {}
+    return run
+
+
+def student_view(renders):
+    """
+    Returns a case rendering the student view
+    """
+    def run(options):
+        block = make_block()
+        block.student_view()
+        with Measurement() as measurement:
+            for _ in range(renders):
+                block.student_view()
+        return measurement, {}
+    return run
+
+
+def xapi_forward(statements, fail_rate=0.0):
+    """
+    Returns a case queueing statements in batches and waiting until they are all stored by a stub LRS
+    """
+    def run(options):
+        from django.conf import settings
+
+        from benchmarks.stub_lrs import StubLRS
+
+        lrs = StubLRS(latency=options.latency, fail_rate=fail_rate).start()
+        # Set before h5pxblock.xapi reads them, as the endpoint is only known once the stub listens
+        settings.H5PXBLOCK_LRS_ENDPOINT = lrs.endpoint
+        settings.H5PXBLOCK_LRS_QUEUE_PATH = os.path.join(settings.MEDIA_ROOT, "xapi-queue.sqlite3")
+        settings.H5PXBLOCK_LRS_RETRY_DELAY = 0.05
+        settings.H5PXBLOCK_LRS_POLL_INTERVAL = 0.05
+        from h5pxblock.xapi import enqueue_statements, get_forwarder, prepare_statement
+
+        actor = {"objectType": "Agent", "name": "Learner", "mbox": "mailto:learner@example.com"}
+        batches = [
+            [
+                prepare_statement({
+                    "verb": {"id": "http://adlnet.gov/expapi/verbs/answered"},
+                    "object": {"id": "https://example.com/activities/{}".format(index)},
+                }, actor)
+                for index in range(start, start + 20)
+            ]
+            for start in range(0, statements, 20)
+        ]
+        with Measurement() as measurement:
+            for batch in batches:
+                enqueue_statements(batch)
+            while get_forwarder().queue.count():
+                time.sleep(0.01)
+        lrs.stop()
+        if len(lrs.statements) != statements:
+            raise RuntimeError("Stub LRS stored {} of {} statements".format(len(lrs.statements), statements))
+        return measurement, lrs.calls
+    return run
+
+
+CASES = {
+    "cloud_unpack_many_small": {"run": cloud_unpack("many_small")},
+    "cloud_unpack_few_huge": {"run": cloud_unpack("few_huge")},
+    "cloud_unpack_deep_tree": {"run": cloud_unpack("deep_tree")},
+    "cloud_unpack_failures": {"run": cloud_unpack("many_small", fail_rate=0.02)},
+    "cloud_unpack_shared_libraries": {
+        "run": cloud_unpack("many_small", shared_libraries_path="h5pxblockmedia/shared-libraries"),
+    },
+    "cloud_reupload_differential": {
+        "run": cloud_reupload("many_small"), "settings": {"H5PXBLOCK_DIFFERENTIAL_SYNC": True},
+    },
+    "cloud_delete_batch": {"run": cloud_delete(5000, batch_api=True)},
+    "cloud_delete_listdir": {"run": cloud_delete(5000, batch_api=False)},
+    # Extraction on the local filesystem varies a lot between runs, so more runs are needed to get a stable best
+    "local_unpack_many_small": {"run": local_unpack("many_small"), "repeat": 7},
+    "local_unpack_few_huge": {"run": local_unpack("few_huge"), "repeat": 7},
+    "local_unpack_deep_tree": {"run": local_unpack("deep_tree"), "repeat": 7},
+    "handler_user_state": {"run": handler_user_state(500)},
+    "handler_result": {"run": handler_result(500)},
+    "handler_student_view": {"run": student_view(200)},
+    "xapi_forward": {"run": xapi_forward(2000)},
+    "xapi_forward_failures": {"run": xapi_forward(2000, fail_rate=0.1)},
+}
+
+
+def run_case(name, options):
+    """
+    Runs a case in the current process and prints its measurements as JSON
+    """
+    media_root = tempfile.mkdtemp()
+    # Packages are built outside of the media root, which is what cases unpack into
+    options.package_path = os.path.join(tempfile.mkdtemp(), "benchmark.h5p")
+    try:
+        configure_django(media_root, CASES[name].get("settings", {}))
+        measurement, calls = CASES[name]["run"](options)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(options.package_path), ignore_errors=True)
+    print(json.dumps({
+        "wall_time": round(measurement.wall_time, 4),
+        "calls": dict(sorted(calls.items())),
+        "peak_rss_kb": measurement.peak_rss_kb,
+    }))
+
+
+def spawn_case(name, options):
+    """
+    Runs a case options.repeat times, or more if the case asks for it, each in a child process, and returns
+    its best measurements along with its median wall time, which tells how noisy the case is
+    """
+    results = [spawn_case_once(name, options) for _ in range(max(options.repeat, CASES[name].get("repeat", 0)))]
+    wall_times = sorted(result["wall_time"] for result in results)
+    peak_rss = [result["peak_rss_kb"] for result in results if result["peak_rss_kb"] is not None]
+    return {
+        "wall_time": wall_times[0],
+        "wall_time_median": wall_times[len(wall_times) // 2],
+        "calls": results[0]["calls"],
+        "peak_rss_kb": min(peak_rss) if peak_rss else None,
+    }
+
+
+def spawn_case_once(name, options):
+    """
+    Runs a case in a child process and returns its measurements
+    """
+    process = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--case", name, "--child", "--latency", str(options.latency)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    # Logs of the pipeline, e.g. of injected failures, are only shown when a case crashes
+    if process.returncode:
+        sys.stderr.write(process.stderr)
+        process.check_returncode()
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(name, result, baseline, tolerance):
+    """
+    Returns regressions of a case compared to its baseline
+
+    The best wall time of a case is compared to the median of its baseline runs, so that cases whose wall
+    time varies a lot between runs, e.g. with the load of the filesystem, don't fail on noise.
+    """
+    regressions = []
+    reference_time = baseline.get("wall_time_median", baseline["wall_time"])
+    if result["wall_time"] > max(reference_time * (1 + tolerance), baseline["wall_time"] + TIME_NOISE_FLOOR):
+        regressions.append("{}: wall time {:.3f}s, baseline {:.3f}s".format(
+            name, result["wall_time"], baseline["wall_time"]
+        ))
+    if sum(result["calls"].values()) > sum(baseline["calls"].values()):
+        regressions.append("{}: {} storage calls, baseline {}".format(
+            name, sum(result["calls"].values()), sum(baseline["calls"].values())
+        ))
+    if None not in (result["peak_rss_kb"], baseline["peak_rss_kb"]) and result["peak_rss_kb"] > max(
+        baseline["peak_rss_kb"] * (1 + tolerance), baseline["peak_rss_kb"] + RSS_NOISE_FLOOR_KB
+    ):
+        regressions.append("{}: peak RSS {} KB, baseline {} KB".format(
+            name, result["peak_rss_kb"], baseline["peak_rss_kb"]
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--case", action="append", choices=sorted(CASES), help="Case to run, may be repeated")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="Seconds each storage call takes")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each case, the best one is kept")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown against baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Store results as the new baseline")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        run_case(options.case[0], options)
+        return 0
+
+    try:
+        with open(BASELINE_PATH, encoding="utf8") as baseline_file:
+            baseline = json.load(baseline_file)
+    except OSError:
+        baseline = {}
+    if options.save_baseline or baseline.get("latency", options.latency) != options.latency:
+        compared = {}
+    else:
+        compared = baseline.get("cases", {})
+
+    results, regressions = {}, []
+    print("{:<32} {:>10} {:>10} {:>12} {:>10}".format("case", "time (s)", "baseline", "calls", "+RSS (MB)"))
+    for name in options.case or CASES:
+        results[name] = result = spawn_case(name, options)
+        reference = compared.get(name)
+        print("{:<32} {:>10.3f} {:>10} {:>12} {:>10}".format(
+            name, result["wall_time"], "{:.3f}".format(reference["wall_time"]) if reference else "-",
+            sum(result["calls"].values()),
+            "{:.1f}".format(result["peak_rss_kb"] / 1024) if result["peak_rss_kb"] is not None else "-",
+        ))
+        if reference:
+            regressions += compare(name, result, reference, options.tolerance)
+
+    if options.save_baseline:
+        baseline = {"latency": options.latency, "cases": {**baseline.get("cases", {}), **results}}
+        with open(BASELINE_PATH, "w", encoding="utf8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Baseline saved to {}".format(BASELINE_PATH))
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
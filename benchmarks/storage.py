@@ -0,0 +1,150 @@
+"""
+In-memory Django storage with injected latency and failures, standing in for cloud storages in benchmarks
+"""
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+
+LIST_PAGE_SIZE = 1000
+
+
+class StoredObject:
+    """
+    Object of the fake bucket, with the attributes of boto3 object summaries
+    """
+
+    def __init__(self, key, data):
+        self.key = key
+        self.size = len(data)
+        self.last_modified = datetime.now(timezone.utc)
+
+
+class FakeObjects:
+    """
+    Stand-in for boto3 bucket.objects, listing keys in pages of LIST_PAGE_SIZE
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def filter(self, **kwargs):
+        prefix = kwargs.get("Prefix", "")
+        keys = sorted(key for key in list(self.storage.files) if key.startswith(prefix))
+        for index in range(0, max(len(keys), 1), LIST_PAGE_SIZE):
+            self.storage.record("list_objects")
+            for key in keys[index:index + LIST_PAGE_SIZE]:
+                data = self.storage.files.get(key)
+                if data is not None:
+                    yield StoredObject(key, data)
+
+
+class FakeBucket:
+    """
+    Stand-in for a boto3 bucket, supporting prefix listings and batch deletes
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.objects = FakeObjects(storage)
+
+    def delete_objects(self, **kwargs):
+        self.storage.record("delete_objects")
+        errors = []
+        for item in kwargs["Delete"]["Objects"]:
+            if self.storage.should_fail():
+                errors.append({"Key": item["Key"], "Message": "Injected failure"})
+            else:
+                self.storage.files.pop(item["Key"], None)
+        return {"Errors": errors}
+
+
+class InMemoryStorage(Storage):
+    """
+    Storage keeping files in memory, each call sleeping for latency seconds
+
+    With batch_api set, the storage exposes a bucket like S3Boto3Storage does, so that listings and
+    deletions go through batch calls. A fail_rate share of saves and deletes raise, or are reported as
+    errors by batch deletes. Calls are counted by name in calls.
+    """
+
+    def __init__(self, latency=0.0, fail_rate=0.0, batch_api=True, seed=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.files = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        if batch_api:
+            self.bucket = FakeBucket(self)
+
+    def record(self, call):
+        with self._lock:
+            self.calls[call] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.fail_rate
+
+    def _normalize_name(self, name):
+        return name
+
+    def _open(self, name, mode="rb"):
+        self.record("open")
+        if name not in self.files:
+            raise FileNotFoundError(name)
+        return ContentFile(self.files[name], name=name)
+
+    def _save(self, name, content):
+        self.record("save")
+        if self.should_fail():
+            raise OSError("Injected failure saving {}".format(name))
+        content.seek(0)
+        self.files[name] = content.read()
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Like S3Boto3Storage with file_overwrite, existing files are overwritten
+        return name
+
+    def delete(self, name):
+        self.record("delete")
+        if self.should_fail():
+            raise OSError("Injected failure deleting {}".format(name))
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        self.record("exists")
+        prefix = name.rstrip("/") + "/"
+        return name in self.files or any(key.startswith(prefix) for key in list(self.files))
+
+    def listdir(self, path):
+        self.record("listdir")
+        prefix = path.rstrip("/") + "/" if path else ""
+        dirs, files = set(), []
+        for key in list(self.files):
+            if not key.startswith(prefix):
+                continue
+            name, _sep, rest = key[len(prefix):].partition("/")
+            if rest:
+                dirs.add(name)
+            else:
+                files.append(name)
+        return sorted(dirs), sorted(files)
+
+    def size(self, name):
+        self.record("size")
+        return len(self.files[name])
+
+    def url(self, name):
+        return "https://storage.example.com/{}".format(name)
+
+    def get_modified_time(self, name):
+        self.record("get_modified_time")
+        return datetime.now(timezone.utc)
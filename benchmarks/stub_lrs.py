@@ -0,0 +1,118 @@
+"""
+Stub LRS storing xAPI statements in memory, with injected latency and failures
+
+Usage:
+
+    python -m benchmarks.stub_lrs --port 8133 --latency 0.05 --fail-rate 0.1
+
+and point H5PXBLOCK_LRS_ENDPOINT to http://localhost:8133/xapi.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLRSHandler(BaseHTTPRequestHandler):
+    """
+    Handles the statements resource of the stub LRS
+    """
+
+    def do_POST(self):
+        lrs = self.server.lrs
+        lrs.record("post")
+        if lrs.latency:
+            time.sleep(lrs.latency)
+        if not self.path.endswith("/statements") or "X-Experience-API-Version" not in self.headers:
+            self.send_json(400, {"error": "Expected statements with an xAPI version header"})
+            return
+        if lrs.should_fail():
+            self.send_json(503, {"error": "Injected failure"})
+            return
+        statements = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if isinstance(statements, dict):
+            statements = [statements]
+        if any("actor" not in statement or "verb" not in statement for statement in statements):
+            self.send_json(400, {"error": "Statements need an actor and a verb"})
+            return
+        self.send_json(200, [lrs.store(statement) for statement in statements])
+
+    def do_GET(self):
+        with self.server.lrs.lock:
+            statements = list(self.server.lrs.statements.values())
+        self.send_json(200, {"statements": statements, "more": ""})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubLRS:
+    """
+    Stub LRS served from a background thread, keeping statements by id like an LRS does
+    """
+
+    def __init__(self, port=0, latency=0.0, fail_rate=0.0, seed=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.statements = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.server = ThreadingHTTPServer(("localhost", port), StubLRSHandler)
+        self.server.daemon_threads = True
+        self.server.lrs = self
+
+    @property
+    def endpoint(self):
+        return "http://localhost:{}/xapi".format(self.server.server_address[1])
+
+    def record(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+    def should_fail(self):
+        with self.lock:
+            return self._random.random() < self.fail_rate
+
+    def store(self, statement):
+        with self.lock:
+            statement_id = statement.get("id") or str(len(self.statements))
+            self.statements.setdefault(statement_id, statement)
+        return statement_id
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8133)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each request takes")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests failing with a 503")
+    options = parser.parse_args()
+    lrs = StubLRS(options.port, options.latency, options.fail_rate)
+    print("Stub LRS listening on {}".format(lrs.endpoint))
+    try:
+        lrs.server.serve_forever()
+    except KeyboardInterrupt:
+        print("{} statements received, {}".format(len(lrs.statements), dict(lrs.calls)))
+
+
+if __name__ == "__main__":
+    main()
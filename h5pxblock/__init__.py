@@ -1 +1,6 @@
-from .h5pxblock import H5PPlayerXBlock
+def __getattr__(name):
+    # The block is imported on first use, so that pool processes importing h5pxblock.workers don't load it
+    if name == "H5PPlayerXBlock":
+        from .h5pxblock import H5PPlayerXBlock
+        return H5PPlayerXBlock
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
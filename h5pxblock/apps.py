@@ -0,0 +1,14 @@
+"""
+Django app configuration for h5pxblock
+"""
+from django.apps import AppConfig
+
+
+class H5PXBlockConfig(AppConfig):
+    """
+    Registers h5pxblock as an Open edX plugin app so its celery tasks are discovered by workers.
+    """
+
+    name = "h5pxblock"
+    verbose_name = "H5P XBlock"
+    plugin_app = {}
@@ -1,14 +1,20 @@
 """XBlock to play H5P content in open edX."""
 
+import functools
 import json
 import logging
 import os
+import time
+import uuid
 
 from enum import Enum
 
 from datetime import datetime
+from importlib.metadata import PackageNotFoundError, version
 
 from django.conf import settings
+from django.template import Context, Engine, Template
+from django.template.backends.django import get_installed_libraries
 from django.utils import timezone
 from webob import Response
 from xblock.completable import CompletableXBlockMixin
@@ -27,8 +33,10 @@ from xblock.fields import (
 from web_fragments.fragment import Fragment
 try:
     from xblock.utils.resources import ResourceLoader
+    I18N_TEMPLATETAGS = "xblock.utils.templatetags.i18n"
 except ModuleNotFoundError:  # For backward compatibility with releases older than Quince.
     from xblockutils.resources import ResourceLoader
+    I18N_TEMPLATETAGS = "xblockutils.templatetags.i18n"
 try:
     # Older Open edX releases (Redwood and earlier) install a backported version of
     # importlib.resources: https://pypi.org/project/importlib-resources/
@@ -38,12 +46,43 @@ except ModuleNotFoundError:
     # https://docs.python.org/3/library/importlib.resources.html#module-importlib.resources
     from importlib import resources as importlib_resources
 
+from h5pxblock.metrics import increment, timed
+from h5pxblock.player import PLAYER_DIR, get_player_cdn_urls, load_player_manifest
+from h5pxblock.tasks import start_package_processing
 from h5pxblock.utils import (
+    AGGREGATED_ASSETS_DIR,
+    ASYNC_PROCESSING,
+    CONTENT_VERSION_GRACE_PERIOD,
+    CONTENT_VERSIONS_DIR,
+    PACKAGE_UPLOADS_DIR,
+    SHARED_LIBRARIES,
+    SHARED_LIBRARIES_DIR,
+    UPLOAD_CHUNK_SIZE,
+    USER_STATE_MAX_SIZE,
+    VERSIONED_CONTENT,
+    PackagePhase,
+    PackageProgress,
+    PackageRejected,
+    assemble_upload,
     get_h5p_storage,
+    decode_user_state,
+    delete_content_version_cloud,
+    delete_content_version_local,
+    encode_user_state,
+    get_manifest_summary,
+    get_package_version,
+    get_upload_chunks,
+    get_upload_storage,
+    hash_user_state,
+    load_manifest_cloud,
+    load_manifest_local,
+    preflight_package,
+    save_upload_chunk,
     str2bool,
     unpack_and_upload_on_cloud,
     unpack_package_local_path,
 )
+from h5pxblock.xapi import LRS_ENABLED, MAX_REQUEST_STATEMENTS, enqueue_statements, prepare_statement
 
 # Make '_' a no-op so we can scrape strings
 _ = lambda text: text
@@ -53,8 +92,53 @@ loader = ResourceLoader(__name__)
 
 H5P_ROOT = os.path.join(settings.MEDIA_ROOT, "h5pxblockmedia")
 H5P_URL = os.path.join(settings.MEDIA_URL, "h5pxblockmedia")
+H5P_SHARED_LIBRARIES_ROOT = os.path.join(H5P_ROOT, SHARED_LIBRARIES_DIR)
+H5P_SHARED_LIBRARIES_URL = "{}/{}".format(H5P_URL, SHARED_LIBRARIES_DIR)
+H5P_SHARED_LIBRARIES_CLOUD_PATH = os.path.join("h5pxblockmedia", SHARED_LIBRARIES_DIR)
 
 H5P_STORAGE = get_h5p_storage()
+UPLOAD_STORAGE = get_upload_storage()
+PLAYER_CDN_URL = getattr(settings, "H5PXBLOCK_PLAYER_CDN_URL", None)
+INIT_CONCURRENCY = getattr(settings, "H5PXBLOCK_INIT_CONCURRENCY", 1)
+INIT_ROOT_MARGIN = getattr(settings, "H5PXBLOCK_INIT_ROOT_MARGIN", "200px")
+
+try:
+    PACKAGE_VERSION = version("h5p-xblock")
+except PackageNotFoundError:
+    PACKAGE_VERSION = None
+
+
+@functools.lru_cache(maxsize=None)
+def load_resource(path, package_version=PACKAGE_VERSION):
+    """
+    Returns decoded content of a package resource, read once per process and package version
+    """
+    try:
+        data = importlib_resources.files(__name__).joinpath(path).read_bytes()
+    except TypeError:
+        data = importlib_resources.files(__package__).joinpath(path).read_bytes()
+    return data.decode("utf8")
+
+
+@functools.lru_cache(maxsize=None)
+def load_template(template_path, package_version=PACKAGE_VERSION):
+    """
+    Returns compiled django template of a package resource, compiled once per process and package version
+    """
+    libraries = get_installed_libraries()
+    libraries["i18n"] = I18N_TEMPLATETAGS
+    return Template(loader.load_unicode(template_path), engine=Engine(libraries=libraries))
+
+
+@functools.lru_cache(maxsize=None)
+def load_player_manifest_cached(package_version=PACKAGE_VERSION):
+    """
+    Returns manifest of the vendored player, read once per process and package version
+    """
+    manifest = load_player_manifest()
+    if manifest is None and not PLAYER_CDN_URL:
+        log.warning("h5p-standalone player is not vendored, it is loaded from %s", get_player_cdn_urls()["main"])
+    return manifest
 
 
 class SubmissionStatus(Enum):
@@ -91,6 +175,12 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         scope=Scope.settings,
     )
 
+    h5p_libraries_path = String(
+        help=_("Path of the shared library store H5P libraries are loaded from, if any"),
+        default=None,
+        scope=Scope.settings,
+    )
+
     show_frame = Boolean(
         display_name=_("Show H5P player frame"),
         help=_("whether to show H5P player frame and button"),
@@ -144,6 +234,12 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         scope=Scope.user_state
     )
 
+    interaction_data_hash = String(
+        help=_("Hash of user previous content interaction states"),
+        default=None,
+        scope=Scope.user_state
+    )
+
     weight = Float(
         display_name=_("Problem Weight"),
         help=_(
@@ -179,15 +275,29 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         scope=Scope.user_state,
     )
 
+    grade_published = Boolean(
+        help=_("Whether a grade of the learner was published"),
+        default=False,
+        scope=Scope.user_state,
+    )
+
     h5p_content_meta = Dict(scope=Scope.content)
 
+    h5p_package_job_id = String(
+        help=_("Id of the background job processing the last uploaded package"),
+        default=None,
+        scope=Scope.settings,
+    )
+
+    h5p_content_version = String(
+        help=_("Version of the package content served to learners"),
+        default=None,
+        scope=Scope.settings,
+    )
+
     def resource_string(self, path):
         """Handy helper for getting resources from our kit."""
-        try:
-            data = importlib_resources.files(__name__).joinpath(path).read_bytes()
-        except TypeError:
-            data = importlib_resources.files(__package__).joinpath(path).read_bytes()
-        return data.decode("utf8")
+        return load_resource(path)
 
     def render_template(self, template_path, context):
         """
@@ -201,11 +311,8 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         Returns:
             str: The rendered template
         """
-        return loader.render_django_template(
-            template_path,
-            context,
-            i18n_service=self.runtime.service(self, 'i18n'),
-        )
+        context = dict(context, _i18n_service=self.runtime.service(self, 'i18n'))
+        return load_template(template_path).render(Context(context))
 
     def max_score(self):
         return self.points
@@ -238,6 +345,247 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
             'h5pxblockmedia', self.get_block_path_prefix
         )
 
+    @property
+    def content_storage_path(self):
+        return self.local_storage_path if self.store_content_on_local_fs else self.cloud_storage_path
+
+    @property
+    def content_url(self):
+        if self.store_content_on_local_fs:
+            return self.h5p_content_url
+        return H5P_STORAGE.url(self.cloud_storage_path)
+
+    def get_content_version_path(self, version):
+        """
+        Returns storage path of a content version, content of unversioned packages living at the root
+        """
+        if not version:
+            return self.content_storage_path
+        return os.path.join(self.content_storage_path, CONTENT_VERSIONS_DIR, version)
+
+    def get_content_version_url(self, version):
+        """
+        Returns url of a content version
+        """
+        if not version:
+            return self.content_url
+        if self.store_content_on_local_fs:
+            return "{}/{}/{}".format(self.h5p_content_url, CONTENT_VERSIONS_DIR, version)
+        return H5P_STORAGE.url(self.get_content_version_path(version))
+
+    def retire_content_version(self):
+        """
+        Records the served content version as replaced, so that it is deleted once the grace period is over
+
+        Content unpacked at the root before versioning was enabled is retired as the empty version.
+        """
+        previous_versions = list(self.h5p_content_meta.get("previous_versions", []))
+        if self.h5p_content_version:
+            previous_versions.append({"version": self.h5p_content_version, "replaced_at": time.time()})
+        elif self.h5p_content_json_path == self.content_url:
+            previous_versions.append({"version": "", "replaced_at": time.time()})
+        self.h5p_content_version = None
+        self.h5p_content_meta = dict(self.h5p_content_meta, previous_versions=previous_versions)
+
+    def get_published_content_version(self):
+        """
+        Returns the content version served by the published block, "" for content unpacked at the root
+
+        Returns None if the block isn't published, or outside of edx-platform where blocks aren't published.
+        """
+        try:
+            # Only available within edx-platform
+            from xmodule.modulestore import ModuleStoreEnum
+            from xmodule.modulestore.django import modulestore
+            from xmodule.modulestore.exceptions import ItemNotFoundError
+        except ModuleNotFoundError:
+            return None
+        store = modulestore()
+        try:
+            with store.branch_setting(ModuleStoreEnum.Branch.published_only, self.location.course_key):
+                published = store.get_item(self.location)
+        except ItemNotFoundError:
+            return None
+        if published.h5p_content_version:
+            return published.h5p_content_version
+        return "" if published.h5p_content_json_path == published.content_url else None
+
+    def cleanup_content_versions(self):
+        """
+        Deletes replaced content versions older than the grace period
+
+        Learners who loaded the page before a switch keep fetching the version they started with until then.
+        The version served by the published block is never deleted, as the draft block is switched to new
+        versions before they are published. It is kept with its grace period restarted, so that it is
+        deleted once it was replaced on the published block for that long.
+        """
+        try:
+            published_version = self.get_published_content_version()
+        except BaseException as exp:
+            log.error("Unable to get the published h5p content version, versions are kept: %s", exp)
+            return
+        expired_before = time.time() - CONTENT_VERSION_GRACE_PERIOD
+        previous_versions = []
+        for previous in self.h5p_content_meta.get("previous_versions", []):
+            if previous["version"] == (self.h5p_content_version or ""):
+                continue
+            if previous["version"] == published_version:
+                previous_versions.append(dict(previous, replaced_at=time.time()))
+                continue
+            if previous["replaced_at"] > expired_before:
+                previous_versions.append(previous)
+                continue
+            log.info("Deleting h5p content version %r of %s", previous["version"], self.get_block_path_prefix)
+            try:
+                if self.store_content_on_local_fs:
+                    delete_content_version_local(self.content_storage_path, previous["version"])
+                else:
+                    delete_content_version_cloud(H5P_STORAGE, self.content_storage_path, previous["version"])
+            except BaseException as exp:
+                log.error("Unable to delete h5p content version %r: %s", previous["version"], exp)
+                previous_versions.append(previous)
+        self.h5p_content_meta = dict(self.h5p_content_meta, previous_versions=previous_versions)
+
+    def switch_content_version(self, version, cleanup=True):
+        """
+        Points the block to an unpacked content version in one step and retires the one served before
+
+        Content of unversioned packages, unpacked at the root, is switched to as the empty version.
+        Expired versions are deleted unless cleanup is unset.
+        """
+        self.retire_content_version()
+        self.h5p_content_version = version
+        self.h5p_content_json_path = self.get_content_version_url(version)
+        if cleanup:
+            self.cleanup_content_versions()
+
+    @property
+    def shared_libraries_path(self):
+        if not SHARED_LIBRARIES:
+            return None
+        if self.store_content_on_local_fs:
+            return H5P_SHARED_LIBRARIES_ROOT
+        return H5P_SHARED_LIBRARIES_CLOUD_PATH
+
+    def get_libraries_url(self, libraries_shared):
+        """
+        Returns url of the library set of the package in the shared library store, if its libraries are served from it
+
+        Libraries shared before library sets, recorded as True, are served from the root of the store.
+        """
+        if not libraries_shared:
+            return None
+        if self.store_content_on_local_fs:
+            if libraries_shared is True:
+                return H5P_SHARED_LIBRARIES_URL
+            return "{}/{}".format(H5P_SHARED_LIBRARIES_URL, libraries_shared)
+        if libraries_shared is True:
+            return H5P_STORAGE.url(H5P_SHARED_LIBRARIES_CLOUD_PATH)
+        return H5P_STORAGE.url(os.path.join(H5P_SHARED_LIBRARIES_CLOUD_PATH, libraries_shared))
+
+    def apply_package_summary(self, summary):
+        """
+        Records outcome of unpacking a package, as returned by get_manifest_summary, on the block
+        """
+        summary = dict(summary or {})
+        summary.setdefault("aggregated_assets", False)
+        self.h5p_libraries_path = self.get_libraries_url(summary.pop("libraries_shared", False))
+        self.h5p_content_meta = dict(self.h5p_content_meta, **summary)
+
+    def apply_package_result(self, summary, version=None, meta_data=None, cleanup=True):
+        """
+        Records outcome of unpacking a package, along with its meta data, and switches to its content
+
+        A package that was rejected or failed to unpack leaves the block untouched, the previous content
+        being served instead.
+        """
+        if not summary:
+            log.error("Package %s of %s failed to unpack", (meta_data or {}).get("name"), self.get_block_path_prefix)
+            return
+        self.h5p_content_meta = dict(self.h5p_content_meta, **(meta_data or {}))
+        self.apply_package_summary(summary)
+        self.switch_content_version(version, cleanup)
+
+    def get_package_job_status(self, read_manifest=True):
+        """
+        Returns status of the pending background job of the block once it is finished, None otherwise
+
+        The status is read from the progress kept in cache, or, when read_manifest is set, from the manifest
+        the job saved with the content it unpacked when the progress expired or isn't shared with the worker.
+        """
+        status = PackageProgress.get_status(self.h5p_package_job_id)
+        if status is not None:
+            finished = status["phase"] in (PackagePhase.DONE.value, PackagePhase.FAILED.value)
+            return status if finished else None
+        if not read_manifest:
+            return None
+        path = self.get_content_version_path(self.h5p_content_meta.get("pending_version"))
+        if self.store_content_on_local_fs:
+            manifest = load_manifest_local(path)
+        else:
+            manifest = load_manifest_cloud(H5P_STORAGE, path)
+        if manifest and manifest.get("job_id") == self.h5p_package_job_id:
+            return {"phase": PackagePhase.DONE.value, "result": get_manifest_summary(manifest)}
+        return None
+
+    def apply_package_job(self, cleanup=True, read_manifest=True):
+        """
+        Applies outcome of the pending background job of the block once it is finished
+
+        Called by the views and handlers, so that the outcome is applied whether or not Studio polled
+        package_status until the job finished. Returns whether the pending job was resolved.
+        """
+        if not self.h5p_package_job_id:
+            return False
+        status = self.get_package_job_status(read_manifest)
+        if status is None:
+            return False
+        version = self.h5p_content_meta.get("pending_version")
+        meta_data = self.h5p_content_meta.get("pending_package")
+        self.h5p_package_job_id = None
+        self.h5p_content_meta = {
+            key: value for key, value in self.h5p_content_meta.items()
+            if key not in ("pending_version", "pending_package")
+        }
+        # Unversioned content was unpacked in place, so that its outcome is applied even if the job failed
+        if status["phase"] == PackagePhase.DONE.value or not version:
+            self.apply_package_result(status["result"], version, meta_data, cleanup)
+        return True
+
+    def get_player_paths(self):
+        """
+        Returns paths the player loads content and libraries from
+
+        Packages with aggregated assets are loaded through their bundle, whose main library
+        preloads all JS and CSS of the package in two files.
+        """
+        if self.h5p_content_json_path and self.h5p_content_meta.get("aggregated_assets"):
+            bundle_path = "{}/{}".format(self.h5p_content_json_path, AGGREGATED_ASSETS_DIR)
+            return {
+                "h5pJsonPath": bundle_path,
+                "contentJsonPath": "{}/content".format(self.h5p_content_json_path),
+                "librariesPath": bundle_path,
+            }
+        return {
+            "h5pJsonPath": self.h5p_content_json_path,
+            "librariesPath": self.h5p_libraries_path,
+        }
+
+    def get_player_assets(self):
+        """
+        Returns URLs of the h5p-standalone player files
+
+        The vendored player is served with the block resources, unless H5PXBLOCK_PLAYER_CDN_URL is set or
+        the configured player version isn't vendored, in which case it is loaded from a CDN.
+        """
+        manifest = load_player_manifest_cached()
+        if PLAYER_CDN_URL or manifest is None:
+            return get_player_cdn_urls(PLAYER_CDN_URL)
+        return {
+            asset: self.runtime.local_resource_url(self, "{}/{}".format(PLAYER_DIR, file_name))
+            for asset, file_name in manifest["files"].items()
+        }
+
     def get_context_studio(self):
         return {
             "field_display_name": self.fields["display_name"],
@@ -254,34 +602,44 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         }
 
     def studio_view(self, context=None):
+        if self.apply_package_job():
+            self.save()
         context = self.get_context_studio()
         template = self.render_template("static/html/studio.html", context)
         frag = Fragment(template)
         frag.add_css(self.resource_string("static/css/studio.css"))
-        frag.add_javascript(self.resource_string("static/js/src/installRequired.js"))
         frag.add_javascript(self.resource_string("static/js/src/studio.js"))
         frag.initialize_js(
             "H5PStudioXBlock",
             json_args={
                 "uploading_txt": self.ugettext("Uploading"),
                 "uploaded_txt": self.ugettext("Uploaded"),
-                "extracting_txt": self.ugettext("Extracting")
+                "extracting_txt": self.ugettext("Extracting"),
+                "validating_txt": self.ugettext("Validating"),
+                "deleting_txt": self.ugettext("Deleting previous content"),
+                "failed_txt": self.ugettext("Processing failed"),
+                "upload_chunk_size": UPLOAD_CHUNK_SIZE,
             }
         )
         return frag
 
+    @timed("view.student_view")
     def student_view(self, context=None):
         """
         The primary view of the H5PPlayerXBlock, shown to students
         when viewing courses.
+
+        The outcome of a finished background job still in cache is applied for this view only, as content
+        and settings are read-only in the LMS, and expired content versions are left to Studio to delete.
+        Manifests aren't read from storage on every view: the job saves its outcome to the block itself.
         """
+        self.apply_package_job(cleanup=False, read_manifest=False)
         context = {
             "h5pblock": self,
         }
         template = self.render_template("static/html/h5pxblock.html", context)
         frag = Fragment(template)
         frag.add_css(self.resource_string("static/css/student_view.css"))
-        frag.add_javascript(self.resource_string("static/js/src/installRequired.js"))
         frag.add_javascript(self.resource_string("static/js/src/h5pxblock.js"))
         user_service = self.runtime.service(self, 'user')
         user = user_service.get_current_user()
@@ -297,30 +655,144 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
                 "saveFreq": save_freq,
                 "user_full_name": user.full_name,
                 "user_email": user.emails[0],
-                "userData": self.interaction_data,
+                "hasUserData": self.interaction_data is not None,
+                "xapiForwarding": LRS_ENABLED,
+                "xapiBatchSize": MAX_REQUEST_STATEMENTS,
                 "customJsPath": self.runtime.local_resource_url(self, "public/js/h5pcustom.js"),
-                "h5pJsonPath": self.h5p_content_json_path
+                "playerAssets": self.get_player_assets(),
+                "initConcurrency": INIT_CONCURRENCY,
+                "initRootMargin": INIT_ROOT_MARGIN,
+                **self.get_player_paths(),
             }
         )
         return frag
 
     @XBlock.handler
+    @timed("handler.user_interaction_data")
     def user_interaction_data(self, request, suffix=''):
         """
         Handles to retrieve and save user interactions with h5p content
+
+        GET returns the stored state with an ETag so that unchanged state is not downloaded again.
+        On POST, state identical to the stored one is not written again, and the response tells whether it was.
         """
-        success = False
+        if request.method == "GET":
+            return self.get_user_state_response(request)
+
+        success, saved = False, False
         if request.method == "POST":
             try:
-                self.interaction_data = request.POST['data']
+                data = request.POST['data']
+                if len(data) > USER_STATE_MAX_SIZE:
+                    log.warning("Learner interaction data of %s characters exceeds size limit", len(data))
+                    return Response(json.dumps({"success": False, "saved": False, "error": "State is too large"}))
+
+                data_hash = hash_user_state(data)
+                if data_hash != (self.interaction_data_hash or hash_user_state(self.user_state)):
+                    self.interaction_data = encode_user_state(data)
+                    self.interaction_data_hash = data_hash
+                    saved = True
+                    increment("learner_state.bytes", len(data))
                 success = True
             except BaseException as exp:
                 log.error("Error while saving learner interaction data: %s", exp)
 
-        return Response(json.dumps({"success": success}))
+        return Response(json.dumps({"success": success, "saved": saved}))
+
+    def get_user_state_response(self, request):
+        """
+        Returns learner interaction data, or a 304 response if the client already has it
+        """
+        etag = self.interaction_data_hash or hash_user_state(self.user_state) or "empty"
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(
+                json.dumps({"success": True, "data": self.user_state}),
+                content_type="application/json",
+                charset="utf8",
+            )
+        response.etag = etag
+        response.cache_control = "private, no-cache"
+        return response
+
+    @property
+    def user_state(self):
+        """
+        Returns learner interaction data, decompressed
+        """
+        return decode_user_state(self.interaction_data)
+
+    def import_package(self, h5p_package, asynchronous=ASYNC_PROCESSING, force=False):
+        """
+        Unpacks a package as the content of the block
+
+        The package is checked once by preflight_package, raising PackageRejected if it doesn't pass.
+        A package whose content version is already served is skipped, unless force is set, in which case it is
+        unpacked again into a fresh version, as learners keep loading the served one until the switch.
+        Returns id of the background job processing the package when it is processed asynchronously.
+        """
+        h5p_zip, report = preflight_package(h5p_package)
+        if h5p_zip is None:
+            raise PackageRejected(report.errors)
+        meta_data = {
+            "name": h5p_package.name,
+            "upload_time": timezone.now().strftime(DateTime.DATETIME_FORMAT),
+            "size": h5p_package.size,
+        }
+        version = get_package_version(report) if VERSIONED_CONTENT else None
+        # Versions unpacked again are suffixed to get a fresh prefix
+        served = bool(version) and (self.h5p_content_version or "").split("-")[0] == version
+        if served and force:
+            version = "{}-{}".format(version, uuid.uuid4().hex[:8])
+        content_path = self.get_content_version_path(version)
+        job_id = None
+        if served and not force:
+            h5p_zip.close()
+            log.info("Content version %s of %s is already served", version, self.get_block_path_prefix)
+        elif asynchronous:
+            # The worker checks the package again, as it reads it back from storage
+            h5p_zip.close()
+            h5p_package.seek(0)
+            job_id = uuid.uuid4().hex
+            package_name = H5P_STORAGE.save(
+                os.path.join(PACKAGE_UPLOADS_DIR, "{}.h5p".format(job_id)), h5p_package
+            )
+            self.h5p_package_job_id = job_id
+            self.h5p_content_meta = dict(self.h5p_content_meta, pending_version=version, pending_package=meta_data)
+            start_package_processing(
+                job_id=job_id,
+                package_name=package_name,
+                content_path=content_path,
+                local=self.store_content_on_local_fs,
+                shared_libraries_path=self.shared_libraries_path,
+                immutable=bool(version),
+                usage_id=str(self.scope_ids.usage_id),
+            )
+        else:
+            # Finishing the progress reports metrics of the last phase
+            progress = PackageProgress()
+            if self.store_content_on_local_fs:
+                manifest = unpack_package_local_path(
+                    h5p_package, content_path, self.shared_libraries_path, progress=progress,
+                    preflight=(h5p_zip, report),
+                )
+            else:
+                manifest = unpack_and_upload_on_cloud(
+                    h5p_package, H5P_STORAGE, content_path, self.shared_libraries_path,
+                    progress=progress, immutable=bool(version), preflight=(h5p_zip, report),
+                )
+            summary = manifest and get_manifest_summary(manifest)
+            progress.finish(**(summary or {}))
+            self.apply_package_result(summary, version, meta_data)
+        return job_id
 
     @XBlock.handler
+    @timed("handler.studio_submit")
     def studio_submit(self, request, suffix=""):
+        if not self.user_can_upload:
+            return self.forbidden_response()
+        self.apply_package_job()
         self.display_name = request.params["display_name"]
         self.show_frame = str2bool(request.params["show_frame"])
         self.show_copyright = str2bool(request.params["show_copyright"])
@@ -332,33 +804,113 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         points = request.params["points"]
         weight = request.params["weight"]
         self.points, self.weight = self.validate_score(points, weight)
+        response = {"result": "success"}
 
-        if hasattr(request.params["h5p_content_bundle"], "file"):
+        h5p_package = None
+        if hasattr(request.params.get("h5p_content_bundle"), "file"):
             h5p_package = request.params["h5p_content_bundle"].file
+        elif request.params.get("upload_id"):
+            # Package sent by chunks through upload_chunk
+            try:
+                h5p_package = assemble_upload(
+                    UPLOAD_STORAGE,
+                    request.params["upload_id"],
+                    int(request.params["upload_chunks"]),
+                    request.params["upload_name"],
+                )
+            except (KeyError, ValueError) as exp:
+                return Response(
+                    json.dumps({"result": "error", "message": str(exp)}),
+                    status=400,
+                    content_type="application/json",
+                    charset="utf8",
+                )
 
-            meta_data = {
-                "name": h5p_package.name,
-                "upload_time": timezone.now().strftime(DateTime.DATETIME_FORMAT),
-                "size": h5p_package.size,
-            }
-            self.h5p_content_meta = meta_data
-            if self.store_content_on_local_fs:
-                unpack_package_local_path(h5p_package, self.local_storage_path)
-                self.h5p_content_json_path = self.h5p_content_url
-            else:
-                unpack_and_upload_on_cloud(
-                    h5p_package, H5P_STORAGE, self.cloud_storage_path
+        if h5p_package is not None:
+            try:
+                job_id = self.import_package(h5p_package)
+            except PackageRejected as exp:
+                return Response(
+                    json.dumps({"result": "error", "message": str(exp), "errors": exp.errors}),
+                    status=400,
+                    content_type="application/json",
+                    charset="utf8",
                 )
-                self.h5p_content_json_path = H5P_STORAGE.url(self.cloud_storage_path)
+            finally:
+                h5p_package.close()
+            if job_id:
+                response["job_id"] = job_id
         elif request.params["h5_content_path"]:
+            if request.params["h5_content_path"] != self.h5p_content_json_path:
+                # Content reused from another path brings its own libraries and assets
+                self.apply_package_summary(None)
+                if VERSIONED_CONTENT:
+                    self.retire_content_version()
             self.h5p_content_json_path = request.params["h5_content_path"]
 
+        return Response(
+            json.dumps(response),
+            content_type="application/json",
+            charset="utf8",
+        )
+
+    @XBlock.handler
+    def upload_chunk(self, request, suffix=""):
+        """
+        Handler to receive a package in chunks, sent in any order and possibly in parallel
+
+        Chunks are kept on the local filesystem under their upload id until studio_submit assembles them.
+        """
+        if not self.user_can_upload:
+            return self.forbidden_response()
+        try:
+            save_upload_chunk(
+                UPLOAD_STORAGE,
+                request.params["upload_id"],
+                int(request.params["index"]),
+                request.params["chunk"].file,
+            )
+        except (AttributeError, KeyError, ValueError) as exp:
+            return Response(
+                json.dumps({"result": "error", "message": str(exp)}),
+                status=400,
+                content_type="application/json",
+                charset="utf8",
+            )
         return Response(
             json.dumps({"result": "success"}),
             content_type="application/json",
             charset="utf8",
         )
 
+    @XBlock.json_handler
+    def upload_status(self, data, suffix=''):
+        """
+        Handler to list chunks already received for an upload, so that an interrupted upload can resume
+        """
+        if not self.user_can_upload:
+            raise JsonHandlerError(403, "Only course staff can upload H5P content")
+        try:
+            return {"chunks": get_upload_chunks(UPLOAD_STORAGE, data.get("upload_id"))}
+        except ValueError as exp:
+            raise JsonHandlerError(400, str(exp)) from exp
+
+    @XBlock.json_handler
+    def package_status(self, data, suffix=''):
+        """
+        Handler to report progress of a package processed in background
+
+        Once the block's pending job is finished, its outcome is applied to the block.
+        """
+        job_id = data.get("job_id")
+        status = PackageProgress.get_status(job_id)
+        if status is None:
+            raise JsonHandlerError(404, "Unknown package processing job")
+
+        if job_id == self.h5p_package_job_id:
+            self.apply_package_job()
+        return status
+
     @staticmethod
     def validate_score(points: int, weight: int) -> None:
         """
@@ -389,17 +941,27 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
         return points, weight
 
     @XBlock.json_handler
+    @timed("handler.result_handler")
     def result_handler(self, data, suffix=''):
         """
         Handler to injest results when h5p content triggers completion or rescorable events
+
+        Accepts a single xAPI statement or a batch as {"statements": [...]}. Completion is only emitted
+        once, and at most one grade is published per batch: for the first scored attempt, or when the best
+        score of the batch improves on the learner's score. Content completed without a score, e.g. consumed,
+        still gets its grade published by the first scored attempt.
         """
-        save_completion, save_score = False, False
-        try:
-            self.emit_completion(1.0)
-            save_completion = True
-            self.submission_status = SubmissionStatus.COMPLETED.value
-        except BaseException as exp:
-            log.error("Error while marking completion %s", exp)
+        statements = data.get("statements", [data])
+        increment("xapi.statements", len(statements))
+        already_completed = self.submission_status == SubmissionStatus.COMPLETED.value
+        save_completion, save_score = already_completed, False
+        if not already_completed:
+            try:
+                self.emit_completion(1.0)
+                save_completion = True
+                self.submission_status = SubmissionStatus.COMPLETED.value
+            except BaseException as exp:
+                log.error("Error while marking completion %s", exp)
 
         if self.is_past_due:
             return Response(
@@ -408,26 +970,15 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
                 charset="utf8",
             )
 
-        if self.has_score and data['result'] and data['result']['score']:
-            raw_score = data['result']['score']['raw']
-            max_score = data['result']['score']['max']
-            score = 0
-            if max_score:
-                score = raw_score/max_score * self.points
-            grade_dict = {
-                'value': score,
-                'max_value': self.points,
-                'only_if_higher': True,
-            }
-            try:
-                self.runtime.publish(self, 'grade', grade_dict)
-                save_score = True
-            except TypeError:
-                grade_dict["only_if_higher"] = False
-                self.runtime.publish(self, 'grade', grade_dict)
+        scores = [self.get_statement_score(statement) for statement in statements]
+        scores = [score for score in scores if score is not None]
+        if self.has_score and scores:
+            score = max(scores)
+            if self.grade_published and score <= self.weighted_score:
                 save_score = True
-            except BaseException as exp:
-                log.error("Error while publishing score %s", exp)
+            else:
+                save_score = self.publish_grade(score)
+                self.grade_published = self.grade_published or save_score
 
             if save_score and score > self.weighted_score:
                 self.weighted_score = score
@@ -438,6 +989,84 @@ class H5PPlayerXBlock(XBlock, CompletableXBlockMixin):
             charset="utf8",
         )
 
+    @XBlock.json_handler
+    @timed("handler.xapi_statements")
+    def xapi_statements(self, data, suffix=''):
+        """
+        Handler to forward xAPI statements of the content to the LRS set in H5PXBLOCK_LRS_ENDPOINT
+
+        Accepts a batch as {"statements": [...]}, attributed to the current user. Statements are queued
+        and sent by a background worker, so that the LRS doesn't slow down learner requests.
+        """
+        if not LRS_ENABLED:
+            raise JsonHandlerError(404, "xAPI forwarding is not enabled")
+        statements = data.get("statements")
+        if not isinstance(statements, list) or not all(isinstance(statement, dict) for statement in statements):
+            raise JsonHandlerError(400, "Expected a list of statements")
+        if len(statements) > MAX_REQUEST_STATEMENTS:
+            raise JsonHandlerError(400, "At most {} statements are accepted at once".format(MAX_REQUEST_STATEMENTS))
+
+        user = self.runtime.service(self, 'user').get_current_user()
+        actor = {"objectType": "Agent", "name": user.full_name, "mbox": "mailto:{}".format(user.emails[0])}
+        enqueue_statements([prepare_statement(statement, actor) for statement in statements])
+        return {"queued": len(statements)}
+
+    def get_statement_score(self, statement):
+        """
+        Returns score of an xAPI statement scaled to the block points, or None if it isn't scored
+        """
+        result = statement.get("result") or {}
+        if not result.get("score"):
+            return None
+        max_score = result["score"].get("max")
+        if not max_score:
+            return 0
+        return result["score"]["raw"] / max_score * self.points
+
+    def publish_grade(self, score):
+        """
+        Publishes grade of the learner and returns whether it was saved
+        """
+        grade_dict = {
+            'value': score,
+            'max_value': self.points,
+            'only_if_higher': True,
+        }
+        try:
+            self.runtime.publish(self, 'grade', grade_dict)
+            return True
+        except TypeError:
+            grade_dict["only_if_higher"] = False
+            self.runtime.publish(self, 'grade', grade_dict)
+            return True
+        except BaseException as exp:
+            log.error("Error while publishing score %s", exp)
+        return False
+
+    @property
+    def user_can_upload(self):
+        """
+        Return True if the current user may upload packages, being staff of the course or an author in Studio.
+
+        Upload handlers can also be called through the LMS handler url, where learners must not write to storage.
+        """
+        # The workbench has no course roles
+        if 'Workbench' in self.runtime.__class__.__name__ or getattr(self.runtime, "user_is_staff", False):
+            return True
+        user = self.runtime.service(self, 'user').get_current_user()
+        opt_attrs = getattr(user, "opt_attrs", None) or {}
+        return bool(opt_attrs.get("edx-platform.user_is_staff")) or (
+            opt_attrs.get("edx-platform.user_role") in ("staff", "instructor")
+        )
+
+    def forbidden_response(self):
+        return Response(
+            json.dumps({"result": "error", "message": "Only course staff can upload H5P content"}),
+            status=403,
+            content_type="application/json",
+            charset="utf8",
+        )
+
     @property
     def is_past_due(self):
         """
@@ -0,0 +1,214 @@
+"""
+Management command to delete H5P content no longer referenced by any h5pxblock block, expired content versions
+and abandoned uploads
+
+Examples:
+
+    ./manage.py cms gc_h5p_content --dry-run
+    ./manage.py cms gc_h5p_content --min-age-days 30 --max-deletes-per-second 200
+    ./manage.py cms gc_h5p_content --upload-max-age-hours 6
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from urllib.parse import unquote
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+
+from h5pxblock.h5pxblock import H5P_STORAGE, UPLOAD_STORAGE
+from h5pxblock.utils import (
+    CHUNKED_UPLOADS_DIR,
+    CONTENT_VERSION_GRACE_PERIOD,
+    CONTENT_VERSIONS_DIR,
+    PACKAGE_UPLOADS_DIR,
+    S3_DELETE_BATCH_SIZE,
+    SHARED_LIBRARIES_DIR,
+    delete_path,
+    delete_storage_files,
+    delete_upload,
+    list_file_details_cloud,
+)
+
+log = logging.getLogger(__name__)
+
+CONTENT_ROOT = "h5pxblockmedia"
+
+
+class Command(BaseCommand):
+    """
+    Deletes content trees under h5pxblockmedia whose block is gone and no other block uses
+
+    Content of each block lives under h5pxblockmedia/<org>/<course>/<block_id>. A tree is kept if a
+    block with that path exists on the draft or published branch of any course or library, or if a
+    block plays content from it. Trees modified within the minimum age window are always kept, so that
+    content of blocks being created while the command runs is never deleted.
+
+    Within trees that are kept, content versions no block serves or is unpacking are deleted once they were
+    retired for the grace period, as blocks only delete them when a new package is uploaded. Versions whose
+    retirement isn't recorded, e.g. being unpacked before their block is saved, follow the minimum age window.
+
+    Chunks of uploads which were never saved, and stored packages whose background job never ran, are
+    deleted once they are older than the maximum upload age.
+    """
+
+    help = "Delete H5P content of deleted h5pxblock blocks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age-days", type=float, default=7,
+            help="Only delete trees whose files were all last modified at least this many days ago",
+        )
+        parser.add_argument(
+            "--max-deletes-per-second", type=float, default=500,
+            help="Maximum number of files deleted per second, 0 for no limit",
+        )
+        parser.add_argument(
+            "--upload-max-age-hours", type=float, default=24,
+            help="Delete chunked uploads and packages waiting for processing left for longer than this",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Report content to delete without deleting it")
+
+    def handle(self, *args, **options):
+        self.delete_expired_uploads(options["upload_max_age_hours"], options["dry_run"])
+
+        referenced, retired = self.get_referenced_trees()
+        self.stdout.write("{} content trees are referenced by blocks".format(len(referenced)))
+
+        trees = {}
+        versions = {}
+        for file_path, size, modified in list_file_details_cloud(H5P_STORAGE, CONTENT_ROOT):
+            parts = os.path.relpath(file_path, CONTENT_ROOT).split(os.sep)
+            if len(parts) < 4 or parts[0] == SHARED_LIBRARIES_DIR:
+                continue
+            # Naive times, returned by storages when USE_TZ is off, are in local time as timestamp() expects
+            modified = modified.timestamp()
+            prefixes = [(trees, "/".join(parts[:3]))]
+            if len(parts) > 5 and parts[3] == CONTENT_VERSIONS_DIR:
+                prefixes.append((versions, "/".join(parts[:5])))
+            for groups, prefix in prefixes:
+                group = groups.setdefault(prefix, {"files": [], "size": 0, "modified": modified})
+                group["files"].append(file_path)
+                group["size"] += size
+                group["modified"] = max(group["modified"], modified)
+
+        expired_before = time.time() - options["min_age_days"] * 24 * 60 * 60
+        orphaned = {
+            prefix: tree for prefix, tree in trees.items()
+            if prefix not in referenced and tree["modified"] < expired_before
+        }
+        for prefix, tree in sorted(orphaned.items()):
+            self.stdout.write("{} {}: {} files, {} bytes, last modified {}".format(
+                "Would delete" if options["dry_run"] else "Deleting",
+                prefix, len(tree["files"]), tree["size"], datetime.fromtimestamp(tree["modified"]).isoformat(),
+            ))
+            if not options["dry_run"]:
+                self.delete_tree(prefix, tree["files"], options["max_deletes_per_second"])
+
+        self.stdout.write("{} of {} content trees orphaned, {} files, {} bytes".format(
+            len(orphaned), len(trees),
+            sum(len(tree["files"]) for tree in orphaned.values()),
+            sum(tree["size"] for tree in orphaned.values()),
+        ))
+
+        retired_before = time.time() - CONTENT_VERSION_GRACE_PERIOD
+        expired = {}
+        for prefix, version in sorted(versions.items()):
+            tree_prefix, _, name = prefix.rpartition("/{}/".format(CONTENT_VERSIONS_DIR))
+            if tree_prefix not in referenced or name in referenced[tree_prefix]:
+                continue
+            retired_at = retired.get(tree_prefix, {}).get(name)
+            if retired_at is None:
+                retired_at = version["modified"] if version["modified"] < expired_before else None
+            if retired_at is not None and retired_at < retired_before:
+                expired[prefix] = version
+        for prefix, version in expired.items():
+            self.stdout.write("{} expired content version {}: {} files, {} bytes".format(
+                "Would delete" if options["dry_run"] else "Deleting", prefix, len(version["files"]), version["size"],
+            ))
+            if not options["dry_run"]:
+                self.delete_tree(prefix, version["files"], options["max_deletes_per_second"])
+
+    def delete_expired_uploads(self, max_age_hours, dry_run):
+        """
+        Deletes chunked uploads whose chunks all expired, and expired packages waiting for processing
+        """
+        expired_before = time.time() - max_age_hours * 60 * 60
+        uploads = {}
+        for file_path, _size, modified in list_file_details_cloud(UPLOAD_STORAGE, CHUNKED_UPLOADS_DIR):
+            upload_id = os.path.relpath(file_path, CHUNKED_UPLOADS_DIR).split(os.sep)[0]
+            uploads[upload_id] = max(uploads.get(upload_id, 0), modified.timestamp())
+        expired_uploads = sorted(upload_id for upload_id, modified in uploads.items() if modified < expired_before)
+        expired_packages = [
+            file_path for file_path, _size, modified in list_file_details_cloud(H5P_STORAGE, PACKAGE_UPLOADS_DIR)
+            if modified.timestamp() < expired_before
+        ]
+        self.stdout.write("{} {} abandoned chunked uploads and {} unprocessed packages".format(
+            "Would delete" if dry_run else "Deleting", len(expired_uploads), len(expired_packages),
+        ))
+        if dry_run:
+            return
+        for upload_id in expired_uploads:
+            delete_upload(UPLOAD_STORAGE, upload_id)
+        delete_storage_files(H5P_STORAGE, expired_packages)
+
+    @staticmethod
+    def get_referenced_trees():
+        """
+        Returns content used by blocks of all courses and libraries, and times their content versions were retired
+
+        Content used is returned as the names of the versions in use keyed by the path prefix of their tree,
+        relative to h5pxblockmedia, and retirement times are keyed by tree prefix and version name.
+        """
+        # Imported here as they are only available within edx-platform
+        from xmodule.modulestore import ModuleStoreEnum
+        from xmodule.modulestore.django import modulestore
+
+        store = modulestore()
+        learning_context_keys = [course.id for course in store.get_course_summaries()]
+        if hasattr(store, "get_library_summaries"):
+            learning_context_keys += [library.location.library_key for library in store.get_library_summaries()]
+
+        referenced = {}
+        retired = {}
+        for learning_context_key in learning_context_keys:
+            for branch in (ModuleStoreEnum.Branch.draft_preferred, ModuleStoreEnum.Branch.published_only):
+                with store.branch_setting(branch, learning_context_key):
+                    for block in store.get_items(learning_context_key, qualifiers={"category": "h5pxblock"}):
+                        prefix = block.get_block_path_prefix
+                        referenced.setdefault(prefix, set()).update(
+                            version for version in (
+                                block.h5p_content_version, block.h5p_content_meta.get("pending_version")
+                            ) if version
+                        )
+                        for previous in block.h5p_content_meta.get("previous_versions", []):
+                            retired_at = retired.setdefault(prefix, {}).get(previous["version"], 0)
+                            retired[prefix][previous["version"]] = max(retired_at, previous["replaced_at"])
+                        # Content can be played from the path of another block
+                        content_path = unquote(block.h5p_content_json_path or "")
+                        if "{}/".format(CONTENT_ROOT) in content_path:
+                            parts = content_path.split("{}/".format(CONTENT_ROOT), 1)[1].split("/")
+                            versions = referenced.setdefault("/".join(parts[:3]), set())
+                            if len(parts) > 4 and parts[3] == CONTENT_VERSIONS_DIR:
+                                versions.add(parts[4])
+        return referenced, retired
+
+    def delete_tree(self, prefix, file_paths, max_deletes_per_second):
+        """
+        Deletes files of a content tree in batches, pausing between batches to stay under the rate limit
+        """
+        deleted = failed = 0
+        for index in range(0, len(file_paths), S3_DELETE_BATCH_SIZE):
+            batch = file_paths[index:index + S3_DELETE_BATCH_SIZE]
+            started = time.monotonic()
+            result = delete_storage_files(H5P_STORAGE, batch)
+            deleted += result.deleted
+            failed += len(result.failed)
+            if max_deletes_per_second:
+                time.sleep(max(len(batch) / max_deletes_per_second - (time.monotonic() - started), 0))
+
+        if isinstance(H5P_STORAGE, FileSystemStorage) and not failed:
+            # Directories are left behind by file deletions on the local filesystem
+            delete_path(H5P_STORAGE.path(os.path.join(CONTENT_ROOT, prefix)))
+        log.info("Deleted %s files of orphaned h5p content %s, %s failed", deleted, prefix, failed)
@@ -0,0 +1,240 @@
+"""
+Management command to move H5P content to the configured storage, or to unpack it again
+
+Examples:
+
+    ./manage.py cms migrate_h5p_content --dry-run
+    ./manage.py cms migrate_h5p_content --course-id course-v1:edX+DemoX+Demo_Course --workers 8
+    ./manage.py cms migrate_h5p_content --mode reprocess --checkpoint /tmp/h5p-reprocess.json
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+
+from h5pxblock.h5pxblock import (
+    H5P_SHARED_LIBRARIES_CLOUD_PATH,
+    H5P_SHARED_LIBRARIES_URL,
+    H5P_STORAGE,
+    H5P_URL,
+)
+from h5pxblock.utils import (
+    CONTENT_VERSIONS_DIR,
+    LIBRARY_MARKER_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    copy_storage_tree,
+    get_immutable_storage,
+    list_files_cloud,
+    load_json_cloud,
+    package_storage_tree,
+)
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Walks h5pxblock blocks and copies their content to the configured h5p storage, or unpacks it again
+
+    In copy mode, content still served from the local filesystem, e.g. after switching
+    H5PXBLOCK_STORAGE to S3, is copied as is to the configured storage and blocks are pointed to it.
+    In reprocess mode, the package of each block is rebuilt from its unpacked content and goes through
+    the unpack pipeline again, applying current settings like shared libraries or precompression.
+
+    Blocks are processed by a pool of workers while block updates are saved from the main thread.
+    Processed blocks are recorded in a checkpoint file so that an interrupted run resumes where it stopped.
+    """
+
+    help = "Copy H5P content to the configured storage, or unpack it again, for all h5pxblock blocks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--course-id", dest="course_ids", action="append", default=[],
+            help="Only process blocks of this course, may be repeated. Defaults to all courses.",
+        )
+        parser.add_argument("--mode", choices=("copy", "reprocess"), default="copy")
+        parser.add_argument("--workers", type=int, default=4, help="Number of blocks processed at once")
+        parser.add_argument(
+            "--checkpoint", default="migrate_h5p_content.json",
+            help="File recording processed blocks, used to resume an interrupted run",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be done without doing it")
+
+    def handle(self, *args, **options):
+        # Imported here as they are only available within edx-platform
+        from opaque_keys.edx.keys import CourseKey
+        from xmodule.modulestore import ModuleStoreEnum
+        from xmodule.modulestore.django import modulestore
+
+        self.mode = options["mode"]
+        self.dry_run = options["dry_run"]
+        self.local_storage = FileSystemStorage(location=settings.MEDIA_ROOT, base_url=settings.MEDIA_URL)
+        self.copied_libraries = set()
+        self.libraries_lock = threading.Lock()
+        if self.mode == "copy" and isinstance(H5P_STORAGE, FileSystemStorage):
+            raise CommandError("Content is already stored on the local filesystem, there is nothing to copy")
+
+        checkpoint = self.load_checkpoint(options["checkpoint"])
+        store = modulestore()
+        course_keys = [CourseKey.from_string(course_id) for course_id in options["course_ids"]] or [
+            course.id for course in store.get_course_summaries()
+        ]
+
+        blocks = []
+        for course_key in course_keys:
+            with store.branch_setting(ModuleStoreEnum.Branch.draft_preferred, course_key):
+                for block in store.get_items(course_key, qualifiers={"category": "h5pxblock"}):
+                    if str(block.location) in checkpoint["done"]:
+                        continue
+                    source = self.get_source(block)
+                    if source is None:
+                        log.info("Skipping %s, its content is not hosted by the block", block.location)
+                        continue
+                    blocks.append((block, source))
+        self.stdout.write("{} blocks to {}".format(len(blocks), self.mode))
+
+        started = time.monotonic()
+        files = size = done = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            futures = {executor.submit(self.process_block, block, *source): block for block, source in blocks}
+            for future in concurrent.futures.as_completed(futures):
+                block = futures[future]
+                try:
+                    block_files, block_size = future.result()
+                except BaseException as exp:
+                    log.exception("Unable to %s content of %s", self.mode, block.location)
+                    checkpoint["failed"][str(block.location)] = str(exp)
+                else:
+                    if not self.dry_run:
+                        self.save_block(store, block, ModuleStoreEnum.UserID.mgmt_command)
+                        checkpoint["done"].append(str(block.location))
+                        checkpoint["failed"].pop(str(block.location), None)
+                    files += block_files
+                    size += block_size
+                done += 1
+                if not self.dry_run:
+                    self.save_checkpoint(options["checkpoint"], checkpoint)
+                elapsed = max(time.monotonic() - started, 0.001)
+                self.stdout.write(
+                    "{}/{} blocks, {} files, {:.1f} MB, {:.1f} files/s, {:.2f} MB/s".format(
+                        done, len(blocks), files, size / 1e6, files / elapsed, size / 1e6 / elapsed
+                    )
+                )
+
+        self.stdout.write("{} blocks failed".format(len(checkpoint["failed"])))
+
+    def get_source(self, block):
+        """
+        Returns storage and path of the content served by a block, or None if the block serves external content
+        """
+        path = block.cloud_storage_path
+        local_url = "{}/{}".format(H5P_URL, block.get_block_path_prefix)
+        if block.h5p_content_version:
+            path = os.path.join(path, CONTENT_VERSIONS_DIR, block.h5p_content_version)
+            local_url = "{}/{}/{}".format(local_url, CONTENT_VERSIONS_DIR, block.h5p_content_version)
+        if block.h5p_content_json_path == local_url:
+            return self.local_storage, path
+        if self.mode == "reprocess" and block.h5p_content_json_path == block.get_content_version_url(
+            block.h5p_content_version
+        ):
+            return H5P_STORAGE, path
+        return None
+
+    def process_block(self, block, storage, path):
+        """
+        Copies or reprocesses content of a block and returns the number of files and bytes handled
+        """
+        names = [
+            os.path.relpath(file_path, path) for file_path in list_files_cloud(storage, path)
+            if block.h5p_content_version
+            or os.path.relpath(file_path, path).split(os.sep)[0] != CONTENT_VERSIONS_DIR
+        ]
+        if self.dry_run:
+            size = sum(storage.size(os.path.join(path, name)) for name in names)
+            self.stdout.write("Would {} {} files ({} bytes) of {}".format(self.mode, len(names), size, block.location))
+            return len(names), size
+
+        if self.mode == "reprocess":
+            package = package_storage_tree(storage, path, H5P_SHARED_LIBRARIES_CLOUD_PATH)
+            try:
+                # Packages failing preflight checks raise PackageRejected, recording the block as failed
+                block.import_package(package, asynchronous=False, force=True)
+            finally:
+                package.close()
+            return len(names), package.size
+
+        target = get_immutable_storage(H5P_STORAGE) if block.h5p_content_version else H5P_STORAGE
+        files, size = copy_storage_tree(storage, path, target, path, names)
+        if (block.h5p_libraries_path or "").startswith(H5P_SHARED_LIBRARIES_URL):
+            manifest = load_json_cloud(storage, os.path.join(path, MANIFEST_FILE_NAME)) or {}
+            libraries_shared = manifest.get("libraries_shared") or True
+            # Libraries shared before library sets have a folder per library at the root of the store
+            for folder in manifest.get("libraries", []) if libraries_shared is True else [libraries_shared]:
+                library_files, library_size = self.copy_library(folder)
+                files += library_files
+                size += library_size
+            block.h5p_libraries_path = block.get_libraries_url(libraries_shared)
+        block.h5p_content_json_path = block.get_content_version_url(block.h5p_content_version)
+        return files, size
+
+    def copy_library(self, folder):
+        """
+        Copies a library set, or a library shared before library sets, of the local shared library store to the
+        configured storage, once per run
+        """
+        with self.libraries_lock:
+            if folder in self.copied_libraries:
+                return 0, 0
+            self.copied_libraries.add(folder)
+        library_path = os.path.join(H5P_SHARED_LIBRARIES_CLOUD_PATH, folder)
+        if H5P_STORAGE.exists(os.path.join(library_path, LIBRARY_MARKER_FILE_NAME)):
+            return 0, 0
+        names = [
+            os.path.relpath(file_path, library_path)
+            for file_path in list_files_cloud(self.local_storage, library_path)
+        ]
+        # The marker goes last, so that a library is only considered copied once complete
+        files, size = copy_storage_tree(
+            self.local_storage, library_path, H5P_STORAGE, library_path,
+            [name for name in names if name != LIBRARY_MARKER_FILE_NAME],
+        )
+        if LIBRARY_MARKER_FILE_NAME in names:
+            marker_files, marker_size = copy_storage_tree(
+                self.local_storage, library_path, H5P_STORAGE, library_path, [LIBRARY_MARKER_FILE_NAME]
+            )
+            files, size = files + marker_files, size + marker_size
+        return files, size
+
+    @staticmethod
+    def save_block(store, block, user_id):
+        """
+        Saves block updates, publishing them if the block had no unpublished changes
+        """
+        published = store.has_published_version(block) and not store.has_changes(block)
+        store.update_item(block, user_id)
+        if published:
+            store.publish(block.location, user_id)
+
+    @staticmethod
+    def load_checkpoint(path):
+        try:
+            with open(path, encoding="utf8") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            checkpoint = {}
+        checkpoint.setdefault("done", [])
+        checkpoint.setdefault("failed", {})
+        return checkpoint
+
+    @staticmethod
+    def save_checkpoint(path, checkpoint):
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w", encoding="utf8") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temp_path, path)
@@ -0,0 +1,166 @@
+"""
+Timings and counters of package processing, storage operations and block handlers
+
+Metrics are passed to the sinks listed in H5PXBLOCK_METRICS_SINKS, dotted paths of callables receiving
+a Metric. Nothing is measured when no sink is configured, and sinks only get the metric of a whole
+phase, storage call or request, so that they can stay enabled in production.
+"""
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    from statsd import StatsClient
+except ModuleNotFoundError:
+    StatsClient = None
+
+try:
+    from eventtracking import tracker
+except ModuleNotFoundError:  # Only installed within Open edX
+    tracker = None
+
+log = logging.getLogger(__name__)
+
+METRICS_SINKS = getattr(settings, "H5PXBLOCK_METRICS_SINKS", [])
+METRICS_PREFIX = getattr(settings, "H5PXBLOCK_METRICS_PREFIX", "h5pxblock")
+STATSD_HOST = getattr(settings, "H5PXBLOCK_STATSD_HOST", "localhost")
+STATSD_PORT = getattr(settings, "H5PXBLOCK_STATSD_PORT", 8125)
+TRACKER_EVENT_NAME = "edx.h5pxblock.metric"
+
+COUNTER = "counter"
+TIMING = "timing"
+
+if "h5pxblock.metrics.statsd_sink" in METRICS_SINKS and StatsClient is None:
+    log.warning("H5PXBLOCK_METRICS_SINKS includes statsd_sink but statsd is not installed, metrics are not sent")
+
+
+@dataclass(frozen=True)
+class Metric:
+    """
+    A measurement sent to sinks, timings being in seconds
+    """
+
+    name: str
+    kind: str
+    value: float
+    tags: dict = field(default_factory=dict)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sinks():
+    """
+    Returns the configured sink callables, leaving out those that can't be imported
+    """
+    sinks = []
+    for sink_path in METRICS_SINKS:
+        try:
+            sinks.append(import_string(sink_path) if isinstance(sink_path, str) else sink_path)
+        except ImportError as exp:
+            log.error("Unable to load h5pxblock metrics sink %s: %s", sink_path, exp)
+    return tuple(sinks)
+
+
+def enabled():
+    return bool(get_sinks())
+
+
+def emit(name, value, kind=COUNTER, **tags):
+    """
+    Sends a metric to all sinks, a failing sink never failing the caller
+    """
+    sinks = get_sinks()
+    if not sinks:
+        return
+    metric = Metric("{}.{}".format(METRICS_PREFIX, name), kind, value, tags)
+    for sink in sinks:
+        try:
+            sink(metric)
+        except BaseException as exp:
+            log.error("Metrics sink %s failed: %s", sink, exp)
+
+
+def increment(name, value=1, **tags):
+    emit(name, value, COUNTER, **tags)
+
+
+def timing(name, seconds, **tags):
+    emit(name, seconds, TIMING, **tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    """
+    Times the enclosed block, tagging the timing with status "error" when it raises
+    """
+    if not enabled():
+        yield
+        return
+    started = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        timing(name, time.perf_counter() - started, status=status, **tags)
+
+
+def timed(name):
+    """
+    Decorates a block handler or view to time it, responses with an HTTP error status counting as errors
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            status = "error"
+            try:
+                result = func(*args, **kwargs)
+                status = "error" if getattr(result, "status_code", 200) >= 400 else "ok"
+                return result
+            finally:
+                timing(name, time.perf_counter() - started, status=status)
+        return wrapper
+    return decorator
+
+
+def log_sink(metric):
+    """
+    Logs metrics, e.g. to be parsed by log based monitoring
+    """
+    log.info("metric %s %s=%s %s", metric.name, metric.kind, metric.value, metric.tags)
+
+
+@functools.lru_cache(maxsize=None)
+def get_statsd_client():
+    return StatsClient(STATSD_HOST, STATSD_PORT)
+
+
+def statsd_sink(metric):
+    """
+    Sends metrics to statsd, tag values being appended to metric names as statsd has no tags
+    """
+    if StatsClient is None:
+        return
+    name = ".".join([metric.name] + [str(metric.tags[tag]) for tag in sorted(metric.tags)])
+    if metric.kind == TIMING:
+        get_statsd_client().timing(name, metric.value * 1000)
+    else:
+        get_statsd_client().incr(name, metric.value)
+
+
+def tracker_sink(metric):
+    """
+    Emits metrics as Open edX tracking events, outside of Open edX metrics are dropped
+    """
+    if tracker is None:
+        return
+    tracker.emit(TRACKER_EVENT_NAME, {
+        "name": metric.name, "kind": metric.kind, "value": metric.value, "tags": metric.tags,
+    })
@@ -0,0 +1,46 @@
+"""
+Assets of the h5p-standalone player, vendored under public/h5p-standalone
+
+The player version is set here only. `make vendor_player` fetches the files of that version and writes them
+with content hashed names, along with a manifest mapping each asset to its file. This module only uses the
+standard library so that the vendoring script can load it without Django.
+"""
+import json
+import os
+
+H5P_STANDALONE_VERSION = "3.7.0"
+# Entry points of the player, by asset name, as laid out in the npm package
+PLAYER_ASSETS = {
+    "main": "dist/main.bundle.js",
+    "frame": "dist/frame.bundle.js",
+    "css": "dist/styles/h5p.css",
+}
+PLAYER_DIR = "public/h5p-standalone"
+PLAYER_MANIFEST_NAME = "manifest.json"
+DEFAULT_PLAYER_CDN_URL = "https://cdn.jsdelivr.net/npm/h5p-standalone@{version}"
+
+
+def get_manifest_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), PLAYER_DIR, PLAYER_MANIFEST_NAME)
+
+
+def load_player_manifest():
+    """
+    Returns the manifest of the vendored player, or None if the configured version isn't vendored
+    """
+    try:
+        with open(get_manifest_path(), encoding="utf8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != H5P_STANDALONE_VERSION or set(manifest.get("files", {})) != set(PLAYER_ASSETS):
+        return None
+    return manifest
+
+
+def get_player_cdn_urls(cdn_url=None):
+    """
+    Returns URLs of the player assets on a CDN laid out like the npm package, {version} being replaced in cdn_url
+    """
+    base_url = (cdn_url or DEFAULT_PLAYER_CDN_URL).format(version=H5P_STANDALONE_VERSION).rstrip("/")
+    return {asset: "{}/{}".format(base_url, path) for asset, path in PLAYER_ASSETS.items()}
@@ -1,40 +1,29 @@
 /* Javascript for H5PPlayerXBlock. */
 function H5PPlayerXBlock(runtime, element, args) {
-  // Initialize queue if not exists
-  if (!window.H5PBlocksQueue) {
-    window.H5PBlocksQueue = [];
-    window.H5PBlocksQueueProcessing = false;
-  }
-  
-  window.H5PBlocksQueue.push({runtime, element, args});
-  
-  if (!window.H5PBlocksQueueProcessing) {
-    processNextBlock();
-  }
-  
-  // Process blocks one at a time
-  async function processNextBlock() {
-    window.H5PBlocksQueueProcessing = true;
-    
-    if (window.H5PBlocksQueue.length > 0) {
-      const blockData = window.H5PBlocksQueue.shift();
-      await initH5PBlock(blockData.runtime, blockData.element, blockData.args);
-      processNextBlock();
-    } else {
-      window.H5PBlocksQueueProcessing = false;
-    }
+  // Blocks of the page share one scheduler, configured by the first block
+  if (!window.H5PBlocksScheduler) {
+    window.H5PBlocksScheduler = createH5PBlocksScheduler(
+      args.initConcurrency || 1,
+      args.initRootMargin || "200px"
+    );
   }
-  
+
+  window.H5PBlocksScheduler.add(element, function () {
+    return initH5PBlock(runtime, element, args);
+  });
+
   async function initH5PBlock(runtime, element, args) {
     if (typeof require === "function") {
-      return new Promise((resolve) => {
+      // RequireJS paths leave out the .js extension
+      require.config({ paths: { h5p: args.playerAssets.main.replace(/\.js$/, "") } });
+      return new Promise((resolve, reject) => {
         require(["h5p"], function (H5PStandalone) {
           initWithH5P(H5PStandalone, "cms", runtime, element, args)
-            .then(resolve);
-        });
+            .then(resolve, reject);
+        }, reject);
       });
     } else {
-      await loadJS();
+      await loadJS(args.playerAssets.main);
       return initWithH5P(window.H5PStandalone, "lms", runtime, element, args);
     }
   }
@@ -45,16 +34,70 @@ function H5PPlayerXBlock(runtime, element, args) {
       "user_interaction_data"
     );
     const contentxResultSaveUrl = runtime.handlerUrl(element, "result_handler");
+    const resultBatchDelay = args.resultBatchDelay || 1000;
+    let pendingResults = [];
+    let resultTimer = null;
+
+    // Root completion statements are sent in batches so the server publishes at most one grade per batch.
+    function flushResults(keepalive) {
+      clearTimeout(resultTimer);
+      resultTimer = null;
+      if (pendingResults.length === 0) {
+        return;
+      }
+      const statements = pendingResults;
+      pendingResults = [];
+      postJSON(contentxResultSaveUrl, { statements: statements }, keepalive)
+        .catch(function () {
+          console.error("Error saving H5P results.");
+        });
+    }
+
+    function queueResult(statement) {
+      pendingResults.push(statement);
+      clearTimeout(resultTimer);
+      resultTimer = setTimeout(flushResults, resultBatchDelay);
+    }
+
+    const xapiStatementsUrl = runtime.handlerUrl(element, "xapi_statements");
+    let pendingStatements = [];
+    let statementsTimer = null;
+
+    // With xAPI forwarding, all statements are sent in batches to be queued for the LRS by the server.
+    function flushStatements(keepalive) {
+      clearTimeout(statementsTimer);
+      statementsTimer = null;
+      while (pendingStatements.length > 0) {
+        const statements = pendingStatements.splice(0, args.xapiBatchSize);
+        postJSON(xapiStatementsUrl, { statements: statements }, keepalive)
+          .catch(function () {
+            console.error("Error forwarding xAPI statements.");
+          });
+      }
+    }
+
+    function queueStatement(statement) {
+      pendingStatements.push(statement);
+      if (!statementsTimer) {
+        statementsTimer = setTimeout(flushStatements, resultBatchDelay);
+      }
+    }
+
+    // Requests sent when the page is hidden outlive it, unlike regular ajax requests cancelled on unload
+    window.addEventListener("pagehide", function () {
+      flushResults(true);
+      flushStatements(true);
+    });
 
     const h5pel = document.getElementById("h5p-" + args.player_id);
     if (h5pel && $(h5pel).children(".h5p-iframe-wrapper").length == 0) {
+      const userData = args.hasUserData ? await fetchUserData(contentUserDataUrl) : undefined;
       const userObj = { name: args.user_full_name, mail: args.user_email };
       const options = {
+        id: args.player_id,
         h5pJsonPath: args.h5pJsonPath,
-        frameJs:
-          "https://cdn.jsdelivr.net/npm/h5p-standalone@3.7.0/dist/frame.bundle.js",
-        frameCss:
-          "https://cdn.jsdelivr.net/npm/h5p-standalone@3.7.0/dist/styles/h5p.css",
+        frameJs: args.playerAssets.frame,
+        frameCss: args.playerAssets.css,
         frame: args.frame,
         copyright: args.copyright,
         icon: args.icon,
@@ -64,13 +107,19 @@ function H5PPlayerXBlock(runtime, element, args) {
         customJs: args.customJsPath,
         contentUserData: [
           {
-            state: args.userData,
+            state: userData,
           },
         ],
         ajax: {
           contentUserDataUrl: contentUserDataUrl,
         },
       };
+      if (args.librariesPath) {
+        options.librariesPath = args.librariesPath;
+      }
+      if (args.contentJsonPath) {
+        options.contentJsonPath = args.contentJsonPath;
+      }
 
       try {
         await new H5PStandalone.H5P(h5pel, options);
@@ -83,7 +132,20 @@ function H5PPlayerXBlock(runtime, element, args) {
             return;
           }
 
+          // The dispatcher is shared by all blocks of the page, each block handles statements of its own content
           let statement = event.data.statement;
+          let extensions =
+            statement.object &&
+            statement.object.definition &&
+            statement.object.definition.extensions;
+          let contentId =
+            extensions && extensions["http://h5p.org/x-api/h5p-local-content-id"];
+          if (String(contentId) !== String(args.player_id)) {
+            return;
+          }
+          if (args.xapiForwarding) {
+            queueStatement(statement);
+          }
           let validVerb =
             statement.verb &&
             statement.verb.display &&
@@ -105,17 +167,7 @@ function H5PPlayerXBlock(runtime, element, args) {
 
           // Store only completed root events.
           if (isCompleted && !isChild) {
-            $.ajax({
-              type: "POST",
-              url: contentxResultSaveUrl,
-              data: JSON.stringify(event.data.statement),
-            })
-            .done(function () {
-                  // handle fine request  here
-            })
-            .fail(function () {
-              // handle fails request here
-            });
+            queueResult(event.data.statement);
           }
         });
 
@@ -127,22 +179,169 @@ function H5PPlayerXBlock(runtime, element, args) {
   }
 }
 
-function loadJS() {
+// Initializes blocks at most `concurrency` at a time. Blocks within `rootMargin` of the viewport start
+// closest first, in page order on ties, and offscreen blocks wait until they are scrolled near it. Blocks
+// which aren't rendered, e.g. in a collapsed display:none container, never intersect the viewport and start
+// in page order once no block near the viewport is waiting. Without IntersectionObserver, blocks start in
+// page order. A block that fails frees its slot, and so does a block slow to initialize when blocks are
+// initialized concurrently, so that it never holds back the others. With a concurrency of 1, blocks are
+// initialized strictly one at a time.
+function createH5PBlocksScheduler(concurrency, rootMargin) {
+  const initTimeout = 30000;
+  const pending = [];
+  let running = 0;
+  const observer = "IntersectionObserver" in window
+    ? new IntersectionObserver(onIntersection, { rootMargin: rootMargin })
+    : null;
+
+  function onIntersection(entries) {
+    entries.forEach(function (entry) {
+      const block = pending.find(function (item) {
+        return item.element === entry.target;
+      });
+      if (block) {
+        block.nearViewport = entry.isIntersecting;
+      }
+    });
+    startNext();
+  }
+
+  function distanceToViewport(element) {
+    const rect = element.getBoundingClientRect();
+    if (rect.bottom < 0) {
+      return -rect.bottom;
+    }
+    return Math.max(rect.top - window.innerHeight, 0);
+  }
+
+  function isRendered(element) {
+    return element.getClientRects().length > 0;
+  }
+
+  function startNext() {
+    while (running < concurrency) {
+      let next = null;
+      let nextDistance = Infinity;
+      pending.forEach(function (block) {
+        const distance = block.nearViewport ? distanceToViewport(block.element) : Infinity;
+        if (distance < nextDistance) {
+          next = block;
+          nextDistance = distance;
+        }
+      });
+      if (!next) {
+        next = pending.find(function (block) {
+          return !isRendered(block.element);
+        });
+      }
+      if (!next) {
+        return;
+      }
+      pending.splice(pending.indexOf(next), 1);
+      if (observer) {
+        observer.unobserve(next.element);
+      }
+      start(next);
+    }
+  }
+
+  function start(block) {
+    let released = false;
+    function release() {
+      if (!released) {
+        released = true;
+        running--;
+        startNext();
+      }
+    }
+
+    running++;
+    const timer = concurrency > 1 ? setTimeout(function () {
+      console.warn("H5P content is slow to initialize, starting the next blocks.");
+      release();
+    }, initTimeout) : null;
+    Promise.resolve()
+      .then(block.init)
+      .catch(function (error) {
+        console.error("Error initializing H5P content.", error);
+      })
+      .then(function () {
+        clearTimeout(timer);
+        release();
+      });
+  }
+
+  return {
+    add: function (element, init) {
+      const node = element.jquery ? element[0] : element;
+      pending.push({ element: node, init: init, nearViewport: !observer });
+      if (observer) {
+        observer.observe(node);
+      } else {
+        startNext();
+      }
+    },
+  };
+}
+
+// Posts data as JSON to a handler. With keepalive, the request is sent with fetch so that the browser completes
+// it after the page is unloaded, with the CSRF token jQuery would otherwise add through the platform's ajax setup.
+function postJSON(url, data, keepalive) {
+  if (keepalive && window.fetch) {
+    const csrfToken = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]*)/);
+    return fetch(url, {
+      method: "POST",
+      body: JSON.stringify(data),
+      credentials: "same-origin",
+      keepalive: true,
+      headers: {
+        "Content-Type": "application/json",
+        "X-CSRFToken": csrfToken ? decodeURIComponent(csrfToken[1]) : "",
+      },
+    }).then(function (response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response;
+    });
+  }
+  return Promise.resolve($.ajax({ type: "POST", url: url, data: JSON.stringify(data) }));
+}
+
+// Learner state is fetched when the block is initialized instead of being inlined in the page.
+function fetchUserData(url) {
   return new Promise((resolve) => {
-    if (window.H5PStandalone) {
-      resolve();
-    } else {
-      // Load H5PStandalone dynamically using $.getScript
-      $.getScript(
-        "https://cdn.jsdelivr.net/npm/h5p-standalone@3.7.0/dist/main.bundle.js"
-      )
+    $.ajax({ type: "GET", url: url, dataType: "json" })
+      .done(function (response) {
+        resolve(response.data);
+      })
+      .fail(function () {
+        console.error("Error loading learner state.");
+        resolve(undefined);
+      });
+  });
+}
+
+// The player is loaded once for all blocks initializing concurrently, and again on the next block if it failed.
+function loadJS(url) {
+  if (!window.H5PStandaloneLoading) {
+    window.H5PStandaloneLoading = new Promise((resolve, reject) => {
+      if (window.H5PStandalone) {
+        resolve();
+        return;
+      }
+      // Load H5PStandalone dynamically, letting the browser cache it unlike $.getScript
+      $.ajax({ url: url, dataType: "script", cache: true })
         .done(function () {
           window.H5PStandalone = H5PStandalone;
           resolve();
         })
         .fail(function () {
           console.error("Error loading H5PStandalone.");
+          window.H5PStandaloneLoading = null;
+          reject(new Error("Unable to load H5PStandalone"));
         });
-    }
-  });
+    });
+  }
+  return window.H5PStandaloneLoading;
 }
@@ -1,6 +1,20 @@
 function H5PStudioXBlock(runtime, element, args) {
 
     var handlerUrl = runtime.handlerUrl(element, 'studio_submit');
+    var statusUrl = runtime.handlerUrl(element, 'package_status');
+    var uploadChunkUrl = runtime.handlerUrl(element, 'upload_chunk');
+    var uploadStatusUrl = runtime.handlerUrl(element, 'upload_status');
+    var chunkSize = args.upload_chunk_size;
+    var chunkConcurrency = 3;
+    var chunkRetries = 3;
+    var phaseTexts = {
+        validating: args.validating_txt,
+        deleting: args.deleting_txt,
+        extracting: args.extracting_txt,
+        uploading: args.uploading_txt,
+        done: args.uploaded_txt,
+        failed: args.failed_txt
+    };
 
     function calcWdith(evt){
         var width = 0;
@@ -20,6 +34,139 @@ function H5PStudioXBlock(runtime, element, args) {
             }).text(text + '(' + width + '%)');
     }
 
+    function notifySaveEnd() {
+        if ('notify' in runtime) { //xblock workbench runtime does not have `notify` method
+            runtime.notify('save', { state: 'end' });
+        }
+    }
+
+    function pollPackageStatus(jobId) {
+        $.ajax({
+            url: statusUrl,
+            type: "POST",
+            data: JSON.stringify({ job_id: jobId }),
+            dataType: 'json'
+        }).done(function (status) {
+            var width = status.files_total ? Math.round(status.files_done / status.files_total * 100) : 0;
+            if (status.phase === 'done') {
+                setProgressBarWidth(100, phaseTexts.done);
+                notifySaveEnd();
+            } else if (status.phase === 'failed') {
+                setProgressBarWidth(width, phaseTexts.failed + ': ' + status.errors.join(', ') + ' ');
+                notifySaveEnd();
+            } else {
+                setProgressBarWidth(width, phaseTexts[status.phase] || args.extracting_txt);
+                setTimeout(function () { pollPackageStatus(jobId); }, 1000);
+            }
+        }).fail(function () {
+            setProgressBarWidth(0, phaseTexts.failed);
+            notifySaveEnd();
+        });
+    }
+
+    function getUploadKey(file) {
+        return 'h5pxblock-upload:' + handlerUrl + ':' + file.name + ':' + file.size + ':' + file.lastModified;
+    }
+
+    function getUploadId(file) {
+        // Upload ids are remembered per file, so that saving the same file again resumes its upload
+        var uploadId = null;
+        try {
+            uploadId = window.localStorage.getItem(getUploadKey(file));
+        } catch (e) {}
+        if (!uploadId) {
+            var bytes = new Uint8Array(16);
+            window.crypto.getRandomValues(bytes);
+            uploadId = Array.prototype.map.call(bytes, function (byte) {
+                return ('0' + byte.toString(16)).slice(-2);
+            }).join('');
+            try {
+                window.localStorage.setItem(getUploadKey(file), uploadId);
+            } catch (e) {}
+        }
+        return uploadId;
+    }
+
+    function forgetUploadId(file) {
+        try {
+            window.localStorage.removeItem(getUploadKey(file));
+        } catch (e) {}
+    }
+
+    function sendChunk(uploadId, file, index, attempt) {
+        var chunkData = new FormData();
+        chunkData.append('upload_id', uploadId);
+        chunkData.append('index', index);
+        chunkData.append('chunk', file.slice(index * chunkSize, (index + 1) * chunkSize), file.name + '.part');
+        return $.ajax({
+            url: uploadChunkUrl,
+            type: "POST",
+            data: chunkData,
+            cache: false,
+            contentType: false,
+            processData: false
+        }).then(null, function () {
+            if (attempt + 1 >= chunkRetries) {
+                return $.Deferred().reject();
+            }
+            var retry = $.Deferred();
+            setTimeout(function () {
+                sendChunk(uploadId, file, index, attempt + 1).then(retry.resolve, retry.reject);
+            }, 1000 * Math.pow(2, attempt));
+            return retry.promise();
+        });
+    }
+
+    function uploadChunks(file) {
+        // Sends chunks the server doesn't have yet, chunkConcurrency at a time
+        var upload = $.Deferred();
+        var uploadId = getUploadId(file);
+        var chunkCount = Math.max(Math.ceil(file.size / chunkSize), 1);
+        $.ajax({
+            url: uploadStatusUrl,
+            type: "POST",
+            data: JSON.stringify({ upload_id: uploadId }),
+            dataType: 'json'
+        }).always(function (status) {
+            var received = (status && status.chunks) || [];
+            var pending = [];
+            for (var index = 0; index < chunkCount; index++) {
+                if (received.indexOf(index) === -1) {
+                    pending.push(index);
+                }
+            }
+            var done = chunkCount - pending.length;
+            var active = 0;
+
+            function next() {
+                if (upload.state() !== 'pending') {
+                    return;
+                }
+                if (!pending.length) {
+                    if (!active) {
+                        upload.resolve({ upload_id: uploadId, upload_chunks: chunkCount });
+                    }
+                    return;
+                }
+                var chunkIndex = pending.shift();
+                active++;
+                sendChunk(uploadId, file, chunkIndex, 0).done(function () {
+                    active--;
+                    done++;
+                    setProgressBarWidth(Math.round(done / chunkCount * 100), args.uploading_txt);
+                    next();
+                }).fail(function () {
+                    upload.reject();
+                });
+            }
+
+            for (var i = 0; i < chunkConcurrency; i++) {
+                next();
+            }
+        });
+        return upload.promise();
+    }
+
     $('.copy-text').click(function() {
         var copyIcon = $(this);
         var textToCopy = copyIcon.siblings('.text-to-copy').val();
@@ -59,7 +206,6 @@ function H5PStudioXBlock(runtime, element, args) {
         var weight = $(element).find('input[name=xb_weight]').val();
         var points = $(element).find('input[name=xb_points]').val();
 
-        form_data.append('h5p_content_bundle', h5p_content_bundle);
         form_data.append('display_name', display_name);
         form_data.append('show_frame', show_frame);
         form_data.append('show_copyright', show_copyright);
@@ -73,8 +219,26 @@ function H5PStudioXBlock(runtime, element, args) {
 
         if ('notify' in runtime) { //xblock workbench runtime does not have `notify` method
             runtime.notify('save', { state: 'start' });
-        }        
+        }
+
+        if (h5p_content_bundle === undefined) {
+            submit(form_data);
+            return;
+        }
+        $('.progress-bar-container').show();
+        setProgressBarWidth(0, args.uploading_txt);
+        uploadChunks(h5p_content_bundle).done(function (upload) {
+            form_data.append('upload_id', upload.upload_id);
+            form_data.append('upload_chunks', upload.upload_chunks);
+            form_data.append('upload_name', h5p_content_bundle.name);
+            submit(form_data, h5p_content_bundle);
+        }).fail(function () {
+            setProgressBarWidth(0, phaseTexts.failed);
+            notifySaveEnd();
+        });
+    });
 
+    function submit(form_data, h5p_content_bundle) {
         $.ajax({
             url: handlerUrl,
             dataType: 'text',
@@ -107,13 +271,36 @@ function H5PStudioXBlock(runtime, element, args) {
             },
 
             success: function (response) {
-                if ('notify' in runtime) { //xblock workbench runtime does not have `notify` method
-                    runtime.notify('save', { state: 'end' });
+                var result = JSON.parse(response);
+                if (h5p_content_bundle !== undefined) {
+                    forgetUploadId(h5p_content_bundle);
+                }
+                if (result.job_id) {
+                    setProgressBarWidth(0, phaseTexts.validating);
+                    pollPackageStatus(result.job_id);
+                } else {
+                    notifySaveEnd();
                 }
+            },
+
+            error: function (xhr) {
+                var result = {};
+                try {
+                    result = JSON.parse(xhr.responseText);
+                } catch (e) {}
+                if (result.errors) {
+                    // The package was rejected, sending it again would fail the same way
+                    if (h5p_content_bundle !== undefined) {
+                        forgetUploadId(h5p_content_bundle);
+                    }
+                    setProgressBarWidth(0, phaseTexts.failed + ': ' + result.errors.join(', ') + ' ');
+                } else {
+                    setProgressBarWidth(0, phaseTexts.failed);
+                }
+                notifySaveEnd();
             }
         });
-
-    });
+    }
 
     $(element).find('.cancel-button').bind('click', function () {
         if ('notify' in runtime) { //xblock workbench runtime does not have `notify` method
@@ -0,0 +1,100 @@
+"""
+Background processing of uploaded H5P packages
+"""
+import logging
+import threading
+
+from h5pxblock.utils import (
+    PackageProgress,
+    get_h5p_storage,
+    get_manifest_summary,
+    unpack_and_upload_on_cloud,
+    unpack_package_local_path,
+)
+
+try:
+    from celery import shared_task
+except ModuleNotFoundError:  # Celery is not installed outside of Open edX, e.g. in the workbench
+    shared_task = None
+
+log = logging.getLogger(__name__)
+
+
+def process_package(
+    job_id, package_name, content_path, local=False, shared_libraries_path=None, immutable=False, usage_id=None
+):
+    """
+    Unpacks a package stored in h5p storage and reports progress under given job id
+
+    Content uploaded to cloud storage is marked as immutable when immutable is set.
+    The stored package is deleted once processed, and its outcome saved to the block of usage_id.
+    """
+    storage = get_h5p_storage()
+    progress = PackageProgress(job_id)
+    manifest = None
+    try:
+        with storage.open(package_name, "rb") as package:
+            if local:
+                manifest = unpack_package_local_path(
+                    package, content_path, shared_libraries_path, progress=progress
+                )
+            else:
+                manifest = unpack_and_upload_on_cloud(
+                    package, storage, content_path, shared_libraries_path, progress=progress, immutable=immutable
+                )
+    except BaseException as exp:
+        log.exception("Error while processing h5p package %s", package_name)
+        progress.add_error(str(exp))
+    finally:
+        progress.finish(**(get_manifest_summary(manifest) if manifest else {}))
+        storage.delete(package_name)
+    if usage_id:
+        save_package_job_outcome(usage_id, job_id)
+
+
+def save_package_job_outcome(usage_id, job_id):
+    """
+    Applies outcome of a finished job to its block and saves it, publishing it again if it was published as is
+
+    Blocks published while their job was pending would otherwise keep it pending in the LMS until an author
+    opens them in Studio again. Outside of edx-platform, the outcome is applied by the next view of the block.
+    """
+    try:
+        # Only available within edx-platform
+        from opaque_keys.edx.keys import UsageKey
+        from xmodule.modulestore import ModuleStoreEnum
+        from xmodule.modulestore.django import modulestore
+    except ModuleNotFoundError:
+        return
+
+    try:
+        store = modulestore()
+        usage_key = UsageKey.from_string(usage_id)
+        with store.branch_setting(ModuleStoreEnum.Branch.draft_preferred, usage_key.course_key):
+            block = store.get_item(usage_key)
+            # Studio may have applied the outcome already, or the block may not be saved with the job yet
+            if block.h5p_package_job_id != job_id:
+                return
+            published = store.has_published_version(block) and not store.has_changes(block)
+            if block.apply_package_job():
+                store.update_item(block, ModuleStoreEnum.UserID.mgmt_command)
+                if published:
+                    store.publish(block.location, ModuleStoreEnum.UserID.mgmt_command)
+    except BaseException:
+        log.exception("Unable to save outcome of h5p package job %s to %s", job_id, usage_id)
+
+
+if shared_task is not None:
+    process_package_task = shared_task(name="h5pxblock.tasks.process_package")(process_package)
+else:
+    process_package_task = None
+
+
+def start_package_processing(**kwargs):
+    """
+    Processes a stored package in a celery worker when available, otherwise in a background thread
+    """
+    if process_package_task is not None:
+        process_package_task.delay(**kwargs)
+    else:
+        threading.Thread(target=process_package, kwargs=kwargs, daemon=True).start()
@@ -1,20 +1,223 @@
 """
 Utility methods for xblock
 """
+import base64
 import concurrent.futures
+import copy
+import gzip
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import posixpath
+import re
 import shutil
-from zipfile import ZipFile, is_zipfile
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from enum import Enum
+from zipfile import ZIP_DEFLATED, BadZipFile, ZipFile
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage, get_storage_class
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, default_storage, get_storage_class
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+from h5pxblock.metrics import increment, timer, timing
+from h5pxblock.workers import Image, inflate_zip_member, optimize_image
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
 
 log = logging.getLogger(__name__)
 
 
 MAX_WORKERS = getattr(settings, "THREADPOOLEXECUTOR_MAX_WORKERS", 10)
+MAX_INFLIGHT_FILES = getattr(settings, "H5PXBLOCK_MAX_INFLIGHT_FILES", MAX_WORKERS * 2)
+MAX_INFLIGHT_BYTES = getattr(settings, "H5PXBLOCK_MAX_INFLIGHT_BYTES", MAX_WORKERS * 8 * 1024 * 1024)
+DIFFERENTIAL_SYNC = getattr(settings, "H5PXBLOCK_DIFFERENTIAL_SYNC", False)
+SYNC_CONTENT_HASH = getattr(settings, "H5PXBLOCK_SYNC_CONTENT_HASH", False)
+
+SHARED_LIBRARIES = getattr(settings, "H5PXBLOCK_SHARED_LIBRARIES", False)
+ASYNC_PROCESSING = getattr(settings, "H5PXBLOCK_ASYNC_PROCESSING", False)
+
+MANIFEST_FILE_NAME = ".h5pxblock-manifest.json"
+LIBRARY_MARKER_FILE_NAME = ".h5pxblock-library.json"
+SHARED_LIBRARIES_DIR = "shared-libraries"
+PACKAGE_UPLOADS_DIR = "h5pxblock-uploads"
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+S3_DELETE_BATCH_SIZE = 1000
+PRECOMPRESS_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".json", ".svg", ".html", ".htm", ".txt", ".xml", ".vtt")
+PRECOMPRESS_MIN_SIZE = getattr(settings, "H5PXBLOCK_PRECOMPRESS_MIN_SIZE", 1024)
+PRECOMPRESS_ENCODINGS = [
+    encoding for encoding in getattr(settings, "H5PXBLOCK_PRECOMPRESS_ENCODINGS", [])
+    if encoding in PRECOMPRESS_SUFFIXES and (encoding != "br" or brotli is not None)
+]
+if "br" in getattr(settings, "H5PXBLOCK_PRECOMPRESS_ENCODINGS", []) and brotli is None:
+    log.warning("brotli is not installed, brotli variants of h5p content will not be generated")
+AGGREGATE_ASSETS = getattr(settings, "H5PXBLOCK_AGGREGATE_ASSETS", False)
+AGGREGATED_ASSETS_DIR = "h5pxblock-bundle"
+CSS_URL_PATTERN = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+USER_STATE_MAX_SIZE = getattr(settings, "H5PXBLOCK_USER_STATE_MAX_SIZE", 1024 * 1024)
+USER_STATE_COMPRESS_MIN_SIZE = getattr(settings, "H5PXBLOCK_USER_STATE_COMPRESS_MIN_SIZE", 1024)
+USER_STATE_COMPRESSED_PREFIX = "h5pz1:"
+VERSIONED_CONTENT = getattr(settings, "H5PXBLOCK_VERSIONED_CONTENT", False)
+CONTENT_VERSION_GRACE_PERIOD = getattr(settings, "H5PXBLOCK_CONTENT_VERSION_GRACE_PERIOD", 24 * 60 * 60)
+IMMUTABLE_CACHE_CONTROL = getattr(
+    settings, "H5PXBLOCK_IMMUTABLE_CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+CONTENT_VERSIONS_DIR = "versions"
+MAX_PACKAGE_SIZE = getattr(settings, "H5PXBLOCK_MAX_PACKAGE_SIZE", 4 * 1024 * 1024 * 1024)
+MAX_PACKAGE_FILES = getattr(settings, "H5PXBLOCK_MAX_PACKAGE_FILES", 20000)
+MAX_COMPRESSION_RATIO = getattr(settings, "H5PXBLOCK_MAX_COMPRESSION_RATIO", 100)
+COMPRESSION_RATIO_MIN_SIZE = 1024 * 1024
+PARALLEL_EXTRACT_MIN_SIZE = getattr(settings, "H5PXBLOCK_PARALLEL_EXTRACT_MIN_SIZE", 256 * 1024)
+PACKAGE_PROGRESS_TIMEOUT = getattr(settings, "H5PXBLOCK_PACKAGE_PROGRESS_TIMEOUT", 24 * 60 * 60)
+OPTIMIZE_IMAGES = getattr(settings, "H5PXBLOCK_OPTIMIZE_IMAGES", False) and Image is not None
+if getattr(settings, "H5PXBLOCK_OPTIMIZE_IMAGES", False) and Image is None:
+    log.warning("Pillow is not installed, images of h5p content will not be optimized")
+IMAGE_OPTIMIZE_MIN_SIZE = getattr(settings, "H5PXBLOCK_IMAGE_OPTIMIZE_MIN_SIZE", 100 * 1024)
+IMAGE_MAX_DIMENSION = getattr(settings, "H5PXBLOCK_IMAGE_MAX_DIMENSION", 2560)
+IMAGE_JPEG_QUALITY = getattr(settings, "H5PXBLOCK_IMAGE_JPEG_QUALITY", 85)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+PROCESS_POOL_WORKERS = getattr(settings, "H5PXBLOCK_PROCESS_POOL_WORKERS", os.cpu_count() or 1)
+UPLOAD_CHUNK_SIZE = getattr(settings, "H5PXBLOCK_UPLOAD_CHUNK_SIZE", 5 * 1024 * 1024)
+CHUNKED_UPLOADS_DIR = "h5pxblock-chunked-uploads"
+UPLOADS_ROOT = getattr(settings, "H5PXBLOCK_UPLOADS_ROOT", None) or settings.MEDIA_ROOT
+MAX_OPEN_UPLOADS = getattr(settings, "H5PXBLOCK_MAX_OPEN_UPLOADS", 50)
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+UNPACK_STRATEGY = getattr(settings, "H5PXBLOCK_UNPACK_STRATEGY", "threads")
+PROCESS_INFLATE_MIN_SIZE = getattr(settings, "H5PXBLOCK_PROCESS_INFLATE_MIN_SIZE", 8 * 1024 * 1024)
+
+
+class InFlightLimiter:
+    """
+    Bounds the number of files and uncompressed bytes queued or being uploaded at once
+
+    A member larger than the byte budget is still let through, but only when nothing else is in flight.
+    """
+
+    def __init__(self, max_files=MAX_INFLIGHT_FILES, max_bytes=MAX_INFLIGHT_BYTES):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+        self._condition = threading.Condition()
+
+    def _has_room(self, size):
+        if self.files >= self.max_files:
+            return False
+        return self.files == 0 or self.bytes + size <= self.max_bytes
+
+    def acquire(self, size):
+        with self._condition:
+            self._condition.wait_for(lambda: self._has_room(size))
+            self.files += 1
+            self.bytes += size
+
+    def release(self, size):
+        with self._condition:
+            self.files -= 1
+            self.bytes -= size
+            self._condition.notify_all()
+
+
+class PackagePhase(Enum):
+    """Phases of package processing reported to Studio."""
+
+    VALIDATING = "validating"
+    DELETING = "deleting"
+    EXTRACTING = "extracting"
+    UPLOADING = "uploading"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class PackageProgress:
+    """
+    Tracks progress of package processing
+
+    With a job id, the status is persisted in django cache so that it can be reported by any process.
+    Saves are throttled to one per SAVE_INTERVAL seconds, except on phase changes.
+    The duration, files and bytes of each phase are sent to metrics sinks when it ends.
+    """
+
+    CACHE_KEY = "h5pxblock.package_progress.{}"
+    SAVE_INTERVAL = 1
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.status = {
+            "phase": PackagePhase.VALIDATING.value,
+            "files_done": 0,
+            "files_total": 0,
+            "bytes_done": 0,
+            "bytes_total": 0,
+            "errors": [],
+            "result": None,
+        }
+        self._lock = threading.Lock()
+        self._saved_at = 0
+        self._phase_started = time.monotonic()
+        self.save(force=True)
+
+    @classmethod
+    def get_status(cls, job_id):
+        return cache.get(cls.CACHE_KEY.format(job_id))
+
+    def save(self, force=False):
+        if not self.job_id:
+            return
+        now = time.monotonic()
+        if force or now - self._saved_at >= self.SAVE_INTERVAL:
+            self._saved_at = now
+            cache.set(self.CACHE_KEY.format(self.job_id), dict(self.status), PACKAGE_PROGRESS_TIMEOUT)
+
+    def end_phase(self):
+        phase = self.status["phase"]
+        timing("package.phase", time.monotonic() - self._phase_started, phase=phase)
+        if self.status["files_done"]:
+            increment("package.files", self.status["files_done"], phase=phase)
+            increment("package.bytes", self.status["bytes_done"], phase=phase)
+        self._phase_started = time.monotonic()
+
+    def start_phase(self, phase, files_total=0, bytes_total=0):
+        with self._lock:
+            self.end_phase()
+            self.status.update(
+                phase=phase.value, files_done=0, files_total=files_total, bytes_done=0, bytes_total=bytes_total
+            )
+            self.save(force=True)
+
+    def file_done(self, size):
+        with self._lock:
+            self.status["files_done"] += 1
+            self.status["bytes_done"] += size
+            self.save()
+
+    def add_error(self, message):
+        with self._lock:
+            increment("package.errors", phase=self.status["phase"])
+            self.status["errors"].append(message)
+            self.save(force=True)
+
+    def finish(self, **result):
+        with self._lock:
+            self.end_phase()
+            self.status["result"] = result
+            self.status["phase"] = (PackagePhase.FAILED if self.status["errors"] else PackagePhase.DONE).value
+            increment("package.processed", status=self.status["phase"])
+            self.save(force=True)
 
 
 def get_h5p_storage():
@@ -39,16 +242,250 @@ def get_h5p_storage():
     return storage
 
 
+def get_immutable_storage(storage):
+    """
+    Returns a copy of storage which saves files with immutable Cache-Control metadata
+
+    Storages which don't support setting Cache-Control, like FileSystemStorage, are returned as is.
+    """
+    if hasattr(storage, "cache_control"):
+        immutable_storage = copy.copy(storage)
+        immutable_storage.cache_control = IMMUTABLE_CACHE_CONTROL
+        return immutable_storage
+    if isinstance(getattr(storage, "object_parameters", None), dict):
+        immutable_storage = copy.copy(storage)
+        key = "cache_control" if "Google" in storage.__class__.__name__ else "CacheControl"
+        immutable_storage.object_parameters = dict(storage.object_parameters, **{key: IMMUTABLE_CACHE_CONTROL})
+        return immutable_storage
+    return storage
+
+
+def get_encoding_storage(storage, encoding):
+    """
+    Returns a copy of storage which saves files with Content-Encoding metadata, their data being compressed
+
+    Returns None for storages which can't set Content-Encoding, like FileSystemStorage.
+    """
+    if not isinstance(getattr(storage, "object_parameters", None), dict):
+        return None
+    encoding_storage = copy.copy(storage)
+    key = "content_encoding" if "Google" in storage.__class__.__name__ else "ContentEncoding"
+    encoding_storage.object_parameters = dict(storage.object_parameters, **{key: encoding})
+    return encoding_storage
+
+
+def get_upload_storage():
+    """
+    Returns storage for the chunks of chunked uploads
+
+    Chunks are kept on the local filesystem under H5PXBLOCK_UPLOADS_ROOT, defaulting to MEDIA_ROOT, so that
+    packages are assembled without downloading them from the h5p storage.
+    """
+    return FileSystemStorage(location=UPLOADS_ROOT)
+
+
 def str2bool(val):
     """ Converts string value to boolean"""
     return val in ['True', 'true', '1']
 
 
+def get_upload_path(upload_id):
+    """
+    Returns storage path of the chunks of a chunked upload, rejecting malformed upload ids
+    """
+    if not UPLOAD_ID_PATTERN.match(upload_id or ""):
+        raise ValueError("Invalid upload id")
+    return os.path.join(CHUNKED_UPLOADS_DIR, upload_id)
+
+
+def get_upload_chunk_count(size):
+    return max((size + UPLOAD_CHUNK_SIZE - 1) // UPLOAD_CHUNK_SIZE, 1)
+
+
+def save_upload_chunk(storage, upload_id, index, chunk):
+    """
+    Saves a chunk of a chunked upload, replacing a chunk previously received with the same index
+
+    No new upload is started while H5PXBLOCK_MAX_OPEN_UPLOADS uploads are in progress or left abandoned.
+    """
+    if not 0 <= index < get_upload_chunk_count(MAX_PACKAGE_SIZE):
+        raise ValueError("Invalid chunk index")
+    upload_path = get_upload_path(upload_id)
+    if not storage.exists(upload_path) and count_open_uploads(storage) >= MAX_OPEN_UPLOADS:
+        raise ValueError("Too many uploads in progress, try again later")
+    if not isinstance(chunk, File):
+        chunk = File(chunk, name="{:06d}.part".format(index))
+    if chunk.size > UPLOAD_CHUNK_SIZE:
+        raise ValueError("Chunk is larger than {} bytes".format(UPLOAD_CHUNK_SIZE))
+    chunk_path = os.path.join(upload_path, "{:06d}.part".format(index))
+    if storage.exists(chunk_path):
+        # Chunks are only sent again when the browser retries them
+        increment("upload.chunk_retries")
+        storage.delete(chunk_path)
+    storage.save(chunk_path, chunk)
+
+
+def count_open_uploads(storage):
+    if not storage.exists(CHUNKED_UPLOADS_DIR):
+        return 0
+    return len(storage.listdir(CHUNKED_UPLOADS_DIR)[0])
+
+
+def get_upload_chunks(storage, upload_id):
+    """
+    Returns indexes of the chunks received for a chunked upload, so that an interrupted upload can resume
+    """
+    file_names = [os.path.basename(file_path) for file_path in list_files_cloud(storage, get_upload_path(upload_id))]
+    return sorted(int(file_name[:-len(".part")]) for file_name in file_names if file_name.endswith(".part"))
+
+
+def assemble_upload(storage, upload_id, chunk_count, name):
+    """
+    Concatenates the chunks of a chunked upload into a temporary file, which is returned open
+
+    Chunks are streamed and deleted once assembled. Raises ValueError if any chunk is missing.
+    """
+    upload_path = get_upload_path(upload_id)
+    missing = set(range(chunk_count)) - set(get_upload_chunks(storage, upload_id))
+    if chunk_count < 1 or missing:
+        raise ValueError("Missing {} chunks of upload {}".format(len(missing), upload_id))
+
+    package = TemporaryUploadedFile(os.path.basename(name), "application/zip", 0, None)
+    for index in range(chunk_count):
+        with storage.open(os.path.join(upload_path, "{:06d}.part".format(index)), "rb") as chunk:
+            shutil.copyfileobj(chunk, package.file, HASH_CHUNK_SIZE)
+    package.size = package.file.tell()
+    package.seek(0)
+    delete_upload(storage, upload_id)
+    return package
+
+
+def delete_upload(storage, upload_id):
+    """
+    Deletes the chunks of a chunked upload, along with their directory on the local filesystem
+    """
+    delete_path(storage.path(get_upload_path(upload_id)))
+
+
+def get_package_version(report):
+    """
+    Returns version id of a package, derived from the name, CRC and size of the members of its preflight report
+    """
+    digest = hashlib.sha256()
+    for zip_info in sorted(report.members, key=lambda info: info.filename):
+        digest.update("{}:{}:{}\n".format(zip_info.filename, zip_info.CRC, zip_info.file_size).encode("utf8"))
+    return digest.hexdigest()[:16]
+
+
+def delete_content_version_local(path, version):
+    """
+    Deletes a content version under local path, an empty version being content extracted at its root
+    """
+    if version:
+        delete_path(os.path.join(path, CONTENT_VERSIONS_DIR, version))
+        return
+    if not os.path.isdir(path):
+        return
+    for entry in os.listdir(path):
+        entry_path = os.path.join(path, entry)
+        if entry == CONTENT_VERSIONS_DIR:
+            continue
+        if os.path.isdir(entry_path):
+            delete_path(entry_path)
+        else:
+            os.remove(entry_path)
+
+
+def delete_content_version_cloud(storage, path, version):
+    """
+    Deletes a content version under path on cloud storage, an empty version being content uploaded at its root
+    """
+    if version:
+        return delete_existing_files_cloud(storage, os.path.join(path, CONTENT_VERSIONS_DIR, version))
+    versions_path = os.path.join(path, CONTENT_VERSIONS_DIR) + "/"
+    return delete_storage_files(
+        storage,
+        [file_path for file_path in list_files_cloud(storage, path) if not file_path.startswith(versions_path)],
+    )
+
+
+def hash_user_state(data):
+    return hashlib.sha256(data.encode("utf8")).hexdigest() if data is not None else None
+
+
+def encode_user_state(data):
+    """
+    Returns learner state to store, zlib compressed behind a version prefix when large enough to be worth it
+    """
+    if data is None or len(data) < USER_STATE_COMPRESS_MIN_SIZE:
+        return data
+    compressed = base64.b64encode(zlib.compress(data.encode("utf8"))).decode("ascii")
+    if len(compressed) + len(USER_STATE_COMPRESSED_PREFIX) >= len(data):
+        return data
+    return USER_STATE_COMPRESSED_PREFIX + compressed
+
+
+def decode_user_state(value):
+    """
+    Returns learner state stored by encode_user_state, stored states without prefix are returned as is
+    """
+    if value is None or not value.startswith(USER_STATE_COMPRESSED_PREFIX):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(USER_STATE_COMPRESSED_PREFIX):])).decode("utf8")
+
+
 def delete_path(path):
     if os.path.exists(path):
         shutil.rmtree(path)
 
 
+def delete_path_async(path):
+    """
+    Deletes a local directory in a background thread
+    """
+    def delete():
+        try:
+            delete_path(path)
+        except BaseException as exp:
+            log.error("Unable to delete %s: %s", path, exp)
+
+    threading.Thread(target=delete, daemon=True).start()
+
+
+def get_staging_path(path, kind):
+    """
+    Returns a unique hidden sibling of a local path, used to prepare or retire its content
+    """
+    return os.path.join(
+        os.path.dirname(path), ".{}.{}-{}".format(os.path.basename(path), kind, uuid.uuid4().hex)
+    )
+
+
+def link_or_copy(src, dst):
+    """
+    Hard links src to dst, falling back to a copy where hard links are not supported
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def swap_path(path, staging_path):
+    """
+    Moves a staged directory into place and deletes the directory it replaces in background
+
+    Both moves are renames within the same parent directory, so the content under path is
+    never partially written and is only missing between the two renames.
+    """
+    retired_path = get_staging_path(path, "old") if os.path.exists(path) else None
+    if retired_path:
+        os.rename(path, retired_path)
+    os.rename(staging_path, path)
+    if retired_path:
+        delete_path_async(retired_path)
+
+
 def future_result_handler(future):
     """
     Prints results of future in logs
@@ -59,54 +496,1337 @@ def future_result_handler(future):
         log.error("Future completed with error %s", exp)
 
 
+@dataclass
+class DeletionResult:
+    """
+    Outcome of deleting files on cloud storage
+    """
+
+    deleted: int = 0
+    failed: list = field(default_factory=list)
+
+    def add(self, other):
+        self.deleted += other.deleted
+        self.failed.extend(other.failed)
+
+
+class PackageRejected(ValueError):
+    """
+    Raised when a package doesn't pass preflight checks, with the errors of its report
+    """
+
+    def __init__(self, errors):
+        super().__init__(", ".join(errors))
+        self.errors = list(errors)
+
+
+@dataclass
+class PackageReport:
+    """
+    Outcome of checking a package against package limits before unpacking it
+    """
+
+    name: str
+    members: list = field(default_factory=list)
+    file_count: int = 0
+    total_size: int = 0
+    compressed_size: int = 0
+    errors: list = field(default_factory=list)
+
+    @property
+    def valid(self):
+        return not self.errors
+
+
+def get_s3_bucket(storage):
+    """
+    Returns boto3 bucket of S3 storages, which support listing a prefix and deleting keys in batches
+    """
+    bucket = getattr(storage, "bucket", None)
+    if hasattr(bucket, "objects") and hasattr(bucket, "delete_objects") and hasattr(storage, "_normalize_name"):
+        return bucket
+    return None
+
+
+def get_storage_key(storage, name):
+    """
+    Returns S3 key of given storage file name
+    """
+    clean_name = getattr(storage, "_clean_name", None)
+    if clean_name:
+        name = clean_name(name)
+    return storage._normalize_name(name)
+
+
+def list_files_cloud(storage, path):
+    """
+    Returns paths of all files under given path on cloud storage
+
+    S3 prefixes are listed in one paginated pass, other storages are walked level by level with listdir.
+    """
+    bucket = get_s3_bucket(storage)
+    with timer("storage.list", batch=bucket is not None):
+        if bucket is not None:
+            prefix = get_storage_key(storage, path).rstrip("/") + "/"
+            return [
+                os.path.join(path, s3_object.key[len(prefix):])
+                for s3_object in bucket.objects.filter(Prefix=prefix)
+            ]
+
+        file_paths = []
+        pending = [path]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                dir_names, file_names = storage.listdir(dir_path)
+            except (OSError, NotImplementedError):
+                continue
+            file_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+            pending.extend(os.path.join(dir_path, dir_name) for dir_name in dir_names)
+        return file_paths
+
+
+def list_file_details_cloud(storage, path):
+    """
+    Returns (path, size, modified time) of all files under given path on cloud storage
+
+    S3 listings carry size and modified time already, other storages are asked for them file by file.
+    """
+    bucket = get_s3_bucket(storage)
+    if bucket is not None:
+        prefix = get_storage_key(storage, path).rstrip("/") + "/"
+        return [
+            (os.path.join(path, s3_object.key[len(prefix):]), s3_object.size, s3_object.last_modified)
+            for s3_object in bucket.objects.filter(Prefix=prefix)
+        ]
+    return [
+        (file_path, storage.size(file_path), storage.get_modified_time(file_path))
+        for file_path in list_files_cloud(storage, path)
+    ]
+
+
+def delete_s3_keys(bucket, keys):
+    """
+    Deletes up to S3_DELETE_BATCH_SIZE keys with a single request
+    """
+    response = bucket.delete_objects(Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+    errors = response.get("Errors", [])
+    return DeletionResult(
+        deleted=len(keys) - len(errors),
+        failed=[(error.get("Key"), error.get("Message")) for error in errors],
+    )
+
+
+def delete_storage_file(storage, file_path):
+    try:
+        storage.delete(file_path)
+    except BaseException as exp:
+        return DeletionResult(failed=[(file_path, str(exp))])
+    return DeletionResult(deleted=1)
+
+
+def delete_storage_files(storage, file_paths):
+    """
+    Deletes given files on cloud storage using a single worker pool
+
+    Storages exposing a batch API get their keys deleted S3_DELETE_BATCH_SIZE at a time,
+    others are deleted file by file in parallel.
+    """
+    result = DeletionResult()
+    if not file_paths:
+        return result
+
+    bucket = get_s3_bucket(storage)
+    with timer("storage.delete", batch=bucket is not None):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            if bucket is not None:
+                keys = [get_storage_key(storage, file_path) for file_path in file_paths]
+                futures = [
+                    executor.submit(delete_s3_keys, bucket, keys[index:index + S3_DELETE_BATCH_SIZE])
+                    for index in range(0, len(keys), S3_DELETE_BATCH_SIZE)
+                ]
+            else:
+                futures = [executor.submit(delete_storage_file, storage, file_path) for file_path in file_paths]
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result.add(future.result())
+                except BaseException as exp:
+                    log.error("Batch deletion failed with error %s", exp)
+                    result.failed.append((None, str(exp)))
+
+    increment("storage.deleted", result.deleted)
+    if result.failed:
+        increment("storage.delete_errors", len(result.failed))
+        log.error("Unable to delete %s files on cloud: %s", len(result.failed), result.failed[:10])
+    return result
+
+
 def delete_existing_files_cloud(storage, path):
     """
-    Recusively delete all files under given path on cloud storage
+    Delete all files under given path on cloud storage
     """
-    if storage.exists(path):
+    file_paths = list_files_cloud(storage, path)
+    if file_paths:
         log.info("%s path is being deleted on cloud", path)
-        dir_names, file_names = storage.listdir(path)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for file_name in file_names:
-                file_path = os.path.join(path, file_name)
-                future = executor.submit(storage.delete, file_path)
-                future.add_done_callback(future_result_handler)
+    result = delete_storage_files(storage, file_paths)
+    log.info("Deleted %s files under %s on cloud", result.deleted, path)
+    return result
 
-        for dir_name in dir_names:
-            dir_path = os.path.join(path, dir_name)
-            delete_existing_files_cloud(storage, dir_path)
 
+def is_safe_zip_member(name):
+    """
+    Returns False for zip members which are directories or have invalid or dangerous names
 
-def unpack_package_local_path(package, path):
+    Absolute names and names with parent directory components would escape the content path.
     """
-    Unpacks a zip file in local path
+    parts = name.replace("\\", "/").split("/")
+    return parts[-1] not in {"", ".", ".."} and parts[0] != "" and ".." not in parts
+
+
+def preflight_package(package, progress=None):
+    """
+    Opens a package and checks it against package limits in a single pass over the zip central directory
+
+    Packages must contain h5p.json and stay within H5PXBLOCK_MAX_PACKAGE_SIZE uncompressed bytes and
+    H5PXBLOCK_MAX_PACKAGE_FILES members, none of which may exceed H5PXBLOCK_MAX_COMPRESSION_RATIO.
+    Returns the open zip, or None if the package is rejected, and a PackageReport whose members are
+    the files to unpack.
+    """
+    started = time.perf_counter()
+    report = PackageReport(name=getattr(package, "name", None))
+    try:
+        h5p_zip = ZipFile(package, 'r')
+    except (BadZipFile, OSError, ValueError):
+        report.errors.append('{} is not a valid zip'.format(report.name))
+        h5p_zip = None
+
+    if h5p_zip is not None:
+        infolist = h5p_zip.infolist()
+        report.file_count = len(infolist)
+        for zip_info in infolist:
+            report.total_size += zip_info.file_size
+            report.compressed_size += zip_info.compress_size
+            if not is_safe_zip_member(zip_info.filename):
+                continue
+            if (
+                zip_info.file_size >= COMPRESSION_RATIO_MIN_SIZE
+                and zip_info.file_size > MAX_COMPRESSION_RATIO * max(zip_info.compress_size, 1)
+            ):
+                report.errors.append('{} exceeds the maximum compression ratio'.format(zip_info.filename))
+            report.members.append(zip_info)
+        if report.file_count > MAX_PACKAGE_FILES:
+            report.errors.append('Package has {} files, more than the maximum of {}'.format(
+                report.file_count, MAX_PACKAGE_FILES
+            ))
+        if report.total_size > MAX_PACKAGE_SIZE:
+            report.errors.append('Package is {} bytes uncompressed, more than the maximum of {}'.format(
+                report.total_size, MAX_PACKAGE_SIZE
+            ))
+        if not any(zip_info.filename == "h5p.json" for zip_info in report.members):
+            report.errors.append('Package has no h5p.json')
+
+    if not report.valid:
+        if h5p_zip is not None:
+            h5p_zip.close()
+            h5p_zip = None
+        for error in report.errors:
+            log.error('Rejected h5p package %s: %s', report.name, error)
+            if progress:
+                progress.add_error(error)
+    timing("package.preflight", time.perf_counter() - started, status="ok" if report.valid else "error")
+    return h5p_zip, report
+
+
+def build_zip_manifest(h5p_zip, members, content_hash=SYNC_CONTENT_HASH):
+    """
+    Builds a manifest of the package members, as listed by preflight_package, from the zip central directory
+
+    CRC and size come from the directory for free. When content_hash is set, each member is also
+    streamed through sha256 to guard against CRC collisions.
+    """
+    files = {}
+    for zip_info in members:
+        entry = {"crc": zip_info.CRC, "size": zip_info.file_size}
+        if content_hash:
+            digest = hashlib.sha256()
+            with h5p_zip.open(zip_info) as member:
+                for chunk in iter(lambda: member.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            entry["sha256"] = digest.hexdigest()
+        files[zip_info.filename] = entry
+
+    return {"version": MANIFEST_VERSION, "files": files}
+
+
+def diff_manifests(previous, current):
+    """
+    Returns names of files which are new or changed in current manifest and names of removed files
+    """
+    previous_files = previous.get("files", {})
+    current_files = current["files"]
+    changed = [name for name, entry in current_files.items() if previous_files.get(name) != entry]
+    removed = [name for name in previous_files if name not in current_files]
+    return changed, removed
+
+
+def load_json_local(file_path):
+    try:
+        with open(file_path, "r", encoding="utf8") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_json_local(file_path, data):
+    """
+    Writes data as json, replacing the file at once rather than rewriting it in place
+    """
+    temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+    with open(temp_path, "w", encoding="utf8") as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, file_path)
+
+
+def load_json_cloud(storage, file_path):
+    try:
+        with storage.open(file_path, "rb") as json_file:
+            return json.loads(json_file.read().decode("utf8"))
+    except BaseException as exp:
+        log.info("Unable to load %s from cloud: %s", file_path, exp)
+        return None
+
+
+def save_json_cloud(storage, file_path, data):
+    if storage.exists(file_path):
+        storage.delete(file_path)
+    storage.save(file_path, ContentFile(json.dumps(data).encode("utf8")))
+
+
+def load_manifest_local(path):
+    """
+    Loads manifest of previously extracted package from local path
+    """
+    manifest = load_json_local(os.path.join(path, MANIFEST_FILE_NAME))
+    return manifest if manifest and manifest.get("version") == MANIFEST_VERSION else None
+
+
+def load_manifest_cloud(storage, path):
+    """
+    Loads manifest of previously uploaded package from storage
+    """
+    manifest = load_json_cloud(storage, os.path.join(path, MANIFEST_FILE_NAME))
+    return manifest if manifest and manifest.get("version") == MANIFEST_VERSION else None
+
+
+def read_zip_json(h5p_zip, name):
+    """
+    Returns parsed content of a json member of the zip, or None if it is missing or invalid
+    """
+    try:
+        return json.loads(h5p_zip.read(name).decode("utf8"))
+    except (KeyError, ValueError) as exp:
+        log.warning("Unable to read %s from package: %s", name, exp)
+        return None
+
+
+def get_library_id(library):
+    """
+    Returns (machineName, majorVersion, minorVersion) of a library or dependency
+
+    Versions are strings in the dependencies listed by h5p.json and integers in library.json files.
+    """
+    try:
+        return (library.get("machineName"), int(library.get("majorVersion")), int(library.get("minorVersion")))
+    except (TypeError, ValueError):
+        return (library.get("machineName"), library.get("majorVersion"), library.get("minorVersion"))
+
+
+def index_package(h5p_zip, manifest):
+    """
+    Adds an index of the package content to its manifest
+
+    h5p.json, content/content.json and the bundled library.json files are parsed once so that the
+    preloadedDependencies graph can be resolved into the JS and CSS files to load, in load order.
+    """
+    h5p_json = read_zip_json(h5p_zip, "h5p.json") or {}
+    content_json = read_zip_json(h5p_zip, "content/content.json")
+
+    libraries = {}
+    for name in h5p_zip.namelist():
+        folder, _, file_name = name.partition("/")
+        if file_name == "library.json" and folder != "content":
+            library = read_zip_json(h5p_zip, name)
+            if library:
+                libraries[get_library_id(library)] = (folder, library)
+
+    ordered, visiting = [], set()
+
+    def visit(dependency):
+        library_id = get_library_id(dependency)
+        if library_id in visiting:
+            return
+        visiting.add(library_id)
+        if library_id not in libraries:
+            log.warning("Library %s-%s.%s is not bundled in package", *library_id)
+            return
+        folder, library = libraries[library_id]
+        for sub_dependency in library.get("preloadedDependencies", []):
+            visit(sub_dependency)
+        ordered.append((folder, library))
+
+    for dependency in h5p_json.get("preloadedDependencies", []):
+        visit(dependency)
+
+    main_library = next(
+        (
+            "{}-{}.{}".format(*get_library_id(dependency))
+            for dependency in h5p_json.get("preloadedDependencies", [])
+            if dependency.get("machineName") == h5p_json.get("mainLibrary")
+        ),
+        None,
+    )
+    manifest.update(
+        title=h5p_json.get("title"),
+        main_library=main_library,
+        valid_content_json=content_json is not None,
+        libraries=[folder for folder, _library in ordered],
+        js=[
+            "{}/{}".format(folder, asset["path"])
+            for folder, library in ordered
+            for asset in library.get("preloadedJs", [])
+        ],
+        css=[
+            "{}/{}".format(folder, asset["path"])
+            for folder, library in ordered
+            for asset in library.get("preloadedCss", [])
+        ],
+        total_size=sum(entry["size"] for entry in manifest["files"].values()),
+        file_count=len(manifest["files"]),
+    )
+    return manifest
+
+
+def get_package_libraries(h5p_zip):
+    """
+    Returns libraries bundled in the package keyed by their folder name
+
+    Each library comes with its store key, built from machineName-major.minor.patch and a hash
+    of the CRC and size of every file of the library, and the names of its zip members.
+    """
+    members = {}
+    for name in h5p_zip.namelist():
+        folder, _, file_name = name.partition("/")
+        if file_name and folder != "content" and is_safe_zip_member(name):
+            members.setdefault(folder, []).append(name)
+
+    libraries = {}
+    for folder, names in members.items():
+        library_json_name = "{}/library.json".format(folder)
+        if library_json_name not in names:
+            continue
+        library = read_zip_json(h5p_zip, library_json_name)
+        if library is None:
+            continue
+        digest = hashlib.sha256()
+        for name in sorted(names):
+            zip_info = h5p_zip.getinfo(name)
+            digest.update("{}:{}:{}\n".format(name, zip_info.CRC, zip_info.file_size).encode("utf8"))
+        libraries[folder] = {
+            "key": "{}-{}.{}.{}-{}".format(
+                library["machineName"],
+                library["majorVersion"],
+                library["minorVersion"],
+                library.get("patchVersion", 0),
+                digest.hexdigest()[:16],
+            ),
+            "members": names,
+        }
+    return libraries
+
+
+def get_library_set_key(libraries):
+    """
+    Returns the key of the set of libraries of a package, as returned by get_package_libraries
+
+    The key is a hash of the folder and key of every library, so that it names a prefix of the
+    shared library store which is only ever written once, by the first package bundling these builds.
+    """
+    digest = hashlib.sha256()
+    for folder in sorted(libraries):
+        digest.update("{}:{}\n".format(folder, libraries[folder]["key"]).encode("utf8"))
+    return digest.hexdigest()[:16]
+
+
+def get_library_set_marker(libraries):
+    return {"libraries": {folder: library["key"] for folder, library in libraries.items()}}
+
+
+def share_libraries_local(h5p_zip, shared_path):
+    """
+    Extracts bundled libraries into their library set of the local shared library store
+
+    A new set is extracted into a hidden sibling directory which is renamed into place once complete,
+    and existing sets are never written again. Returns the key of the set and the names of the library
+    members now served from it, or None if the package bundles no library.
+    """
+    libraries = get_package_libraries(h5p_zip)
+    if not libraries:
+        return None
+    set_key = get_library_set_key(libraries)
+    set_path = os.path.join(shared_path, set_key)
+    members = {name for library in libraries.values() for name in library["members"]}
+    if load_json_local(os.path.join(set_path, LIBRARY_MARKER_FILE_NAME)):
+        return set_key, members
+
+    log.info("Writing library set %s to shared store", set_key)
+    staging_path = get_staging_path(set_path, "new")
+    try:
+        os.makedirs(staging_path)
+        extract_zip_members(h5p_zip, sorted(members), staging_path)
+        save_json_local(os.path.join(staging_path, LIBRARY_MARKER_FILE_NAME), get_library_set_marker(libraries))
+        if os.path.exists(set_path) and not load_json_local(os.path.join(set_path, LIBRARY_MARKER_FILE_NAME)):
+            # Left incomplete by an earlier version of the store, as sets only appear through renames
+            delete_path(set_path)
+        try:
+            os.rename(staging_path, set_path)
+        except OSError:
+            # The same set was written concurrently by another package
+            if not load_json_local(os.path.join(set_path, LIBRARY_MARKER_FILE_NAME)):
+                raise
+    finally:
+        delete_path(staging_path)
+    return set_key, members
+
+
+def share_libraries_cloud(h5p_zip, storage, shared_path):
+    """
+    Uploads bundled libraries into their library set of the shared library store on cloud storage
+
+    Files of a new set are saved with immutable Cache-Control metadata and its marker is saved last, existing
+    sets are never written again. Returns the key of the set and the names of the library members now
+    served from it, or None if the package bundles no library or they failed to upload.
+    """
+    libraries = get_package_libraries(h5p_zip)
+    if not libraries:
+        return None
+    set_key = get_library_set_key(libraries)
+    set_path = os.path.join(shared_path, set_key)
+    members = {name for library in libraries.values() for name in library["members"]}
+    if load_json_cloud(storage, os.path.join(set_path, LIBRARY_MARKER_FILE_NAME)):
+        return set_key, members
+
+    log.info("Uploading library set %s to shared store", set_key)
+    # Files left by an interrupted upload of the set, not served as its marker is missing, are replaced
+    overwrite = bool(list_files_cloud(storage, set_path))
+    failed, _precompressed = upload_zip_members(
+        h5p_zip, sorted(members), get_immutable_storage(storage), set_path, overwrite=overwrite
+    )
+    if failed:
+        log.error("Unable to upload %s library files to shared store", len(failed))
+        return None
+    save_json_cloud(storage, os.path.join(set_path, LIBRARY_MARKER_FILE_NAME), get_library_set_marker(libraries))
+    return set_key, members
+
+
+def is_compressible(file_name, size):
+    return bool(PRECOMPRESS_ENCODINGS) and size >= PRECOMPRESS_MIN_SIZE and file_name.lower().endswith(
+        PRECOMPRESS_EXTENSIONS
+    )
+
+
+def compress_data(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data)
+
+
+def get_precompressed_variants(h5p_zip, file_name):
+    """
+    Returns (encoding, file suffix, compressed data) of each configured encoding that makes the member smaller
+    """
+    return compress_variants(h5p_zip.read(file_name))
+
+
+def compress_variants(data):
+    variants = []
+    for encoding in PRECOMPRESS_ENCODINGS:
+        compressed = compress_data(data, encoding)
+        if len(compressed) < len(data):
+            variants.append((encoding, PRECOMPRESS_SUFFIXES[encoding], compressed))
+    return variants
+
+
+def get_precompressed_names(manifest, file_names):
+    """
+    Returns names of the precompressed variants recorded in manifest for given files
+
+    Files compressed in place have no variants.
+    """
+    if manifest.get("precompressed_in_place"):
+        return []
+    precompressed = manifest.get("precompressed", {})
+    return [
+        file_name + PRECOMPRESS_SUFFIXES[encoding]
+        for file_name in file_names
+        for encoding in precompressed.get(file_name, [])
+    ]
+
+
+def precompress_local(h5p_zip, file_name, path):
+    """
+    Writes precompressed variants of a member next to its extracted file
+    """
+    encodings = []
+    for encoding, suffix, compressed in get_precompressed_variants(h5p_zip, file_name):
+        with open(os.path.join(path, file_name + suffix), "wb") as variant_file:
+            variant_file.write(compressed)
+        encodings.append(encoding)
+    return encodings
+
+
+def precompress_cloud(h5p_zip, file_name, storage, path, overwrite=False):
+    """
+    Uploads precompressed variants of a member next to it
+
+    Storages like S3 derive the Content-Encoding of these files from their extension.
+    """
+    encodings = []
+    for encoding, suffix, compressed in get_precompressed_variants(h5p_zip, file_name):
+        real_path = os.path.join(path, file_name + suffix)
+        if overwrite and storage.exists(real_path):
+            storage.delete(real_path)
+        storage.save(real_path, ContentFile(compressed))
+        encodings.append(encoding)
+    return encodings
+
+
+def compresses_in_place(storage):
+    """
+    Returns whether compressible files are saved compressed under their own name on storage
+
+    Storages serving files as stored, like S3, would never serve precompressed variants to the player,
+    which requests files by their original name. Files are compressed with gzip, which all browsers accept.
+    """
+    return bool(PRECOMPRESS_ENCODINGS) and get_encoding_storage(storage, "gzip") is not None
+
+
+def save_encoded_cloud(storage, file_path, data):
+    """
+    Saves data gzip compressed with Content-Encoding metadata, or as is if compression doesn't make it smaller
+
+    Returns encodings of the saved file.
+    """
+    compressed = compress_data(data, "gzip")
+    if len(compressed) < len(data):
+        get_encoding_storage(storage, "gzip").save(file_path, ContentFile(compressed, name=os.path.basename(file_path)))
+        return ["gzip"]
+    storage.save(file_path, ContentFile(data, name=os.path.basename(file_path)))
+    return []
+
+
+def upload_encoded_member(h5p_zip, zip_info, storage, real_path, overwrite=False):
+    """
+    Uploads a member compressed in place by save_encoded_cloud and returns its encodings
+    """
+    data = h5p_zip.read(zip_info)
+    with timer("storage.upload"):
+        if overwrite and storage.exists(real_path):
+            storage.delete(real_path)
+        return save_encoded_cloud(storage, real_path, data)
+
+
+def collect_precompressed(futures):
+    """
+    Returns encodings of precompressed variants keyed by file name from finished compression futures
+    """
+    precompressed = {}
+    for future, file_name in futures.items():
+        try:
+            encodings = future.result()
+        except BaseException as exp:
+            log.error("Unable to precompress %s: %s", file_name, exp)
+            continue
+        if encodings:
+            precompressed[file_name] = encodings
+    return precompressed
+
+
+def get_process_pool(max_workers=PROCESS_POOL_WORKERS):
+    """
+    Returns a pool of processes for CPU bound work
+
+    Daemonic processes, like prefork celery workers, can't start processes of their own and get a thread pool.
+    Processes are started by a forkserver, or spawned where it isn't available, as forking the threads of web
+    and celery workers, or of the upload pool, could leave locks held by other threads locked in the children.
+    """
+    if multiprocessing.current_process().daemon:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)
+    )
+
+
+class MemberInflater:
+    """
+    Inflates large deflated members of a package in a process pool, handing them over as temp files
+
+    With H5PXBLOCK_UNPACK_STRATEGY set to "processes", deflated members of at least
+    H5PXBLOCK_PROCESS_INFLATE_MIN_SIZE bytes are decompressed by worker processes, which reopen the
+    package from disk, instead of under the GIL of the threads writing them. Stored members and
+    smaller ones are streamed from the zip as usual. Packages that aren't files on disk are
+    spooled to a temp file first.
+    """
+
+    def __init__(self, package, strategy=UNPACK_STRATEGY):
+        self.package = package
+        self.enabled = strategy == "processes"
+        self.executor = None
+        self.temp_dir = None
+        self.package_path = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.temp_dir = tempfile.mkdtemp(prefix="h5pxblock-")
+            self.package_path = self.get_package_path()
+            self.executor = get_process_pool()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.temp_dir is not None:
+            delete_path(self.temp_dir)
+
+    def get_package_path(self):
+        if hasattr(self.package, "temporary_file_path"):
+            return self.package.temporary_file_path()
+        name = getattr(self.package, "name", None)
+        if isinstance(name, str) and os.path.isabs(name) and os.path.isfile(name):
+            return name
+        package_path = os.path.join(self.temp_dir, "package.h5p")
+        self.package.seek(0)
+        with open(package_path, "wb") as package_file:
+            shutil.copyfileobj(self.package, package_file, HASH_CHUNK_SIZE)
+        self.package.seek(0)
+        return package_path
+
+    def accepts(self, zip_info):
+        return (
+            self.executor is not None
+            and zip_info.compress_type == ZIP_DEFLATED
+            and zip_info.file_size >= PROCESS_INFLATE_MIN_SIZE
+        )
+
+    def submit(self, zip_info):
+        """
+        Returns a future of the path of the temp file the member is inflated into
+        """
+        return self.executor.submit(inflate_zip_member, self.package_path, zip_info.filename, self.temp_dir)
+
+
+def is_optimizable_image(file_name, size):
+    return (
+        file_name.startswith("content/")
+        and file_name.lower().endswith(IMAGE_EXTENSIONS)
+        and size >= IMAGE_OPTIMIZE_MIN_SIZE
+    )
+
+
+class ImageOptimizer:
+    """
+    Optimizes oversized PNG and JPEG content images of a package in a process pool, member by member
+
+    With H5PXBLOCK_OPTIMIZE_IMAGES enabled, images accepted by the optimizer are read and submitted by the
+    extracting or uploading loop once the InFlightLimiter let them through, and written by their worker from
+    the optimized data, so that only images in flight are held in memory. Images keep their name and format,
+    so that references from content.json stay valid. Sizes of the images made smaller are recorded in optimized.
+    """
+
+    def __init__(self, enabled=OPTIMIZE_IMAGES):
+        self.enabled = enabled
+        self.executor = None
+        self.optimized = {}
+
+    def __enter__(self):
+        if self.enabled:
+            self.executor = get_process_pool()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            log.info("Optimized %s images", len(self.optimized))
+
+    def accepts(self, zip_info):
+        return self.executor is not None and is_optimizable_image(zip_info.filename, zip_info.file_size)
+
+    def submit(self, h5p_zip, zip_info):
+        """
+        Returns a future of the optimized data of the member, or of None if it isn't made smaller
+        """
+        future = self.executor.submit(
+            optimize_image, h5p_zip.read(zip_info), IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY
+        )
+        future.add_done_callback(lambda _future: self.record(zip_info.filename, _future))
+        return future
+
+    def record(self, file_name, future):
+        if future.exception() is not None:
+            log.error("Unable to optimize %s: %s", file_name, future.exception())
+        elif future.result() is not None:
+            self.optimized[file_name] = len(future.result())
+
+
+def get_optimized_data(optimized):
+    """
+    Returns data of a future of ImageOptimizer, None when there is none or the image couldn't be optimized
+    """
+    if optimized is None or optimized.exception() is not None:
+        return None
+    return optimized.result()
+
+
+def extract_zip_member(h5p_zip, zip_info, path, optimized=None, inflated=None):
     """
-    delete_path(path)
-    os.makedirs(path)
+    Streams a single zip member to its file under local path
 
-    if not is_zipfile(package):
-        log.error('%s is not a valid zip', package.name)
+    Optimized data of the future of an ImageOptimizer is written in place of the member when there is some,
+    and the future of an inflated temp file is moved into place.
+    """
+    file_path = os.path.join(path, *zip_info.filename.split("/"))
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    data = get_optimized_data(optimized)
+    if inflated is not None:
+        shutil.move(inflated.result(), file_path)
+        return
+    if data is not None:
+        with open(file_path, "wb") as member_file:
+            member_file.write(data)
         return
+    with h5p_zip.open(zip_info) as member, open(file_path, "wb") as member_file:
+        shutil.copyfileobj(member, member_file, HASH_CHUNK_SIZE)
+
+
+def extract_zip_members(h5p_zip, file_names, path, progress=None, optimizer=None, inflater=None):
+    """
+    Extracts given zip members in local path and returns encodings of their precompressed variants
 
-    with ZipFile(package, 'r') as h5p_zip:
-        log.info('Extracting all the files now from %s', package.name)
-        h5p_zip.extractall(path)
+    Members of at least H5PXBLOCK_PARALLEL_EXTRACT_MIN_SIZE bytes are extracted by a worker pool, bounded
+    by an InFlightLimiter, while small ones are extracted directly. Compression runs in the same pool.
+    Images accepted by the optimizer are optimized by its process pool and written by the worker pool,
+    and other members accepted by the inflater are decompressed by its process pool.
+    """
+    limiter = InFlightLimiter()
+    extract_futures = []
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for file_name in file_names:
+            zip_info = h5p_zip.getinfo(file_name)
+            optimizable = optimizer is not None and optimizer.accepts(zip_info)
+            if zip_info.file_size >= PARALLEL_EXTRACT_MIN_SIZE or optimizable:
+                limiter.acquire(zip_info.file_size)
+                optimized = optimizer.submit(h5p_zip, zip_info) if optimizable else None
+                inflated = (
+                    inflater.submit(zip_info)
+                    if inflater and not optimizable and inflater.accepts(zip_info) else None
+                )
+                future = executor.submit(extract_zip_member, h5p_zip, zip_info, path, optimized, inflated)
+                future.add_done_callback(lambda _future, size=zip_info.file_size: limiter.release(size))
+                if progress:
+                    future.add_done_callback(lambda _future, size=zip_info.file_size: progress.file_done(size))
+                extract_futures.append(future)
+            else:
+                extract_zip_member(h5p_zip, zip_info, path)
+                if progress:
+                    progress.file_done(zip_info.file_size)
+            if is_compressible(file_name, zip_info.file_size):
+                futures[executor.submit(precompress_local, h5p_zip, file_name, path)] = file_name
+
+    for future in extract_futures:
+        future.result()
+    return collect_precompressed(futures)
+
+
+def remove_local_files(path, file_names):
+    """
+    Removes given files under local path along with directories left empty
+    """
+    for file_name in file_names:
+        file_path = os.path.join(path, file_name)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        directory = os.path.dirname(file_path)
+        while directory != path and os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+
+def finalize_manifest(manifest, previous, libraries_shared, precompressed, optimized=None, progress=None):
+    """
+    Records outcome of unpacking in the package manifest
+
+    Precompressed variants and bytes saved by optimizing images of files left untouched by a
+    differential sync are carried over from previous manifest, precompressed variants only if files were
+    compressed in place or not alike.
+    The id of the background job which unpacked the package without errors is recorded, so that blocks
+    can apply its outcome once its progress expired from the cache.
+    """
+    manifest["libraries_shared"] = libraries_shared
+    if progress is not None and progress.job_id and not progress.status["errors"]:
+        manifest["job_id"] = progress.job_id
+    same_compression = (
+        (previous or {}).get("precompressed_in_place", False) == manifest.get("precompressed_in_place", False)
+    )
+    for key, values in (
+        ("precompressed", precompressed),
+        ("optimized_images", optimized or {}),
+    ):
+        carried_over = {
+            file_name: value
+            for file_name, value in (previous or {}).get(key, {}).items()
+            if file_name in manifest["files"] and previous["files"].get(file_name) == manifest["files"][file_name]
+            and (key != "precompressed" or same_compression)
+        }
+        manifest[key] = dict(carried_over, **values)
+
+
+def rewrite_css_urls(css, css_path, bundle_path):
+    """
+    Rewrites relative urls of a stylesheet so that they resolve from the bundle location
+    """
+    css_dir = posixpath.dirname(css_path)
+
+    def rewrite(match):
+        quote, url = match.groups()
+        if url.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(css_dir, url))
+        return "url({0}{1}{0})".format(quote, posixpath.relpath(target, bundle_path))
+
+    return CSS_URL_PATTERN.sub(rewrite, css)
+
+
+def build_aggregated_assets(h5p_zip, manifest, path, libraries_path):
+    """
+    Returns files of a bundle that lets the player load all preloaded JS and CSS of the package in two requests
+
+    The bundle holds a copy of h5p.json depending on the main library only, and a library.json of the main
+    library whose preloaded files are the JS and CSS of all libraries concatenated in dependency order.
+    Returns None if the main library of the package can't be resolved.
+    """
+    main_folder = manifest.get("main_library")
+    h5p_json = read_zip_json(h5p_zip, "h5p.json")
+    main_library = read_zip_json(h5p_zip, "{}/library.json".format(main_folder))
+    if main_folder not in manifest.get("libraries", []) or not h5p_json or not main_library:
+        log.warning("Assets of package %s are not aggregated, its main library is not bundled", main_folder)
+        return None
+
+    h5p_json["preloadedDependencies"] = [
+        dependency for dependency in h5p_json["preloadedDependencies"]
+        if dependency.get("machineName") == h5p_json.get("mainLibrary")
+    ]
+    main_library["preloadedDependencies"] = []
+    main_library["preloadedJs"] = [{"path": "bundle.js"}]
+    main_library["preloadedCss"] = [{"path": "bundle.css"}]
+
+    bundle_path = posixpath.join(path, AGGREGATED_ASSETS_DIR, main_folder)
+    js = b"\n;\n".join(h5p_zip.read(file_name) for file_name in manifest["js"])
+    css = "\n".join(
+        rewrite_css_urls(
+            h5p_zip.read(file_name).decode("utf8"), posixpath.join(libraries_path, file_name), bundle_path
+        )
+        for file_name in manifest["css"]
+    )
+    return {
+        "h5p.json": json.dumps(h5p_json).encode("utf8"),
+        "{}/library.json".format(main_folder): json.dumps(main_library).encode("utf8"),
+        "{}/bundle.js".format(main_folder): js,
+        "{}/bundle.css".format(main_folder): css.encode("utf8"),
+    }
+
+
+def write_aggregated_assets_local(h5p_zip, manifest, path, libraries_path):
+    """
+    Writes the aggregated assets bundle of the package, with its precompressed variants, under local path
+    """
+    bundle_root = os.path.join(path, AGGREGATED_ASSETS_DIR)
+    delete_path(bundle_root)
+    bundle = build_aggregated_assets(h5p_zip, manifest, path, libraries_path)
+    for file_name, data in (bundle or {}).items():
+        file_path = os.path.join(bundle_root, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as bundle_file:
+            bundle_file.write(data)
+        if is_compressible(file_name, len(data)):
+            for _encoding, suffix, compressed in compress_variants(data):
+                with open(file_path + suffix, "wb") as variant_file:
+                    variant_file.write(compressed)
+    return bundle is not None
+
+
+def write_aggregated_assets_cloud(h5p_zip, manifest, storage, path, libraries_path):
+    """
+    Uploads the aggregated assets bundle of the package, with its precompressed variants or compressed in place,
+    under path
+    """
+    bundle_root = os.path.join(path, AGGREGATED_ASSETS_DIR)
+    delete_existing_files_cloud(storage, bundle_root)
+    bundle = build_aggregated_assets(h5p_zip, manifest, path, libraries_path)
+    in_place = compresses_in_place(storage)
+    for file_name, data in (bundle or {}).items():
+        file_path = os.path.join(bundle_root, file_name)
+        if in_place and is_compressible(file_name, len(data)):
+            save_encoded_cloud(storage, file_path, data)
+            continue
+        storage.save(file_path, ContentFile(data))
+        if is_compressible(file_name, len(data)):
+            for _encoding, suffix, compressed in compress_variants(data):
+                storage.save(file_path + suffix, ContentFile(compressed))
+    return bundle is not None
+
+
+def get_manifest_summary(manifest):
+    """
+    Returns the parts of a package manifest small enough to be kept in block fields
+    """
+    return {
+        "libraries_shared": manifest["libraries_shared"],
+        "title": manifest.get("title"),
+        "main_library": manifest.get("main_library"),
+        "total_size": manifest.get("total_size"),
+        "file_count": manifest.get("file_count"),
+        "precompressed_encodings": sorted(
+            {encoding for encodings in manifest["precompressed"].values() for encoding in encodings}
+        ),
+        "precompressed_files": len(manifest["precompressed"]),
+        "aggregated_assets": manifest.get("aggregated_assets", False),
+        "optimized_images": len(manifest.get("optimized_images", {})),
+        "image_bytes_saved": sum(
+            manifest["files"][file_name]["size"] - size
+            for file_name, size in manifest.get("optimized_images", {}).items()
+        ),
+    }
+
+
+def get_tree_members(storage, path):
+    """
+    Returns names, relative to path, of the package members of content unpacked under path on storage
+
+    Files generated while unpacking, like the manifest, precompressed variants and the aggregated
+    assets bundle, are left out, as well as content versions kept under path.
+    """
+    manifest = load_json_cloud(storage, os.path.join(path, MANIFEST_FILE_NAME)) or {}
+    generated = set(get_precompressed_names(manifest, list(manifest.get("precompressed", {}))))
+    generated.add(MANIFEST_FILE_NAME)
+    members = []
+    for file_path in list_files_cloud(storage, path):
+        name = os.path.relpath(file_path, path).replace(os.sep, "/")
+        if name in generated or name.split("/")[0] in (AGGREGATED_ASSETS_DIR, CONTENT_VERSIONS_DIR):
+            continue
+        members.append(name)
+    return manifest, members
 
 
-def unpack_and_upload_on_cloud(package, storage, path):
+def copy_storage_file(source, source_path, target, target_path):
+    """
+    Streams a file from one storage to another, replacing it on the target, and returns its size
+    """
+    if target.exists(target_path):
+        target.delete(target_path)
+    with source.open(source_path, "rb") as source_file:
+        content = File(source_file, name=os.path.basename(target_path))
+        size = content.size
+        target.save(target_path, content)
+    return size
+
+
+def copy_storage_tree(source, source_path, target, target_path, names=None):
+    """
+    Copies files under source_path, or given names relative to it, to target_path on another storage
+
+    Files are streamed by a pool of MAX_WORKERS threads. Returns the number of files and bytes copied.
+    """
+    if names is None:
+        names = [os.path.relpath(file_path, source_path) for file_path in list_files_cloud(source, source_path)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        sizes = list(executor.map(
+            lambda name: copy_storage_file(
+                source, os.path.join(source_path, name), target, os.path.join(target_path, name)
+            ),
+            names,
+        ))
+    return len(sizes), sum(sizes)
+
+
+def package_storage_tree(storage, path, libraries_path=None):
+    """
+    Rebuilds the package of content unpacked under path on storage, as a temporary file returned open
+
+    Libraries of content whose libraries were shared are taken from its library set in the shared store at
+    libraries_path, or from the folders of its libraries when they were shared before library sets.
+    """
+    manifest, members = get_tree_members(storage, path)
+    sources = [(name, os.path.join(path, name)) for name in members]
+    libraries_shared = manifest.get("libraries_shared")
+    if libraries_shared and libraries_path:
+        if libraries_shared is True:
+            folder_paths = [(folder, os.path.join(libraries_path, folder)) for folder in manifest.get("libraries", [])]
+        else:
+            folder_paths = [("", os.path.join(libraries_path, libraries_shared))]
+        for folder, folder_path in folder_paths:
+            file_paths = set(list_files_cloud(storage, folder_path))
+            sources.extend(
+                (posixpath.join(folder, os.path.relpath(file_path, folder_path).replace(os.sep, "/")), file_path)
+                for file_path in sorted(file_paths)
+                if os.path.basename(file_path) != LIBRARY_MARKER_FILE_NAME and not any(
+                    # Precompressed variants written next to shared library files
+                    file_path.endswith(suffix) and file_path[:-len(suffix)] in file_paths
+                    for suffix in PRECOMPRESS_SUFFIXES.values()
+                )
+            )
+
+    package = TemporaryUploadedFile("{}.h5p".format(os.path.basename(path)), "application/zip", 0, None)
+    with ZipFile(package.file, "w", ZIP_DEFLATED) as h5p_zip:
+        for name, file_path in sources:
+            with storage.open(file_path, "rb") as source_file, h5p_zip.open(name, "w") as member:
+                # Files compressed in place are read back as stored, compressed
+                if name.lower().endswith(PRECOMPRESS_EXTENSIONS):
+                    magic = source_file.read(2)
+                    source_file.seek(0)
+                    if magic == b"\x1f\x8b":
+                        source_file = gzip.GzipFile(fileobj=source_file)
+                shutil.copyfileobj(source_file, member, HASH_CHUNK_SIZE)
+    package.size = package.file.tell()
+    package.seek(0)
+    return package
+
+
+def get_files_size(manifest, file_names):
+    return sum(manifest["files"][file_name]["size"] for file_name in file_names)
+
+
+def unpack_package_local_path(package, path, shared_libraries_path=None, progress=None, preflight=None):
+    """
+    Unpacks a zip file in local path
+
+    The package is extracted into a hidden sibling of path which is then swapped into place, so
+    learners never see a partially extracted package. With H5PXBLOCK_DIFFERENTIAL_SYNC enabled, the
+    sibling starts as a hard linked copy of the current content and only new or changed members are
+    extracted and removed members are deleted, based on the manifest left by the previous extraction.
+
+    When shared_libraries_path is given, bundled libraries are extracted into their library set of that
+    shared store instead.
+    preflight is the open zip and report returned by preflight_package for a package checked already.
+    Returns the package manifest, or None if the package is rejected by preflight_package.
+    """
+    progress = progress or PackageProgress()
+    h5p_zip, report = preflight or preflight_package(package, progress)
+    if h5p_zip is None:
+        return None
+
+    staging_path = get_staging_path(path, "new")
+    try:
+        with h5p_zip:
+            manifest = index_package(h5p_zip, build_zip_manifest(h5p_zip, report.members))
+            previous = load_manifest_local(path) if DIFFERENTIAL_SYNC else None
+
+            progress.start_phase(PackagePhase.EXTRACTING)
+            libraries_key, shared_members = (
+                share_libraries_local(h5p_zip, shared_libraries_path) if shared_libraries_path else None
+            ) or (None, ())
+            for file_name in shared_members:
+                manifest["files"].pop(file_name, None)
+
+            if previous is None:
+                os.makedirs(staging_path)
+                log.info('Extracting all the files now from %s', package.name)
+                changed = list(manifest["files"])
+            else:
+                changed, removed = diff_manifests(previous, manifest)
+                log.info(
+                    'Extracting %s changed files and removing %s files from %s',
+                    len(changed), len(removed), package.name
+                )
+                progress.start_phase(PackagePhase.DELETING, files_total=len(removed))
+                shutil.copytree(path, staging_path, copy_function=link_or_copy)
+                # Changed files are removed too, so that their hard links to the live content are not written through
+                remove_local_files(
+                    staging_path, changed + removed + get_precompressed_names(previous, changed + removed)
+                )
+
+            progress.start_phase(PackagePhase.EXTRACTING, len(changed), get_files_size(manifest, changed))
+            with ImageOptimizer() as optimizer, MemberInflater(package) as inflater:
+                precompressed = extract_zip_members(h5p_zip, changed, staging_path, progress, optimizer, inflater)
+            if AGGREGATE_ASSETS:
+                manifest["aggregated_assets"] = write_aggregated_assets_local(
+                    h5p_zip, manifest, staging_path,
+                    os.path.join(shared_libraries_path, libraries_key) if libraries_key else staging_path
+                )
+
+        finalize_manifest(manifest, previous, libraries_key, precompressed, optimizer.optimized, progress)
+        save_json_local(os.path.join(staging_path, MANIFEST_FILE_NAME), manifest)
+        swap_path(path, staging_path)
+    except BaseException:
+        delete_path(staging_path)
+        raise
+    return manifest
+
+
+def upload_zip_member(h5p_zip, zip_info, storage, real_path, overwrite=False, optimized=None, inflated=None):
+    """
+    Streams a single zip member to storage without reading it into memory
+
+    Optimized data of the future of an ImageOptimizer is saved in place of the member when there is some,
+    and the future of an inflated temp file is streamed instead.
+    """
+    data = get_optimized_data(optimized)
+    with timer("storage.upload"):
+        if overwrite and storage.exists(real_path):
+            storage.delete(real_path)
+        if data is not None:
+            return storage.save(real_path, ContentFile(data, name=os.path.basename(real_path)))
+        if inflated is not None:
+            temp_path = inflated.result()
+            try:
+                with open(temp_path, "rb") as member:
+                    return storage.save(real_path, File(member, name=os.path.basename(real_path)))
+            finally:
+                os.remove(temp_path)
+        with h5p_zip.open(zip_info) as member:
+            content = File(member, name=os.path.basename(real_path))
+            content.size = zip_info.file_size
+            return storage.save(real_path, content)
+
+
+def upload_zip_members(
+    h5p_zip, file_names, storage, path, overwrite=False, progress=None, optimizer=None, inflater=None
+):
+    """
+    Uploads given zip members on cloud storage
+
+    Images accepted by the optimizer are optimized by its process pool and uploaded from their optimized
+    data, and other members accepted by the inflater are decompressed by its process pool before upload
+    threads stream them.
+
+    Members are streamed from the zip by the worker threads, and an InFlightLimiter keeps
+    the number of queued files and bytes proportional to MAX_WORKERS instead of the package size.
+    Precompressed variants of compressible members are uploaded by the same pool, or compressible members
+    are uploaded compressed in place on storages supporting it.
+
+    Returns names of the members which failed and encodings of precompressed variants keyed by member name.
+    """
+    limiter = InFlightLimiter()
+    futures = {}
+    compress_futures = {}
+    in_place = compresses_in_place(storage)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for file_name in file_names:
+            zip_info = h5p_zip.getinfo(file_name)
+            real_path = os.path.join(path, file_name)
+            limiter.acquire(zip_info.file_size)
+            optimizable = optimizer is not None and optimizer.accepts(zip_info)
+            optimized = optimizer.submit(h5p_zip, zip_info) if optimizable else None
+            encoded = in_place and is_compressible(file_name, zip_info.file_size)
+            # Members compressed in place are read whole from the zip to be compressed, inflating them aside is wasted
+            inflated = (
+                inflater.submit(zip_info)
+                if inflater and not optimizable and not encoded and inflater.accepts(zip_info) else None
+            )
+            if encoded:
+                future = executor.submit(upload_encoded_member, h5p_zip, zip_info, storage, real_path, overwrite)
+                compress_futures[future] = file_name
+            else:
+                future = executor.submit(
+                    upload_zip_member, h5p_zip, zip_info, storage, real_path, overwrite, optimized, inflated,
+                )
+            future.add_done_callback(
+                lambda _future, size=zip_info.file_size: limiter.release(size)
+            )
+            future.add_done_callback(future_result_handler)
+            if progress:
+                future.add_done_callback(
+                    lambda _future, size=zip_info.file_size: progress.file_done(size)
+                )
+            futures[future] = file_name
+            if not encoded and is_compressible(file_name, zip_info.file_size):
+                compress_future = executor.submit(precompress_cloud, h5p_zip, file_name, storage, path, overwrite)
+                compress_futures[compress_future] = file_name
+
+    failed = {file_name for future, file_name in futures.items() if future.exception()}
+    return failed, collect_precompressed(compress_futures)
+
+
+def delete_files_cloud(storage, path, file_names):
+    """
+    Deletes given files under path on cloud storage
+    """
+    return delete_storage_files(storage, [os.path.join(path, file_name) for file_name in file_names])
+
+
+def unpack_and_upload_on_cloud(
+    package, storage, path, shared_libraries_path=None, progress=None, immutable=False, preflight=None
+):
     """
     Unpacks a zip file and upload it on cloud storage
+
+    With H5PXBLOCK_DIFFERENTIAL_SYNC enabled, only new or changed members are uploaded and removed
+    members are deleted, based on the manifest stored with the previous upload. Members that fail to
+    upload are left out of the new manifest so that the next upload retries them.
+
+    When shared_libraries_path is given, bundled libraries are uploaded once into their library set of that
+    shared store instead.
+    Files under path are saved with immutable Cache-Control metadata when immutable is set.
+    preflight is the open zip and report returned by preflight_package for a package checked already.
+    Returns the package manifest, or None if the package is rejected by preflight_package.
     """
-    if not is_zipfile(package):
-        log.error('%s is not a valid zip', package.name)
-        return
+    progress = progress or PackageProgress()
+    content_storage = get_immutable_storage(storage) if immutable else storage
+    h5p_zip, report = preflight or preflight_package(package, progress)
+    if h5p_zip is None:
+        return None
 
-    delete_existing_files_cloud(storage, path)
+    with h5p_zip:
+        manifest = index_package(h5p_zip, build_zip_manifest(h5p_zip, report.members))
+        previous = load_manifest_cloud(storage, path) if DIFFERENTIAL_SYNC else None
 
-    with ZipFile(package, 'r') as h5p_zip:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for zipfile_name in h5p_zip.namelist():
-                real_path = os.path.join(path, zipfile_name)
-                if not os.path.basename(real_path) in {"", ".", ".."}:  # skip invalid or dangerous paths
-                    future = executor.submit(storage.save, real_path, ContentFile(h5p_zip.read(zipfile_name)))
-                    future.add_done_callback(future_result_handler)
+        progress.start_phase(PackagePhase.UPLOADING)
+        libraries_key, shared_members = (
+            share_libraries_cloud(h5p_zip, storage, shared_libraries_path) if shared_libraries_path else None
+        ) or (None, ())
+        for file_name in shared_members:
+            manifest["files"].pop(file_name, None)
+
+        progress.start_phase(PackagePhase.DELETING)
+        if previous is None:
+            delete_existing_files_cloud(storage, path)
+            changed = list(manifest["files"])
+        else:
+            changed, removed = diff_manifests(previous, manifest)
+            log.info('Uploading %s changed files and deleting %s files on cloud', len(changed), len(removed))
+            delete_files_cloud(storage, path, removed + get_precompressed_names(previous, changed + removed))
+
+        progress.start_phase(PackagePhase.UPLOADING, len(changed), get_files_size(manifest, changed))
+        with ImageOptimizer() as optimizer, MemberInflater(package) as inflater:
+            failed, precompressed = upload_zip_members(
+                h5p_zip, changed, content_storage, path, overwrite=previous is not None, progress=progress,
+                optimizer=optimizer, inflater=inflater,
+            )
+        if AGGREGATE_ASSETS:
+            manifest["aggregated_assets"] = write_aggregated_assets_cloud(
+                h5p_zip, manifest, content_storage, path,
+                os.path.join(shared_libraries_path, libraries_key) if libraries_key else path,
+            )
+
+    for file_name in failed:
+        manifest["files"].pop(file_name, None)
+    if failed:
+        progress.add_error('Unable to upload {} files'.format(len(failed)))
+    manifest["precompressed_in_place"] = compresses_in_place(content_storage)
+    finalize_manifest(
+        manifest, previous, libraries_key, precompressed,
+        {file_name: size for file_name, size in optimizer.optimized.items() if file_name not in failed}, progress,
+    )
+    save_json_cloud(storage, os.path.join(path, MANIFEST_FILE_NAME), manifest)
+    return manifest
@@ -0,0 +1,56 @@
+"""
+CPU bound work run in the process pool of the package pipeline
+
+Pool processes are started with forkserver or spawn rather than forked from the multithreaded processes
+unpacking packages, so that they never inherit locks held by other threads. They import this module
+afresh, which is why it only depends on the standard library and Pillow, and not on Django settings:
+values read from settings are passed as arguments.
+"""
+import io
+import shutil
+import tempfile
+from zipfile import ZipFile
+
+try:
+    from PIL import Image, ImageOps
+except ModuleNotFoundError:
+    Image = ImageOps = None
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def inflate_zip_member(package_path, file_name, temp_dir):
+    """
+    Inflates a zip member into a temp file and returns its path
+    """
+    with ZipFile(package_path, 'r') as h5p_zip, h5p_zip.open(file_name) as member:
+        with tempfile.NamedTemporaryFile(dir=temp_dir, delete=False) as temp_file:
+            shutil.copyfileobj(member, temp_file, CHUNK_SIZE)
+    return temp_file.name
+
+
+def optimize_image(data, max_dimension, jpeg_quality):
+    """
+    Returns an image downsized to max_dimension and recompressed in its original format
+
+    Returns None if that doesn't make it smaller, or for animated and unreadable images.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image_format = image.format
+        if image_format not in ("PNG", "JPEG") or getattr(image, "is_animated", False):
+            return None
+        # EXIF metadata isn't saved, so pixels are rotated as the EXIF orientation tells viewers to display them
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+        options = {"optimize": True}
+        if image.info.get("icc_profile"):
+            options["icc_profile"] = image.info["icc_profile"]
+        if image_format == "JPEG":
+            options.update(quality=jpeg_quality, progressive=True)
+        output = io.BytesIO()
+        image.save(output, format=image_format, **options)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(data) else None
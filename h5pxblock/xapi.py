@@ -0,0 +1,261 @@
+"""
+Forwarding of xAPI statements to an external LRS through a durable local queue
+
+Statements are stored in a SQLite queue and sent to the LRS in batches by a background thread, started in
+each process that queues statements. Batches are claimed for a lease, so that several processes can share
+a queue and statements claimed by a process that dies are sent by another one once the lease expires.
+Statements failing with a retriable error are sent again with an exponential backoff.
+"""
+import base64
+import functools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from h5pxblock.metrics import increment, timer
+
+log = logging.getLogger(__name__)
+
+LRS_ENDPOINT = getattr(settings, "H5PXBLOCK_LRS_ENDPOINT", None)
+LRS_USERNAME = getattr(settings, "H5PXBLOCK_LRS_USERNAME", "")
+LRS_PASSWORD = getattr(settings, "H5PXBLOCK_LRS_PASSWORD", "")
+LRS_TIMEOUT = getattr(settings, "H5PXBLOCK_LRS_TIMEOUT", 10)
+LRS_BATCH_SIZE = getattr(settings, "H5PXBLOCK_LRS_BATCH_SIZE", 50)
+LRS_MAX_ATTEMPTS = getattr(settings, "H5PXBLOCK_LRS_MAX_ATTEMPTS", 10)
+LRS_RETRY_DELAY = getattr(settings, "H5PXBLOCK_LRS_RETRY_DELAY", 2)
+LRS_MAX_RETRY_DELAY = getattr(settings, "H5PXBLOCK_LRS_MAX_RETRY_DELAY", 10 * 60)
+LRS_POLL_INTERVAL = getattr(settings, "H5PXBLOCK_LRS_POLL_INTERVAL", 5)
+LRS_QUEUE_PATH = getattr(
+    settings, "H5PXBLOCK_LRS_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "h5pxblock-xapi-queue.sqlite3")
+)
+LRS_ENABLED = bool(LRS_ENDPOINT)
+XAPI_VERSION = "1.0.3"
+MAX_REQUEST_STATEMENTS = 100
+
+
+class LRSError(Exception):
+    """
+    Raised when the LRS doesn't accept a batch, retriable unless the LRS rejected the statements
+    """
+
+    def __init__(self, message, retriable=True):
+        super().__init__(message)
+        self.retriable = retriable
+
+
+def get_retry_delay(attempts):
+    return min(LRS_RETRY_DELAY * 2 ** attempts, LRS_MAX_RETRY_DELAY)
+
+
+def prepare_statement(statement, actor):
+    """
+    Returns a copy of a statement sent by the browser, attributed to given actor
+
+    Statements get an id when they have none, so that the LRS ignores a batch sent again after a
+    response was lost, and a timestamp of when they were received.
+    """
+    statement = dict(statement, actor=actor)
+    statement.setdefault("id", str(uuid.uuid4()))
+    statement.setdefault("timestamp", datetime.now(timezone.utc).isoformat())
+    return statement
+
+
+class StatementQueue:
+    """
+    Durable queue of statements in a SQLite database, shared by the processes of a host
+    """
+
+    def __init__(self, path=LRS_QUEUE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections are per thread and must not be inherited by forked processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS statements ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, statement TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, claimed_by TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS statements_available ON statements (available_at)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def put(self, statements):
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO statements (statement, available_at) VALUES (?, ?)",
+                [(json.dumps(statement), now) for statement in statements],
+            )
+
+    def claim(self, limit, worker_id, lease):
+        """
+        Returns up to limit (id, statement, attempts) rows due for sending, claimed by worker_id for lease seconds
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE statements SET claimed_by = ?, available_at = ? WHERE id IN ("
+                "SELECT id FROM statements WHERE available_at <= ? ORDER BY id LIMIT ?)",
+                (worker_id, now + lease, now, limit),
+            )
+            rows = connection.execute(
+                "SELECT id, statement, attempts FROM statements WHERE claimed_by = ? ORDER BY id", (worker_id,)
+            ).fetchall()
+            connection.execute("UPDATE statements SET claimed_by = NULL WHERE claimed_by = ?", (worker_id,))
+        return [(row_id, json.loads(statement), attempts) for row_id, statement, attempts in rows]
+
+    def ack(self, row_ids):
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM statements WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    def retry(self, rows):
+        """
+        Makes rows available again once their backoff delay has passed
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE statements SET attempts = ?, available_at = ? WHERE id = ?",
+                [(attempts + 1, now + get_retry_delay(attempts), row_id) for row_id, _statement, attempts in rows],
+            )
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM statements").fetchone()[0]
+
+
+def send_statements(statements):
+    """
+    Posts statements to the LRS statements resource, raising LRSError if they are not stored
+    """
+    headers = {"Content-Type": "application/json", "X-Experience-API-Version": XAPI_VERSION}
+    if LRS_USERNAME:
+        credentials = "{}:{}".format(LRS_USERNAME, LRS_PASSWORD).encode()
+        headers["Authorization"] = "Basic {}".format(base64.b64encode(credentials).decode())
+    request = urllib.request.Request(
+        "{}/statements".format(LRS_ENDPOINT.rstrip("/")),
+        data=json.dumps(statements).encode(),
+        headers=headers,
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=LRS_TIMEOUT) as response:
+            response.read()
+    except urllib.error.HTTPError as exp:
+        if exp.code == 409:
+            # Statements with these ids were already stored, e.g. by an attempt whose response was lost
+            log.warning("LRS already has statements of a batch of %s", len(statements))
+            return
+        raise LRSError(
+            "LRS responded with status {}".format(exp.code), retriable=exp.code in (408, 429) or exp.code >= 500
+        ) from exp
+    except (urllib.error.URLError, OSError) as exp:
+        raise LRSError("Unable to reach LRS: {}".format(exp)) from exp
+
+
+class LRSForwarder:
+    """
+    Sends queued statements to the LRS from a background thread of the current process
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.worker_id = uuid.uuid4().hex
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_running(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name="h5pxblock-lrs-forwarder", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                forwarded = self.forward_batch()
+            except BaseException as exp:
+                log.error("Error while forwarding xAPI statements: %s", exp)
+                forwarded = 0
+            if not forwarded:
+                self._wake.wait(LRS_POLL_INTERVAL)
+                self._wake.clear()
+
+    def forward_batch(self):
+        """
+        Sends a batch of due statements and returns the number stored by the LRS
+        """
+        rows = self.queue.claim(LRS_BATCH_SIZE, "{}-{}".format(self.worker_id, os.getpid()), LRS_TIMEOUT + 30)
+        return self.forward_rows(rows) if rows else 0
+
+    def forward_rows(self, rows):
+        try:
+            with timer("xapi.forward"):
+                send_statements([statement for _row_id, statement, _attempts in rows])
+        except LRSError as exp:
+            if not exp.retriable and len(rows) > 1:
+                # The LRS rejects whole batches, statements are sent one by one to drop only invalid ones
+                return sum(self.forward_rows([row]) for row in rows)
+            retried = [row for row in rows if exp.retriable and row[2] + 1 < LRS_MAX_ATTEMPTS]
+            dropped = [row for row in rows if row not in retried]
+            if retried:
+                log.warning("Retrying %s xAPI statements: %s", len(retried), exp)
+                increment("xapi.retries", len(retried))
+                self.queue.retry(retried)
+            if dropped:
+                log.error("Dropping %s xAPI statements: %s", len(dropped), exp)
+                increment("xapi.dropped", len(dropped))
+                self.queue.ack([row_id for row_id, _statement, _attempts in dropped])
+            return 0
+        self.queue.ack([row_id for row_id, _statement, _attempts in rows])
+        increment("xapi.forwarded", len(rows))
+        return len(rows)
+
+
+@functools.lru_cache(maxsize=None)
+def get_forwarder():
+    return LRSForwarder(StatementQueue())
+
+
+def enqueue_statements(statements):
+    """
+    Stores statements for the LRS and returns without waiting for them to be sent
+    """
+    forwarder = get_forwarder()
+    forwarder.queue.put(statements)
+    increment("xapi.queued", len(statements))
+    forwarder.ensure_running()
+    forwarder.wake()
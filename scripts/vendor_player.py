@@ -0,0 +1,119 @@
+"""
+Vendors the h5p-standalone player version set in h5pxblock/player.py into h5pxblock/public/h5p-standalone
+
+The npm package is downloaded from the registry and checked against its published integrity hash, or read
+from a local tarball, e.g. made with `npm pack h5p-standalone@<version>`. Entry points of the player get
+content hashed names so that they can be cached for good, other files of the dist directory like fonts keep
+their paths, and a manifest maps each entry point to its file.
+
+Usage:
+
+    python scripts/vendor_player.py
+    python scripts/vendor_player.py --tarball h5p-standalone-3.7.0.tgz
+"""
+import argparse
+import base64
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import posixpath
+import shutil
+import sys
+import tarfile
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGISTRY_URL = "https://registry.npmjs.org/h5p-standalone/{version}"
+
+
+def load_player_module():
+    """
+    Loads h5pxblock/player.py by path, as importing the h5pxblock package requires Django settings
+    """
+    spec = importlib.util.spec_from_file_location("h5pxblock_player", os.path.join(ROOT, "h5pxblock", "player.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def download_package(version):
+    """
+    Returns the npm tarball of given version, after checking it against the integrity hash of the registry
+    """
+    with urllib.request.urlopen(REGISTRY_URL.format(version=version), timeout=60) as response:
+        dist = json.load(response)["dist"]
+    with urllib.request.urlopen(dist["tarball"], timeout=300) as response:
+        tarball = response.read()
+    algorithm, _sep, expected = dist["integrity"].partition("-")
+    if base64.b64encode(hashlib.new(algorithm, tarball).digest()).decode() != expected:
+        raise SystemExit("Integrity check failed for {}".format(dist["tarball"]))
+    return tarball
+
+
+def get_hashed_name(path, data):
+    base, extension = posixpath.splitext(path)
+    return "{}.{}{}".format(base, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+def vendor_player(player, tarball):
+    """
+    Writes the dist files of the player tarball and their manifest, replacing previously vendored files
+    """
+    target = os.path.join(ROOT, "h5pxblock", player.PLAYER_DIR)
+    staging = "{}.tmp".format(target)
+    shutil.rmtree(staging, ignore_errors=True)
+    entry_points = {path: asset for asset, path in player.PLAYER_ASSETS.items()}
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(tarball), mode="r:gz") as archive:
+        version = json.load(archive.extractfile("package/package.json"))["version"]
+        if version != player.H5P_STANDALONE_VERSION:
+            raise SystemExit("Package is version {}, not {}".format(version, player.H5P_STANDALONE_VERSION))
+        for member in archive.getmembers():
+            path = posixpath.relpath(member.name, "package")
+            if not member.isfile() or not path.startswith("dist/") or path.endswith(".map"):
+                continue
+            relative_path = posixpath.relpath(path, "dist")
+            if relative_path.startswith("..") or posixpath.isabs(relative_path):
+                raise SystemExit("Unexpected path {} in package".format(member.name))
+            data = archive.extractfile(member).read()
+            if path in entry_points:
+                relative_path = get_hashed_name(relative_path, data)
+                files[entry_points[path]] = relative_path
+            file_path = os.path.join(staging, *relative_path.split("/"))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as output:
+                output.write(data)
+
+    missing = set(player.PLAYER_ASSETS) - set(files)
+    if missing:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise SystemExit("Package has no {}".format(", ".join(player.PLAYER_ASSETS[asset] for asset in missing)))
+    with open(os.path.join(staging, player.PLAYER_MANIFEST_NAME), "w", encoding="utf8") as manifest_file:
+        json.dump({"version": player.H5P_STANDALONE_VERSION, "files": files}, manifest_file, indent=2, sort_keys=True)
+        manifest_file.write("\n")
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(staging, target)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tarball", help="npm tarball of the player to vendor instead of downloading it")
+    options = parser.parse_args()
+
+    player = load_player_module()
+    if options.tarball:
+        with open(options.tarball, "rb") as tarball_file:
+            tarball = tarball_file.read()
+    else:
+        tarball = download_package(player.H5P_STANDALONE_VERSION)
+    files = vendor_player(player, tarball)
+    for asset, file_name in sorted(files.items()):
+        print("{}: {}/{}".format(asset, player.PLAYER_DIR, file_name))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
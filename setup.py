@@ -39,10 +39,17 @@ setup(
     keywords='python edx h5p xblock',
     packages=[
         'h5pxblock',
+        'h5pxblock.management',
+        'h5pxblock.management.commands',
     ],
     install_requires=[
         'XBlock',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'images': ['Pillow'],
+        'statsd': ['statsd'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Framework :: Django',
@@ -57,7 +64,10 @@ setup(
     entry_points={
         'xblock.v1': [
             'h5pxblock = h5pxblock:H5PPlayerXBlock',
-        ]
+        ],
+        'cms.djangoapp': [
+            'h5pxblock = h5pxblock.apps:H5PXBlockConfig',
+        ],
     },
     package_data=package_data("h5pxblock", ["static", "public", "translations"]),
 )
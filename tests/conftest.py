@@ -0,0 +1,40 @@
+"""
+Configuration of the unit tests
+
+h5pxblock reads Django settings when imported, so minimal settings are configured before tests are collected.
+"""
+import os
+import shutil
+import tempfile
+
+import django
+import pytest
+from django.conf import settings
+from django.core.files import File
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cypress", "cypress", "fixtures")
+MEDIA_ROOT = tempfile.mkdtemp(prefix="h5pxblock-tests-")
+
+
+def pytest_configure():
+    settings.configure(
+        MEDIA_ROOT=MEDIA_ROOT,
+        MEDIA_URL="/media/",
+        INSTALLED_APPS=[],
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        TEMPLATES=[{"BACKEND": "django.template.backends.django.DjangoTemplates"}],
+    )
+    django.setup()
+
+
+def pytest_unconfigure():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def drag_the_words_package():
+    """
+    Real H5P package exported from h5p.org, also used by the cypress tests
+    """
+    with open(os.path.join(FIXTURES_DIR, "drag-the-words-1399.h5p"), "rb") as package:
+        yield File(package)
@@ -0,0 +1,60 @@
+"""
+Tests of the command deleting unused H5P content
+"""
+import os
+import time
+import uuid
+
+from django.core.files.base import ContentFile
+
+from h5pxblock.management.commands import gc_h5p_content
+from h5pxblock.utils import CHUNKED_UPLOADS_DIR, PACKAGE_UPLOADS_DIR
+
+
+def test_abandoned_uploads_expire(monkeypatch):
+    storage = gc_h5p_content.UPLOAD_STORAGE
+    monkeypatch.setattr(gc_h5p_content, "H5P_STORAGE", storage)
+    abandoned = [
+        storage.save(os.path.join(CHUNKED_UPLOADS_DIR, "a" * 32, "000000.part"), ContentFile(b"chunk")),
+        storage.save(os.path.join(PACKAGE_UPLOADS_DIR, "{}.h5p".format("b" * 32)), ContentFile(b"package")),
+    ]
+    resumed = [
+        storage.save(os.path.join(CHUNKED_UPLOADS_DIR, "c" * 32, "000000.part"), ContentFile(b"chunk")),
+        storage.save(os.path.join(CHUNKED_UPLOADS_DIR, "c" * 32, "000001.part"), ContentFile(b"chunk")),
+    ]
+    two_days_ago = time.time() - 2 * 24 * 60 * 60
+    for file_path in abandoned + resumed[:1]:
+        os.utime(storage.path(file_path), (two_days_ago, two_days_ago))
+
+    gc_h5p_content.Command().delete_expired_uploads(24, dry_run=False)
+
+    assert not any(storage.exists(file_path) for file_path in abandoned)
+    assert not os.path.exists(storage.path(os.path.join(CHUNKED_UPLOADS_DIR, "a" * 32)))
+    # Uploads with recent chunks are still being resumed
+    assert all(storage.exists(file_path) for file_path in resumed)
+
+
+def test_retired_content_versions_expire(monkeypatch):
+    storage = gc_h5p_content.UPLOAD_STORAGE
+    monkeypatch.setattr(gc_h5p_content, "H5P_STORAGE", storage)
+    monkeypatch.setattr(gc_h5p_content, "CONTENT_VERSION_GRACE_PERIOD", 60 * 60)
+    tree = os.path.join(gc_h5p_content.CONTENT_ROOT, "org", "course", uuid.uuid4().hex)
+    two_days_ago = time.time() - 2 * 24 * 60 * 60
+    files = {}
+    for version in ("served", "published", "retired", "recently-retired", "unrecorded", "unpacking"):
+        files[version] = storage.save(os.path.join(tree, "versions", version, "h5p.json"), ContentFile(b"{}"))
+        if version != "unpacking":
+            os.utime(storage.path(files[version]), (two_days_ago, two_days_ago))
+    prefix = os.path.relpath(tree, gc_h5p_content.CONTENT_ROOT)
+    referenced = {prefix: {"served", "published"}}
+    retired = {prefix: {"retired": two_days_ago, "recently-retired": time.time() - 60, "published": two_days_ago}}
+    monkeypatch.setattr(gc_h5p_content.Command, "get_referenced_trees", staticmethod(lambda: (referenced, retired)))
+
+    gc_h5p_content.Command().handle(
+        min_age_days=1, max_deletes_per_second=0, upload_max_age_hours=24, dry_run=False
+    )
+
+    kept = {version for version, file_path in files.items() if storage.exists(file_path)}
+    # Versions whose retirement isn't recorded are deleted after the minimum age window instead
+    assert kept == {"served", "published", "recently-retired", "unpacking"}
+    assert not os.path.exists(storage.path(os.path.join(tree, "versions", "retired")))
@@ -0,0 +1,275 @@
+"""
+Tests of the H5P player block
+"""
+import io
+import json
+import os
+import sys
+import uuid
+import zipfile
+from types import ModuleType, SimpleNamespace
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from webob import Request
+from xblock.field_data import DictFieldData
+from xblock.fields import ScopeIds
+from xblock.test.toy_runtime import ToyRuntime
+
+from h5pxblock import h5pxblock
+from h5pxblock.tasks import process_package
+from h5pxblock.utils import PackageProgress, PackageRejected
+
+
+@pytest.fixture
+def block():
+    """
+    Returns a block on a toy runtime, with the services of the LMS the block uses
+    """
+    runtime = ToyRuntime()
+    runtime.publish = mock.Mock()
+    block = h5pxblock.H5PPlayerXBlock(
+        runtime, DictFieldData({"has_score": True}), ScopeIds("student", "h5pxblock", "definition", "usage")
+    )
+    block.location = SimpleNamespace(org="org", course="course", block_id=uuid.uuid4().hex)
+    block.due = None
+    block.emit_completion = mock.Mock()
+    user_service = mock.Mock(
+        get_current_user=mock.Mock(return_value=SimpleNamespace(
+            full_name="Learner", emails=["learner@example.com"], opt_attrs={"edx-platform.user_role": "student"}
+        ))
+    )
+    toy_service = runtime.service
+    runtime.service = lambda block, name: user_service if name == "user" else toy_service(block, name)
+    return block
+
+
+def build_rejected_package():
+    """
+    Returns a zip which isn't an H5P package, as it has no h5p.json
+    """
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, "w") as h5p_zip:
+        h5p_zip.writestr("content/content.json", "{}")
+    package.seek(0)
+    package.name = "rejected.h5p"
+    package.size = len(package.getvalue())
+    return package
+
+
+def test_rejected_package_leaves_block_untouched(block, drag_the_words_package, monkeypatch):
+    monkeypatch.setattr(h5pxblock, "SHARED_LIBRARIES", True)
+    block.import_package(drag_the_words_package, asynchronous=False)
+    fields = (block.h5p_content_json_path, block.h5p_libraries_path, dict(block.h5p_content_meta))
+    assert block.h5p_libraries_path
+    assert block.h5p_content_meta["name"].endswith("drag-the-words-1399.h5p")
+
+    with pytest.raises(PackageRejected, match="h5p.json"):
+        block.import_package(build_rejected_package(), asynchronous=False)
+
+    assert (block.h5p_content_json_path, block.h5p_libraries_path, dict(block.h5p_content_meta)) == fields
+
+
+def set_user_role(block, role):
+    block.runtime.service(block, "user").get_current_user().opt_attrs["edx-platform.user_role"] = role
+
+
+def test_studio_submit_rejects_invalid_package(block):
+    set_user_role(block, "staff")
+    params = {
+        "display_name": "H5P", "show_frame": "false", "show_copyright": "false", "show_h5p": "false",
+        "show_fullscreen": "false", "is_scorable": "false", "save_freq": "0", "points": "1", "weight": "1",
+    }
+    params["h5p_content_bundle"] = SimpleNamespace(file=build_rejected_package())
+    response = block.studio_submit(SimpleNamespace(params=params))
+
+    assert response.status_code == 400
+    assert json.loads(response.body)["result"] == "error"
+    assert any("h5p.json" in error for error in json.loads(response.body)["errors"])
+    assert block.h5p_content_json_path is None
+
+
+def test_learners_cannot_upload_through_lms_handlers(block, tmp_path, monkeypatch):
+    storage = FileSystemStorage(location=str(tmp_path))
+    monkeypatch.setattr(h5pxblock, "UPLOAD_STORAGE", storage)
+    upload_id = uuid.uuid4().hex
+    chunk = Request.blank("/", POST={"upload_id": upload_id, "index": "0", "chunk": ("000000.part", b"chunk")})
+    status = Request.blank("/", method="POST", body=json.dumps({"upload_id": upload_id}).encode())
+
+    assert block.upload_chunk(chunk).status_code == 403
+    assert block.upload_status(status).status_code == 403
+    assert block.studio_submit(SimpleNamespace(params={})).status_code == 403
+    assert not os.listdir(str(tmp_path))
+
+    set_user_role(block, "instructor")
+    assert block.upload_chunk(chunk).status_code == 200
+    assert json.loads(block.upload_status(status).body) == {"chunks": [0]}
+
+
+@pytest.mark.parametrize("versioned", [False, True])
+def test_background_job_outcome_applied_on_next_view(block, drag_the_words_package, monkeypatch, versioned):
+    monkeypatch.setattr(h5pxblock, "VERSIONED_CONTENT", versioned)
+    jobs = []
+    monkeypatch.setattr(h5pxblock, "start_package_processing", lambda **kwargs: jobs.append(kwargs))
+    job_id = block.import_package(drag_the_words_package, asynchronous=True)
+    assert block.h5p_content_json_path is None
+    assert not block.apply_package_job()
+
+    # The job runs while nobody polls package_status, and its progress expires from the cache
+    process_package(**jobs[0])
+    cache.delete(PackageProgress.CACHE_KEY.format(job_id))
+
+    # Learner views don't read the manifest from storage, Studio does
+    with mock.patch.object(h5pxblock, "load_manifest_local") as load_manifest:
+        block.student_view()
+    load_manifest.assert_not_called()
+    assert block.h5p_package_job_id == job_id
+
+    block.studio_view()
+    assert block.h5p_package_job_id is None
+    assert block.h5p_content_json_path == block.get_content_version_url(block.h5p_content_version)
+    assert bool(block.h5p_content_version) == versioned
+    assert block.h5p_content_meta["name"].endswith("drag-the-words-1399.h5p")
+    assert "pending_package" not in block.h5p_content_meta
+
+
+def test_finished_job_outcome_is_saved_and_published(block, drag_the_words_package, monkeypatch):
+    jobs = []
+    monkeypatch.setattr(h5pxblock, "start_package_processing", lambda **kwargs: jobs.append(kwargs))
+    job_id = block.import_package(drag_the_words_package, asynchronous=True)
+    assert jobs[0]["usage_id"] == "usage"
+
+    # The block was published while its job was pending
+    store = mock.MagicMock(
+        get_item=mock.Mock(return_value=block),
+        has_published_version=mock.Mock(return_value=True),
+        has_changes=mock.Mock(return_value=False),
+    )
+    modules = {
+        "opaque_keys": ModuleType("opaque_keys"),
+        "opaque_keys.edx": ModuleType("opaque_keys.edx"),
+        "opaque_keys.edx.keys": SimpleNamespace(UsageKey=mock.Mock()),
+        "xmodule": ModuleType("xmodule"),
+        "xmodule.modulestore": SimpleNamespace(ModuleStoreEnum=mock.MagicMock()),
+        "xmodule.modulestore.django": SimpleNamespace(modulestore=lambda: store),
+    }
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    process_package(**jobs[0])
+
+    assert block.h5p_package_job_id is None
+    assert block.h5p_content_meta["name"].endswith("drag-the-words-1399.h5p")
+    store.update_item.assert_called_once()
+    store.publish.assert_called_once()
+    assert PackageProgress.get_status(job_id)["phase"] == "done"
+
+
+def post_statements(block, *statements):
+    """
+    Sends a batch of xAPI statements to the result handler of block
+    """
+    request = Request.blank("/", method="POST", body=json.dumps({"statements": statements}).encode())
+    return json.loads(block.result_handler(request).body)["result"]
+
+
+def test_first_scored_attempt_after_unscored_completion_publishes_grade(block):
+    consumed = {"verb": {"display": {"en-US": "consumed"}}}
+    answered = {"verb": {"display": {"en-US": "answered"}}, "result": {"score": {"raw": 0, "max": 10}}}
+
+    assert post_statements(block, consumed) == {"save_completion": True, "save_score": False}
+    block.runtime.publish.assert_not_called()
+
+    # A zero score doesn't improve on the learner's score, but no grade was published yet
+    assert post_statements(block, answered) == {"save_completion": True, "save_score": True}
+    block.runtime.publish.assert_called_once_with(
+        block, "grade", {"value": 0, "max_value": 100, "only_if_higher": True}
+    )
+    assert post_statements(block, answered)["save_score"]
+    block.runtime.publish.assert_called_once()
+
+
+def test_result_batch_publishes_best_score_once(block):
+    def answered(raw):
+        return {"verb": {"display": {"en-US": "answered"}}, "result": {"score": {"raw": raw, "max": 10}}}
+
+    assert post_statements(block, answered(3), answered(8), answered(5))["save_score"]
+    block.runtime.publish.assert_called_once_with(
+        block, "grade", {"value": 80, "max_value": 100, "only_if_higher": True}
+    )
+    assert block.weighted_score == 80
+
+    # A batch which doesn't improve on the learner's score publishes nothing
+    block.runtime.publish.reset_mock()
+    assert post_statements(block, answered(2), answered(8))["save_score"]
+    block.runtime.publish.assert_not_called()
+
+    assert post_statements(block, answered(9), answered(10))["save_score"]
+    block.runtime.publish.assert_called_once_with(
+        block, "grade", {"value": 100, "max_value": 100, "only_if_higher": True}
+    )
+
+
+def test_forced_import_unpacks_served_version_into_fresh_prefix(block, drag_the_words_package, monkeypatch):
+    monkeypatch.setattr(h5pxblock, "VERSIONED_CONTENT", True)
+    block.import_package(drag_the_words_package, asynchronous=False)
+    served_version = block.h5p_content_version
+    served_path = block.get_content_version_path(served_version)
+    served_files = sorted(os.listdir(served_path))
+
+    drag_the_words_package.seek(0)
+    block.import_package(drag_the_words_package, asynchronous=False, force=True)
+
+    assert block.h5p_content_version.startswith(served_version + "-")
+    assert block.h5p_content_json_path == block.get_content_version_url(block.h5p_content_version)
+    # The version served before is left untouched for learners who loaded it, until the grace period is over
+    assert sorted(os.listdir(served_path)) == served_files
+    assert block.h5p_content_meta["previous_versions"][-1]["version"] == served_version
+
+    drag_the_words_package.seek(0)
+    reprocessed_version = block.h5p_content_version
+    block.import_package(drag_the_words_package, asynchronous=False)
+    assert block.h5p_content_version == reprocessed_version
+
+
+def with_extra_file(package, index):
+    """
+    Returns a copy of package with an extra content file, so that it unpacks as another content version
+    """
+    package.seek(0)
+    copy = io.BytesIO()
+    with zipfile.ZipFile(package) as source, zipfile.ZipFile(copy, "w") as h5p_zip:
+        for zip_info in source.infolist():
+            h5p_zip.writestr(zip_info, source.read(zip_info))
+        h5p_zip.writestr("content/extra-{}.txt".format(index), "extra")
+    copy.seek(0)
+    copy.name = "version-{}.h5p".format(index)
+    copy.size = len(copy.getvalue())
+    return copy
+
+
+def test_version_served_by_published_block_is_never_deleted(block, drag_the_words_package, monkeypatch):
+    monkeypatch.setattr(h5pxblock, "VERSIONED_CONTENT", True)
+    monkeypatch.setattr(h5pxblock, "CONTENT_VERSION_GRACE_PERIOD", 0)
+    published = {}
+    monkeypatch.setattr(block, "get_published_content_version", lambda: published.get("version"))
+    versions = []
+
+    def upload(index):
+        block.import_package(with_extra_file(drag_the_words_package, index), asynchronous=False)
+        versions.append(block.h5p_content_version)
+
+    def exists(index):
+        return os.path.isdir(block.get_content_version_path(versions[index]))
+
+    upload(0)
+    published["version"] = versions[0]
+    upload(1)
+    upload(2)
+    # The published version is still served to learners, unlike the draft version replaced in between
+    assert [exists(index) for index in range(3)] == [True, False, True]
+
+    published["version"] = versions[2]
+    upload(3)
+    assert [exists(index) for index in range(4)] == [False, False, True, True]
@@ -0,0 +1,344 @@
+"""
+Tests of the package pipeline utilities
+"""
+import base64
+import gzip
+import io
+import json
+import os
+import zipfile
+from functools import partial
+from unittest import mock
+
+import pytest
+from django.core.files.storage import FileSystemStorage
+
+from h5pxblock import utils
+
+
+def test_get_library_id_matches_dependency_and_library_versions():
+    dependency = {"machineName": "H5P.DragText", "majorVersion": "1", "minorVersion": "10"}
+    library = {"machineName": "H5P.DragText", "majorVersion": 1, "minorVersion": 10, "patchVersion": 3}
+    assert utils.get_library_id(dependency) == utils.get_library_id(library) == ("H5P.DragText", 1, 10)
+
+
+def build_zip(members):
+    """
+    Returns an in-memory zip of given members, mapping names to bytes
+    """
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, "w", zipfile.ZIP_DEFLATED) as h5p_zip:
+        for name, data in members.items():
+            h5p_zip.writestr(name, data)
+    package.seek(0)
+    package.name = "package.h5p"
+    return package
+
+
+def test_preflight_accepts_package_and_skips_unsafe_members():
+    h5p_zip, report = utils.preflight_package(build_zip({"h5p.json": b"{}", "../outside.js": b"", "a/b.js": b"x"}))
+
+    assert h5p_zip is not None
+    assert report.valid
+    assert report.file_count == 3
+    assert [zip_info.filename for zip_info in report.members] == ["h5p.json", "a/b.js"]
+    h5p_zip.close()
+
+
+@pytest.mark.parametrize("members,limits,error", [
+    ({"content/content.json": b"{}"}, {}, "no h5p.json"),
+    ({"h5p.json": b"{}", "a.js": b"", "b.js": b""}, {"MAX_PACKAGE_FILES": 2}, "3 files"),
+    ({"h5p.json": b"{}", "a.js": b"x" * 2048}, {"MAX_PACKAGE_SIZE": 1024}, "uncompressed"),
+    ({"h5p.json": b"{}", "zeros.bin": bytes(2 * 1024 * 1024)}, {}, "compression ratio"),
+])
+def test_preflight_rejects_package_over_limits(members, limits, error, monkeypatch):
+    for name, value in limits.items():
+        monkeypatch.setattr(utils, name, value)
+    progress = utils.PackageProgress()
+
+    h5p_zip, report = utils.preflight_package(build_zip(members), progress)
+
+    assert h5p_zip is None
+    assert not report.valid
+    assert any(error in message for message in report.errors)
+    assert progress.status["errors"] == report.errors
+
+
+def test_preflight_rejects_invalid_zip():
+    package = io.BytesIO(b"not a zip")
+    package.name = "package.h5p"
+
+    h5p_zip, report = utils.preflight_package(package)
+
+    assert h5p_zip is None
+    assert report.errors == ["package.h5p is not a valid zip"]
+
+
+def test_diff_manifests_lists_new_changed_and_removed_files():
+    previous = {"files": {"same.js": [1, 10], "changed.js": [2, 10], "removed.js": [3, 10]}}
+    current = {"files": {"same.js": [1, 10], "changed.js": [4, 10], "new.js": [5, 10]}}
+
+    assert utils.diff_manifests(previous, current) == (["changed.js", "new.js"], ["removed.js"])
+    # Manifests left by versions without differential sync have no files, everything is extracted
+    assert utils.diff_manifests({}, current) == (["same.js", "changed.js", "new.js"], [])
+
+
+def test_user_state_is_compressed_when_worth_it():
+    small = '{"answers": []}'
+    large = json.dumps({"answers": ["answer"] * 1000})
+
+    assert utils.encode_user_state(small) == small
+    assert utils.encode_user_state(None) is None
+    encoded = utils.encode_user_state(large)
+    assert encoded.startswith(utils.USER_STATE_COMPRESSED_PREFIX)
+    assert len(encoded) < len(large)
+    assert utils.decode_user_state(encoded) == large
+    # States stored before compression, or too small to compress, are read as is
+    assert utils.decode_user_state(large) == large
+    assert utils.decode_user_state(None) is None
+
+
+def test_user_state_not_compressed_when_it_does_not_shrink():
+    incompressible = base64.b64encode(os.urandom(2048)).decode("ascii")
+
+    assert utils.encode_user_state(incompressible) == incompressible
+
+
+def test_library_set_key_depends_on_every_library_build():
+    libraries = {
+        "H5P.DragText-1.10": {"key": "H5P.DragText-1.10.3-aaaa", "members": []},
+        "FontAwesome-4.5": {"key": "FontAwesome-4.5.4-bbbb", "members": []},
+    }
+    reordered = dict(reversed(list(libraries.items())))
+    rebuilt = dict(libraries, **{"FontAwesome-4.5": {"key": "FontAwesome-4.5.4-cccc", "members": []}})
+
+    assert utils.get_library_set_key(libraries) == utils.get_library_set_key(reordered)
+    assert utils.get_library_set_key(libraries) != utils.get_library_set_key(rebuilt)
+    assert utils.get_library_set_key(libraries) != utils.get_library_set_key(
+        {"H5P.DragText-1.10": libraries["H5P.DragText-1.10"]}
+    )
+
+
+def test_rewrite_css_urls_resolves_relative_urls_from_bundle():
+    css = (
+        "a{background:url(../images/a.png)} b{src:url('fonts/b.woff')} c{src:url( \"c.svg\" )}"
+        " d{background:url(data:image/png;base64,AAAA)} e{src:url(https://example.com/e.woff)}"
+        " f{src:url(/static/f.png)} g{filter:url(#g)}"
+    )
+
+    rewritten = utils.rewrite_css_urls(css, "FontAwesome-4.5/css/style.css", "H5P.DragText-1.10")
+
+    assert rewritten == (
+        "a{background:url(../FontAwesome-4.5/images/a.png)} b{src:url('../FontAwesome-4.5/css/fonts/b.woff')}"
+        " c{src:url(\"../FontAwesome-4.5/css/c.svg\")}"
+        " d{background:url(data:image/png;base64,AAAA)} e{src:url(https://example.com/e.woff)}"
+        " f{src:url(/static/f.png)} g{filter:url(#g)}"
+    )
+
+
+def test_unpack_local_indexes_real_package(drag_the_words_package, tmp_path):
+    path = str(tmp_path / "block")
+    manifest = utils.unpack_package_local_path(drag_the_words_package, path)
+
+    assert manifest["title"] == "Drag the Words"
+    assert manifest["main_library"] == "H5P.DragText-1.10"
+    # Dependencies come before the libraries depending on them, and editor libraries are not preloaded
+    assert manifest["libraries"][-1] == "H5P.DragText-1.10"
+    assert manifest["libraries"].index("H5P.Question-1.5") < manifest["libraries"].index("H5P.DragText-1.10")
+    assert set(manifest["libraries"]) == {
+        "H5P.DragText-1.10", "jQuery.ui-1.10", "FontAwesome-4.5", "H5P.JoubelUI-1.3", "H5P.Transition-1.0",
+        "Drop-1.0", "Tether-1.0", "H5P.FontIcons-1.0", "H5P.Question-1.5",
+    }
+    assert "H5P.DragText-1.10/dist/h5p-drag-text.js" in manifest["js"]
+    assert manifest["css"]
+    for file_name in manifest["js"] + manifest["css"]:
+        assert os.path.isfile(os.path.join(path, file_name))
+
+
+def test_unpack_local_aggregates_assets_of_real_package(drag_the_words_package, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "AGGREGATE_ASSETS", True)
+    path = str(tmp_path / "block")
+    manifest = utils.unpack_package_local_path(drag_the_words_package, path)
+
+    assert manifest["aggregated_assets"]
+    bundle_path = os.path.join(path, utils.AGGREGATED_ASSETS_DIR)
+    h5p_json = utils.load_json_local(os.path.join(bundle_path, "h5p.json"))
+    assert [dependency["machineName"] for dependency in h5p_json["preloadedDependencies"]] == ["H5P.DragText"]
+    library_path = os.path.join(bundle_path, "H5P.DragText-1.10")
+    library = utils.load_json_local(os.path.join(library_path, "library.json"))
+    assert library["preloadedJs"] == [{"path": "bundle.js"}]
+    assert library["preloadedDependencies"] == []
+
+    with open(os.path.join(library_path, "bundle.js"), "rb") as bundle_file:
+        bundle_js = bundle_file.read()
+    with open(os.path.join(path, "H5P.DragText-1.10", "dist", "h5p-drag-text.js"), "rb") as main_file:
+        assert bundle_js.endswith(main_file.read())
+    with open(os.path.join(library_path, "bundle.css"), encoding="utf8") as bundle_file:
+        bundle_css = bundle_file.read()
+    # Relative urls of stylesheets, like fonts, resolve from the bundle to the files they resolved to before
+    css_targets = set()
+    for file_name in manifest["css"]:
+        with open(os.path.join(path, file_name), encoding="utf8") as css_file:
+            css_targets |= get_css_targets(css_file.read(), os.path.dirname(os.path.join(path, file_name)))
+    assert get_css_targets(bundle_css, library_path) == css_targets
+    assert os.path.join(path, "FontAwesome-4.5", "fontawesome-webfont.woff") in css_targets
+
+
+def get_css_targets(css, css_dir):
+    """
+    Returns paths of the files referenced by relative urls of a stylesheet in css_dir
+    """
+    return {
+        os.path.normpath(os.path.join(css_dir, url.split("?")[0].split("#")[0]))
+        for _quote, url in utils.CSS_URL_PATTERN.findall(css)
+        if not url.startswith("data:")
+    }
+
+
+def test_unpack_local_shares_library_set_of_real_package(drag_the_words_package, tmp_path):
+    shared_path = str(tmp_path / "shared-libraries")
+    first = utils.unpack_package_local_path(drag_the_words_package, str(tmp_path / "first"), shared_path)
+    set_path = os.path.join(shared_path, first["libraries_shared"])
+    marker_mtime = os.stat(os.path.join(set_path, utils.LIBRARY_MARKER_FILE_NAME)).st_mtime_ns
+    drag_the_words_package.seek(0)
+    second = utils.unpack_package_local_path(drag_the_words_package, str(tmp_path / "second"), shared_path)
+
+    # Both blocks load the libraries from one set, written once and not rewritten by the second upload
+    assert second["libraries_shared"] == first["libraries_shared"]
+    assert os.listdir(shared_path) == [first["libraries_shared"]]
+    assert os.stat(os.path.join(set_path, utils.LIBRARY_MARKER_FILE_NAME)).st_mtime_ns == marker_mtime
+    assert os.path.isfile(os.path.join(set_path, "H5P.DragText-1.10", "dist", "h5p-drag-text.js"))
+    assert not os.path.exists(os.path.join(tmp_path, "second", "H5P.DragText-1.10"))
+
+
+def build_package_with_image(package, file_name, image_data):
+    """
+    Returns a copy of a package with an image added to its content
+    """
+    copy = io.BytesIO()
+    with zipfile.ZipFile(package) as source, zipfile.ZipFile(copy, "w", zipfile.ZIP_DEFLATED) as h5p_zip:
+        for zip_info in source.infolist():
+            h5p_zip.writestr(zip_info, source.read(zip_info))
+        h5p_zip.writestr(file_name, image_data)
+    copy.seek(0)
+    copy.name = "with-image.h5p"
+    return copy
+
+
+def test_unpack_local_optimizes_images_upright(drag_the_words_package, tmp_path, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    monkeypatch.setattr(utils, "IMAGE_OPTIMIZE_MIN_SIZE", 0)
+    image = Image.effect_noise((utils.IMAGE_MAX_DIMENSION + 40, 100), 64).convert("RGB")
+    exif = image.getexif()
+    exif[0x0112] = 6  # Orientation: displayed rotated by 90 degrees clockwise
+    image_data = io.BytesIO()
+    image.save(image_data, format="JPEG", quality=100, exif=exif)
+    package = build_package_with_image(drag_the_words_package, "content/images/photo.jpg", image_data.getvalue())
+
+    path = str(tmp_path / "block")
+    with mock.patch.object(utils, "ImageOptimizer", partial(utils.ImageOptimizer, enabled=True)):
+        manifest = utils.unpack_package_local_path(package, path)
+
+    image_path = os.path.join(path, "content", "images", "photo.jpg")
+    assert manifest["optimized_images"] == {"content/images/photo.jpg": os.path.getsize(image_path)}
+    with Image.open(image_path) as optimized:
+        width, height = optimized.size
+    assert height == utils.IMAGE_MAX_DIMENSION and width < 100
+
+
+def test_unpack_local_inflates_members_in_process_pool(drag_the_words_package, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PROCESS_INFLATE_MIN_SIZE", 0)
+    expected = utils.unpack_package_local_path(drag_the_words_package, str(tmp_path / "threads"))
+    drag_the_words_package.seek(0)
+
+    # Pool processes import h5pxblock.workers afresh, without the Django settings of the test process
+    with mock.patch.object(utils, "MemberInflater", partial(utils.MemberInflater, strategy="processes")):
+        manifest = utils.unpack_package_local_path(drag_the_words_package, str(tmp_path / "processes"))
+
+    assert manifest["files"] == expected["files"]
+    for file_name in manifest["files"]:
+        with open(os.path.join(tmp_path, "threads", file_name), "rb") as expected_file:
+            with open(os.path.join(tmp_path, "processes", file_name), "rb") as inflated_file:
+                assert inflated_file.read() == expected_file.read()
+    with utils.get_process_pool(1) as pool:
+        assert pool._mp_context.get_start_method() != "fork"
+
+
+def test_chunked_upload_is_assembled_from_local_chunks(drag_the_words_package, monkeypatch):
+    monkeypatch.setattr(utils, "UPLOAD_CHUNK_SIZE", 64 * 1024)
+    storage = utils.get_upload_storage()
+    data = drag_the_words_package.read()
+    chunks = [data[index:index + utils.UPLOAD_CHUNK_SIZE] for index in range(0, len(data), utils.UPLOAD_CHUNK_SIZE)]
+    upload_id = "0" * 32
+    # Chunks are sent in any order, and retried ones replace the chunk received before
+    for index in [*reversed(range(len(chunks))), 0]:
+        utils.save_upload_chunk(storage, upload_id, index, io.BytesIO(chunks[index]))
+    assert utils.get_upload_chunks(storage, upload_id) == list(range(len(chunks)))
+
+    package = utils.assemble_upload(storage, upload_id, len(chunks), "drag-the-words.h5p")
+
+    assert package.read() == data and package.size == len(data)
+    assert not os.path.exists(storage.path(utils.get_upload_path(upload_id)))
+
+
+class EncodingStorage(FileSystemStorage):
+    """
+    Local storage recording the Content-Encoding each file is saved with, like S3 sets it on objects
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.object_parameters = {}
+        # Shared with the copies saving files with other object parameters
+        self.encodings = {}
+
+    def _save(self, name, content):
+        name = super()._save(name, content)
+        self.encodings[name] = self.object_parameters.get("ContentEncoding")
+        return name
+
+
+def test_new_uploads_are_refused_past_open_uploads_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "MAX_OPEN_UPLOADS", 2)
+    storage = FileSystemStorage(location=str(tmp_path))
+    utils.save_upload_chunk(storage, "a" * 32, 0, io.BytesIO(b"chunk"))
+    utils.save_upload_chunk(storage, "b" * 32, 0, io.BytesIO(b"chunk"))
+
+    with pytest.raises(ValueError, match="Too many uploads"):
+        utils.save_upload_chunk(storage, "c" * 32, 0, io.BytesIO(b"chunk"))
+    # Uploads in progress still get their remaining chunks
+    utils.save_upload_chunk(storage, "a" * 32, 1, io.BytesIO(b"chunk"))
+    assert utils.get_upload_chunks(storage, "a" * 32) == [0, 1]
+
+
+def test_unpack_cloud_compresses_files_in_place(drag_the_words_package, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PRECOMPRESS_ENCODINGS", ["gzip", "br"])
+    storage = EncodingStorage(location=str(tmp_path))
+    manifest = utils.unpack_and_upload_on_cloud(drag_the_words_package, storage, "block", "shared-libraries")
+
+    # The player requests files by their name, which are served compressed instead of along with variants
+    file_name = "H5P.DragText-1.10/dist/h5p-drag-text.js"
+    file_path = os.path.join("shared-libraries", manifest["libraries_shared"], file_name)
+    assert storage.encodings[file_path] == "gzip"
+    assert manifest["precompressed_in_place"]
+    assert not [name for name in storage.encodings if name.endswith((".gz", ".br"))]
+    with storage.open(file_path) as stored_file, zipfile.ZipFile(drag_the_words_package) as h5p_zip:
+        assert gzip.decompress(stored_file.read()) == h5p_zip.read(file_name)
+
+        # Packages rebuilt from the stored content get the original data back
+        with zipfile.ZipFile(utils.package_storage_tree(storage, "block", "shared-libraries")) as rebuilt_zip:
+            assert rebuilt_zip.read(file_name) == h5p_zip.read(file_name)
+
+
+def test_members_compressed_in_place_are_not_inflated_aside(drag_the_words_package, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PRECOMPRESS_ENCODINGS", ["gzip"])
+    inflater = mock.Mock(accepts=mock.Mock(return_value=True), submit=mock.Mock(return_value=None))
+    storage = EncodingStorage(location=str(tmp_path))
+    with zipfile.ZipFile(drag_the_words_package) as h5p_zip:
+        file_names = [name for name in h5p_zip.namelist() if not name.endswith("/")]
+        utils.upload_zip_members(h5p_zip, file_names, storage, "block", inflater=inflater)
+
+    inflated = {call.args[0].filename for call in inflater.submit.call_args_list}
+    encoded = {name for name, encoding in storage.encodings.items() if encoding == "gzip"}
+    assert inflated and encoded
+    assert not {os.path.join("block", name) for name in inflated} & encoded